@@ -13,7 +13,7 @@ from app.db.database import get_db
 from app.db.models import User, Device, Timecode, Session, TelegramUser, USER_ROLES
 from sqlalchemy import delete as sa_delete, text
 from app.api.dependencies import get_current_user
-from app import rate_limit, settings_cache
+from app import rate_limit, settings_cache, token_cache
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/admin")
@@ -226,6 +226,7 @@ async def change_user_role(
                 base = user.premium_until if (role == "premium" and user.premium_until) else datetime.now(timezone.utc)
                 user.timecode_grace_until = base + timedelta(days=grace_days)
             await db.commit()
+    token_cache.invalidate_user(user.id)
 
     # Уведомление при смене роли на premium
     if role == "premium" and user.notifications_enabled:
@@ -277,6 +278,7 @@ async def extend_premium(
         user.timecode_grace_until = None
 
     await db.commit()
+    token_cache.invalidate_user(user.id)
 
     # Уведомление в Telegram
     from app.db.models import TelegramUser
@@ -538,6 +540,8 @@ async def extend_all_premium(
         user.premium_warned = False
 
     await db.commit()
+    for user in users:
+        token_cache.invalidate_user(user.id)
 
     from urllib.parse import quote
     msg = quote(f"Premium продлён на {days} дн. для {len(users)} пользователей")
@@ -571,6 +575,7 @@ async def block_user(
     # Удаляем все активные сессии
     await db.execute(sa_delete(Session).where(Session.user_id == user_id))
     await db.commit()
+    token_cache.invalidate_user(user_id)
 
     logger.info(f"Admin: user {user.username} blocked, reason={reason!r}")
     from urllib.parse import quote
@@ -596,6 +601,7 @@ async def unblock_user(
     user.blocked_at = None
     user.block_reason = None
     await db.commit()
+    token_cache.invalidate_user(user_id)
 
     logger.info(f"Admin: user {user.username} unblocked")
     from urllib.parse import quote
@@ -640,6 +646,7 @@ async def admin_settings_update(
 
     form = await request.form()
     allowed_keys = set(settings_cache.DEFAULTS.keys())
+    popular_period = settings_cache.get_int("popular_period_days")
 
     # Чекбоксы не отправляются если сняты — явно сохраняем "0"
     for key in settings_cache.CHECKBOX_KEYS:
@@ -654,6 +661,12 @@ async def admin_settings_update(
             continue
         await settings_cache.set_setting(key, value, db)
 
+    # Рейтинг «Популярно в NP» с новым периодом — не дожидаясь планового пересчёта
+    if settings_cache.get_int("popular_period_days") != popular_period:
+        import asyncio
+        from app.tasks import run_popular_refresh
+        asyncio.create_task(run_popular_refresh())
+
     logger.info("Admin: app settings updated")
     from urllib.parse import quote
     return RedirectResponse(
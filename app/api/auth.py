@@ -22,7 +22,7 @@ from app.utils import (
 )
 from app.api.dependencies import get_current_user
 from app.config import get_settings
-from app import rate_limit, settings_cache
+from app import rate_limit, settings_cache, session_cache, token_cache
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -99,6 +99,7 @@ async def _delete_all_sessions(db: AsyncSession, user_id: int):
     """Удаляет все сессии пользователя."""
     await db.execute(delete(Session).where(Session.user_id == user_id))
     await db.commit()
+    session_cache.invalidate_user(user_id)
 
 
 def _set_session_cookie(response, session_key: str):
@@ -214,6 +215,7 @@ async def logout(request: Request, db: AsyncSession = Depends(get_db)):
     if key:
         await db.execute(delete(Session).where(Session.key == key))
         await db.commit()
+        session_cache.invalidate_key(key)
     response = RedirectResponse(url="/login", status_code=status.HTTP_302_FOUND)
     response.delete_cookie(key=COOKIE_NAME)
     return response
@@ -379,6 +381,7 @@ async def delete_account(
 
     await db.delete(current_user)
     await db.commit()
+    token_cache.invalidate_user(current_user.id)
 
     response = RedirectResponse(url="/login", status_code=302)
     response.delete_cookie(key=COOKIE_NAME)
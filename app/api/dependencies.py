@@ -7,9 +7,9 @@ from sqlalchemy import select
 
 from app.db.database import get_db
 from app.db.models import User, Device, Session
-from app import settings_cache
+from app import settings_cache, session_cache, token_cache
 
-def _is_fully_blocked(user: User, now: datetime) -> bool:
+def _is_fully_blocked(user: "User | token_cache.DeviceAuth", now: datetime) -> bool:
     """Полная блокировка: blocked_at задан и premium уже истёк (или его нет)."""
     if not user.blocked_at:
         return False
@@ -58,6 +58,7 @@ async def get_current_user(
     """
     Авторизация в веб-интерфейсе через cookie (session_key → Session.key).
     Скользящее окно: продлеваем сессию при активности (если < 15 дней до истечения).
+    Сессия и пользователь — из session_cache, при промахе один запрос.
     Возвращает None если не авторизован или сессия истекла.
     """
     key = request.cookies.get("session_key")
@@ -65,25 +66,56 @@ async def get_current_user(
         return None
 
     now = datetime.now(timezone.utc)
-    result = await db.execute(
-        select(Session).where(Session.key == key, Session.expires_at > now)
-    )
-    session = result.scalar_one_or_none()
-    if not session:
+    entry = session_cache.get(key)
+    if entry is session_cache.MISS:
+        gen = session_cache.generation()
+        row = (await db.execute(
+            select(Session.expires_at, User)
+            .join(User, User.id == Session.user_id)
+            .where(Session.key == key, Session.expires_at > now)
+        )).first()
+        if not row:
+            session_cache.put(key, None, None, gen)
+            return None
+        expires_at, user = row
+        session_cache.put(key, user, expires_at, gen)
+    elif entry is None or entry.expires_at <= now:
         return None
+    else:
+        expires_at = entry.expires_at
+        user = await session_cache.attach(db, entry)
 
     # Скользящее окно: продлеваем сессию если осталось меньше N дней до истечения
     ttl_days    = settings_cache.get_int("session_ttl_days")
     renew_days  = settings_cache.get_int("session_renew_days")
-    if session.expires_at - now < timedelta(days=renew_days):
-        session.expires_at = now + timedelta(days=ttl_days)
-        await db.commit()
+    if expires_at - now < timedelta(days=renew_days):
+        session_cache.renew(key, now + timedelta(days=ttl_days))
         response.set_cookie(
             key="session_key", value=key,
             httponly=True, max_age=ttl_days * 86400, samesite="lax",
         )
 
-    return await db.get(User, session.user_id)
+    return user
+
+
+async def device_auth(token: str, db: AsyncSession) -> token_cache.DeviceAuth | None:
+    """
+    token → устройство и состояние пользователя — из кэша, при промахе один запрос.
+    None — token не существует или пользователь полностью заблокирован.
+    """
+    auth = token_cache.get(token)
+    if auth is token_cache.MISS:
+        gen = token_cache.generation()
+        row = (await db.execute(
+            select(Device, User)
+            .outerjoin(User, User.id == Device.user_id)
+            .where(Device.token == token)
+        )).first()
+        auth = token_cache.DeviceAuth.from_rows(*row) if row else None
+        token_cache.put(token, auth, gen)
+    if auth is None or _is_fully_blocked(auth, datetime.now(timezone.utc)):
+        return None
+    return auth
 
 
 async def get_device_by_token(
@@ -97,15 +129,10 @@ async def get_device_by_token(
     if not token:
         return None
 
-    result = await db.execute(select(Device).where(Device.token == token))
-    device = result.scalar_one_or_none()
-    if not device:
-        return None
-
-    user = await db.get(User, device.user_id)
-    if user and _is_fully_blocked(user, datetime.now(timezone.utc)):
+    auth = await device_auth(token, db)
+    if auth is None:
         return None
 
-    if _should_update_active(device.user_id):
-        asyncio.create_task(_update_last_active(device.user_id))
-    return device
+    if _should_update_active(auth.user_id):
+        asyncio.create_task(_update_last_active(auth.user_id))
+    return auth.device(token)
@@ -17,8 +17,9 @@ from sqlalchemy.dialects.postgresql import insert as pg_insert
 from app.config import get_settings
 from app.db.database import get_db
 from app.db.models import Device, DeviceCode, Timecode, MediaCard, LampaProfile, User, TelegramUser, Episode
-from app import rate_limit, settings_cache
-from app.api.timecodes import _trim_to_limit, _update_card_views
+from app import rate_limit, settings_cache, timecode_cache, tmdb_client, card_progress, trending, token_cache
+from app import profile_changes
+from app.api.timecodes import _trim_to_limit, _update_card_views, _progress_columns
 
 
 def _import_ctx(user: User) -> dict:
@@ -49,7 +50,7 @@ def _import_ctx(user: User) -> dict:
     }
 
 _CARD_ID_RE = re.compile(r"^(\d+)_(movie|tv)$")
-from app.utils import generate_profile_api_key, generate_device_code, validate_name, lampa_hash, build_episode_hash_string, backup_codes_count
+from app.utils import generate_profile_api_key, generate_device_code, validate_name, lampa_hash, backup_codes_count
 from app.api.dependencies import get_current_user, get_device_by_token
 
 logger = logging.getLogger(__name__)
@@ -227,9 +228,11 @@ async def regenerate_device_token(
         raise HTTPException(status_code=401)
 
     device = await _get_device_or_404(device_id, current_user, db)
+    old_token = device.token
     new_token = generate_profile_api_key()
     device.token = new_token
     await db.commit()
+    token_cache.invalidate_token(old_token)
 
     logger.info(f"Token regenerated: device_id={device_id}, user={current_user.username}")
 
@@ -252,6 +255,8 @@ async def delete_device(
     device = await _get_device_or_404(device_id, current_user, db)
     await db.delete(device)
     await db.commit()
+    timecode_cache.invalidate(device_id)
+    token_cache.invalidate_token(device.token)
 
     logger.info(f"Device deleted: device_id={device_id}, user={current_user.username}")
     return RedirectResponse(url="/profiles", status_code=302)
@@ -267,8 +272,11 @@ async def clear_device_timecodes(
         raise HTTPException(status_code=401)
 
     device = await _get_device_or_404(device_id, current_user, db)
+    await profile_changes.reset_device(db, device_id)
     await db.execute(delete(Timecode).where(Timecode.device_id == device_id))
+    await card_progress.refresh(db, device_id)
     await db.commit()
+    timecode_cache.invalidate(device_id)
 
     logger.info(f"Timecodes cleared: device_id={device_id}, user={current_user.username}")
     from urllib.parse import quote
@@ -413,162 +421,32 @@ async def api_history(
         raise HTTPException(status_code=401)
     await _get_device_or_404(device_id, current_user, db)
 
-    q = select(Timecode).where(Timecode.device_id == device_id)
-    if profile_id is not None:
-        q = q.where(Timecode.lampa_profile_id == profile_id)
-    result = await db.execute(q.order_by(Timecode.updated_at.desc()))
-    timecodes = result.scalars().all()
-
-    _WATCHED_PCT = 90
-
-    card_agg: dict[str, dict] = {}
-    for tc in timecodes:
-        if not _CARD_ID_RE.match(tc.card_id):
-            continue
-        try:
-            pct = json.loads(tc.data).get("percent", 0)
-        except Exception:
-            pct = 0
-        if tc.card_id not in card_agg:
-            card_agg[tc.card_id] = {"last_watched": tc.updated_at, "items": {}}
-        agg = card_agg[tc.card_id]
-        agg["items"][tc.item] = max(agg["items"].get(tc.item, 0), pct)
+    # profile_id=None — все профили устройства, прогресс карточки сведён по профилям
+    cp = card_progress.grouped(device_id, profile_id)
+    rows = (await db.execute(
+        select(cp, MediaCard)
+        .join(MediaCard, MediaCard.card_id == cp.c.card_id)
+        .order_by(cp.c.last_watched.desc().nulls_last(), cp.c.card_id)
+    )).all()
 
-    if not card_agg:
-        return []
-
-    mc_result = await db.execute(
-        select(MediaCard).where(MediaCard.card_id.in_(list(card_agg.keys())))
-    )
-    media_cards = {mc.card_id: mc for mc in mc_result.scalars().all()}
-
-    # Батч-запрос неспешловых эпизодов из MyShows для TV-сериалов
-    tv_tmdb_ids = [
-        int(_CARD_ID_RE.match(cid).group(1))
-        for cid in card_agg.keys()
-        if cid.endswith("_tv") and _CARD_ID_RE.match(cid)
+    return [
+        {
+            "card_id": row.card_id,
+            "media_type": row.MediaCard.media_type,
+            "title": row.MediaCard.title,
+            "poster_path": row.MediaCard.poster_path,
+            "year": row.MediaCard.year,
+            "release_date": row.MediaCard.release_date,
+            "last_watched": row.last_watched.isoformat() if row.last_watched else None,
+            "max_percent": row.max_percent,
+            "progress": card_progress.progress(row),
+            "watched_episodes": row.watched_episodes,
+            "total_episodes": row.total_episodes,
+            "is_complete": row.is_complete,
+            "is_ongoing": row.is_ongoing,
+        }
+        for row in rows
     ]
-    episodes_by_show: dict[int, list[tuple[int, int]]] = {}
-    if tv_tmdb_ids:
-        ep_rows = await db.execute(
-            select(Episode.tmdb_show_id, Episode.season, Episode.episode)
-            .where(Episode.tmdb_show_id.in_(tv_tmdb_ids), Episode.is_special == False, Episode.season > 0,  # noqa: E712
-                   (Episode.air_date == None) | (Episode.air_date <= _date.today()))  # noqa: E711
-            .order_by(Episode.tmdb_show_id, Episode.season, Episode.episode)
-        )
-        for tid, s, e in ep_rows.all():
-            episodes_by_show.setdefault(tid, []).append((s, e))
-
-    today_str = _date.today().isoformat()
-    history = []
-    for card_id, agg in card_agg.items():
-        mc = media_cards.get(card_id)
-        if not mc:
-            continue
-
-        items = agg["items"]
-        max_pct = max(items.values(), default=0)
-
-        watched_episodes = total_episodes = None
-        is_ongoing = False
-        progress = max_pct
-
-        if card_id.endswith("_tv"):
-            try:
-                last_ep_s = mc.last_ep_season or 0
-                last_ep_e = mc.last_ep_number or 0
-
-                if mc.next_ep_air_date is not None:
-                    is_ongoing = bool(mc.next_ep_air_date) or bool(
-                        mc.last_air_date and mc.last_air_date > today_str
-                    )
-
-                # Приоритет: таблица episodes (MyShows, без спешлов)
-                show_eps = episodes_by_show.get(mc.tmdb_id)
-                if show_eps:
-                    # MyShows хранит только вышедшие серии — фильтр по TMDB last_ep не нужен
-                    aired = show_eps
-
-                    orig = mc.original_title or ""
-                    valid_hashes = {
-                        lampa_hash(build_episode_hash_string(s, e, orig))
-                        for s, e in aired
-                    }
-                    total_aired = len(aired)
-                    watched_episodes = sum(
-                        1 for h, p in items.items() if h in valid_hashes and p >= _WATCHED_PCT
-                    )
-                    total_episodes = total_aired
-                    if mc.next_ep_air_date is None and mc.seasons_json:
-                        try:
-                            seasons = json.loads(mc.seasons_json)
-                            total_all = sum(
-                                s.get("episode_count", 0) for s in seasons
-                                if (s.get("season_number") or 0) > 0
-                            )
-                            is_ongoing = (total_all > total_aired) or bool(
-                                mc.last_air_date and mc.last_air_date > today_str
-                            )
-                        except Exception:
-                            pass
-
-                elif mc.seasons_json:
-                    # Fallback: TMDB seasons_json
-                    seasons = json.loads(mc.seasons_json)
-                    total_aired = 0
-                    total_all = 0
-                    for s in seasons:
-                        snum = s.get("season_number") or 0
-                        if snum == 0:
-                            continue
-                        ep_count = s.get("episode_count") or 0
-                        total_all += ep_count
-                        if last_ep_s > 0:
-                            if snum < last_ep_s:
-                                total_aired += ep_count
-                            elif snum == last_ep_s:
-                                total_aired += last_ep_e
-                        else:
-                            s_air = s.get("air_date") or ""
-                            if s_air and s_air <= today_str:
-                                total_aired += ep_count
-                    watched_episodes = sum(1 for p in items.values() if p >= _WATCHED_PCT)
-                    total_episodes = total_aired
-                    if mc.next_ep_air_date is None:
-                        is_ongoing = (total_all > total_aired) or bool(
-                            mc.last_air_date and mc.last_air_date > today_str
-                        )
-
-                if total_episodes is not None and total_episodes > 0:
-                    progress = min(round((watched_episodes or 0) / total_episodes * 100), 100)
-            except Exception:
-                pass
-
-        is_complete = (
-            (watched_episodes is not None and total_episodes is not None
-             and watched_episodes >= total_episodes > 0)
-            if card_id.endswith("_tv")
-            else progress >= _WATCHED_PCT
-        )
-
-        history.append({
-            "card_id": card_id,
-            "media_type": mc.media_type,
-            "title": mc.title,
-            "poster_path": mc.poster_path,
-            "year": mc.year,
-            "release_date": mc.release_date,
-            "last_watched": agg["last_watched"].isoformat() if agg["last_watched"] else None,
-            "max_percent": max_pct,
-            "progress": progress,
-            "watched_episodes": watched_episodes,
-            "total_episodes": total_episodes,
-            "is_complete": is_complete,
-            "is_ongoing": is_ongoing,
-        })
-
-    history.sort(key=lambda x: x["last_watched"] or "", reverse=True)
-    return history
 
 
 @router.get("/api/profile-ids")
@@ -754,7 +632,10 @@ async def api_clear_lampa_profile(
             Timecode.lampa_profile_id == profile_id,
         )
     )
+    await card_progress.refresh(db, device_id, profile_id)
+    await profile_changes.reset(db, device_id, profile_id)
     await db.commit()
+    timecode_cache.invalidate(device_id, profile_id)
     return {"ok": True, "deleted": result.rowcount}
 
 
@@ -784,8 +665,11 @@ async def api_delete_lampa_profile(
         Timecode.device_id == device_id,
         Timecode.lampa_profile_id == profile_id,
     ))
+    await card_progress.refresh(db, device_id, profile_id)
+    await profile_changes.reset(db, device_id, profile_id)
     await db.delete(lp)
     await db.commit()
+    timecode_cache.invalidate(device_id, profile_id)
     return {"ok": True}
 
 
@@ -909,28 +793,20 @@ async def api_media_card(
     title_key = "name" if media_type == "tv" else "title"
     orig_key = "original_name" if media_type == "tv" else "original_title"
     date_key = "first_air_date" if media_type == "tv" else "release_date"
-    headers = {"Authorization": settings.TMDB_TOKEN, "Accept": "application/json"}
 
     try:
-        async with httpx.AsyncClient(timeout=20) as client:
-            resp = await client.get(
-                f"https://api.themoviedb.org/3/{media_type}/{tmdb_id}",
-                headers=headers,
-                params={"language": "ru-RU"},
-            )
+        data = await tmdb_client.details(media_type, tmdb_id)
     except Exception as e:
         logger.warning(f"TMDB request failed for {card_id}: {e}")
         if mc:
             return _mc_to_dict(mc)
         raise HTTPException(status_code=502, detail="Ошибка TMDB")
 
-    if resp.status_code != 200:
+    if data is None:
         if mc:
             return _mc_to_dict(mc)
         raise HTTPException(status_code=404, detail="Не найдено в TMDB")
 
-    data = resp.json()
-
     date_val = data.get(date_key) or ""
     values: dict = {
         "card_id": card_id,
@@ -1009,21 +885,13 @@ async def api_media_card_credits(
     if not settings.TMDB_TOKEN:
         return {"cast": []}
 
-    headers = {"Authorization": settings.TMDB_TOKEN, "Accept": "application/json"}
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.get(
-                f"https://api.themoviedb.org/3/{media_type}/{tmdb_id}/credits",
-                headers=headers,
-                params={"language": "ru-RU"},
-            )
+        data = await tmdb_client.get_json(f"/{media_type}/{tmdb_id}/credits", {"language": "ru-RU"})
     except Exception:
         return {"cast": []}
 
-    if resp.status_code != 200:
+    if data is None:
         return {"cast": []}
-
-    data = resp.json()
     cast = [
         {
             "id": p.get("id"),
@@ -1058,9 +926,6 @@ async def api_media_card_recommendations(
     if not settings.TMDB_TOKEN:
         return {"items": []}
 
-    headers = {"Authorization": settings.TMDB_TOKEN, "Accept": "application/json"}
-    base = "https://api.themoviedb.org/3"
-
     def _parse_items(results: list, mtype: str) -> list:
         out = []
         for r in results:
@@ -1078,43 +943,34 @@ async def api_media_card_recommendations(
         return out
 
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            # Параллельно: детали карточки + рекомендации TMDB
-            detail_resp, rec_resp = await asyncio.gather(
-                client.get(f"{base}/{media_type}/{tmdb_id}", headers=headers, params={"language": "ru-RU"}),
-                client.get(f"{base}/{media_type}/{tmdb_id}/recommendations", headers=headers, params={"language": "ru-RU", "page": 1}),
-            )
+        # Параллельно: детали карточки + рекомендации TMDB
+        detail, rec = await asyncio.gather(
+            tmdb_client.details(media_type, tmdb_id),
+            tmdb_client.get_json(f"/{media_type}/{tmdb_id}/recommendations", {"language": "ru-RU", "page": 1}),
+        )
 
-            orig_lang = ""
-            genre_ids = []
-            if detail_resp.status_code == 200:
-                detail = detail_resp.json()
-                orig_lang = detail.get("original_language") or ""
-                genre_ids = [g["id"] for g in (detail.get("genres") or [])]
-
-            rec_results = []
-            if rec_resp.status_code == 200:
-                rec_results = rec_resp.json().get("results") or []
-
-            # Если русский контент — дополнительно запрашиваем Discover с теми же жанрами
-            ru_results = []
-            if orig_lang == "ru":
-                discover_params = {
-                    "language": "ru-RU",
-                    "with_original_language": "ru",
-                    "sort_by": "popularity.desc",
-                    "page": 1,
-                    "vote_count.gte": 50,
-                }
-                if genre_ids:
-                    discover_params["with_genres"] = ",".join(str(g) for g in genre_ids[:2])
-                disc_resp = await client.get(
-                    f"{base}/discover/{media_type}",
-                    headers=headers,
-                    params=discover_params,
-                )
-                if disc_resp.status_code == 200:
-                    ru_results = disc_resp.json().get("results") or []
+        orig_lang = ""
+        genre_ids = []
+        if detail:
+            orig_lang = detail.get("original_language") or ""
+            genre_ids = [g["id"] for g in (detail.get("genres") or [])]
+
+        rec_results = (rec or {}).get("results") or []
+
+        # Если русский контент — дополнительно запрашиваем Discover с теми же жанрами
+        ru_results = []
+        if orig_lang == "ru":
+            discover_params = {
+                "language": "ru-RU",
+                "with_original_language": "ru",
+                "sort_by": "popularity.desc",
+                "page": 1,
+                "vote_count.gte": 50,
+            }
+            if genre_ids:
+                discover_params["with_genres"] = ",".join(str(g) for g in genre_ids[:2])
+            disc = await tmdb_client.get_json(f"/discover/{media_type}", discover_params)
+            ru_results = (disc or {}).get("results") or []
 
     except Exception:
         return {"items": []}
@@ -1158,23 +1014,20 @@ async def api_actor(
     if not settings.TMDB_TOKEN:
         raise HTTPException(status_code=503)
 
-    headers = {"Authorization": settings.TMDB_TOKEN, "Accept": "application/json"}
     params  = {"language": "ru-RU"}
 
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            person_resp, credits_resp = await asyncio.gather(
-                client.get(f"https://api.themoviedb.org/3/person/{person_id}", headers=headers, params=params),
-                client.get(f"https://api.themoviedb.org/3/person/{person_id}/combined_credits", headers=headers, params=params),
-            )
+        person, credits = await asyncio.gather(
+            tmdb_client.get_json(f"/person/{person_id}", params),
+            tmdb_client.get_json(f"/person/{person_id}/combined_credits", params),
+        )
     except Exception:
         raise HTTPException(status_code=502)
 
-    if person_resp.status_code != 200:
+    if person is None:
         raise HTTPException(status_code=404)
 
-    person  = person_resp.json()
-    credits = credits_resp.json() if credits_resp.status_code == 200 else {}
+    credits = credits or {}
 
     cast = credits.get("cast") or []
     # Сортируем по популярности, убираем дубликаты по id
@@ -1236,12 +1089,16 @@ async def api_mark_watched(
         card_id=body.card_id,
         item=body.item,
         data=data,
+        **_progress_columns(data),
     ).on_conflict_do_update(
         constraint="uq_timecode_unique",
-        set_={"data": data, "updated_at": func.now()},
+        set_={"data": data, **_progress_columns(data), "updated_at": func.now()},
     )
     await db.execute(stmt)
+    await card_progress.refresh(db, body.device_id, body.profile_id, [body.card_id])
+    await profile_changes.record_timecodes(db, body.device_id, body.profile_id, [(body.card_id, body.item)])
     await db.commit()
+    timecode_cache.patch(body.device_id, body.profile_id, [(body.card_id, body.item, data)])
     return {"ok": True}
 
 
@@ -1398,6 +1255,7 @@ async def api_set_timecode(
         card_id=body.card_id,
         item=body.item,
         data=new_data,
+        **_progress_columns(new_data),
         counted_at=today if counted else None,
         view_count=1 if counted else 0,
     )
@@ -1405,13 +1263,19 @@ async def api_set_timecode(
         constraint="uq_timecode_unique",
         set_={
             "data": new_data,
+            **_progress_columns(new_data),
             "updated_at": func.now(),
             "counted_at": func.coalesce(stmt.excluded.counted_at, Timecode.counted_at),
             "view_count": Timecode.view_count + stmt.excluded.view_count,
         },
     )
     await db.execute(stmt)
+    await card_progress.refresh(db, body.device_id, body.profile_id, [body.card_id])
+    await profile_changes.record_timecodes(db, body.device_id, body.profile_id, [(body.card_id, body.item)])
     await db.commit()
+    timecode_cache.patch(body.device_id, body.profile_id, [(body.card_id, body.item, new_data)])
+    if counted:
+        trending.record([body.card_id])
     await _trim_to_limit(db, body.device_id, body.profile_id, current_user.role)
     return {"ok": True, "percent": pct, "time": time_sec}
 
@@ -1437,8 +1301,14 @@ async def api_delete_episode_timecode(
     ]
     if profile_id is not None:
         where.append(Timecode.lampa_profile_id == profile_id)
-    await db.execute(delete(Timecode).where(*where))
+    deleted = (await db.execute(
+        delete(Timecode).where(*where)
+        .returning(Timecode.lampa_profile_id, Timecode.card_id, Timecode.item)
+    )).all()
+    await card_progress.refresh(db, device_id, profile_id, [card_id])
+    await profile_changes.record_deleted_timecodes(db, device_id, deleted)
     await db.commit()
+    timecode_cache.invalidate(device_id, profile_id)
     return {"ok": True}
 
 
@@ -1458,8 +1328,14 @@ async def api_delete_card_timecodes(
     where = [Timecode.device_id == device_id, Timecode.card_id == card_id]
     if profile_id is not None:
         where.append(Timecode.lampa_profile_id == profile_id)
-    await db.execute(delete(Timecode).where(*where))
+    deleted = (await db.execute(
+        delete(Timecode).where(*where)
+        .returning(Timecode.lampa_profile_id, Timecode.card_id, Timecode.item)
+    )).all()
+    await card_progress.refresh(db, device_id, profile_id, [card_id])
+    await profile_changes.record_deleted_timecodes(db, device_id, deleted)
     await db.commit()
+    timecode_cache.invalidate(device_id, profile_id)
     return {"ok": True}
 
 
@@ -1481,12 +1357,16 @@ async def api_unmark_special(
         card_id=body.card_id,
         item=body.item,
         data=data,
+        **_progress_columns(data),
     ).on_conflict_do_update(
         constraint="uq_timecode_unique",
-        set_={"data": data, "updated_at": func.now()},
+        set_={"data": data, **_progress_columns(data), "updated_at": func.now()},
     )
     await db.execute(stmt)
+    await card_progress.refresh(db, body.device_id, body.profile_id, [body.card_id])
+    await profile_changes.record_timecodes(db, body.device_id, body.profile_id, [(body.card_id, body.item)])
     await db.commit()
+    timecode_cache.patch(body.device_id, body.profile_id, [(body.card_id, body.item, data)])
     return {"ok": True}
 
 
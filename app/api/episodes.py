@@ -20,6 +20,7 @@ from app.db.database import get_db
 from app.db.models import Device, Episode, MediaCard, Timecode, User
 from app.api.dependencies import get_current_user, get_device_by_token
 from app.utils import lampa_hash, build_episode_hash_string
+from app import episode_registry, tmdb_client, card_progress
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -355,6 +356,10 @@ async def sync_episodes(mc: MediaCard, db: AsyncSession, client: httpx.AsyncClie
         mc.next_ep_air_date = min(future_dates).isoformat()
 
     await db.commit()
+    episode_registry.put(mc.tmdb_id, orig, rows)
+    # Серии изменились — пересчёт прогресса у всех профилей с этим сериалом
+    await card_progress.refresh(db, card_ids=[mc.card_id])
+    await db.commit()
 
     logger.info(f"sync_episodes: {mc.card_id} → {len(rows)} episodes synced")
     return True
@@ -391,7 +396,6 @@ _CARD_ID_RE = re.compile(r"^(\d+)_(movie|tv)$")
 async def _bg_refresh_card(card_id: str) -> None:
     """Фоновое обновление эпизодов одной карточки (вызывается при открытии, раз в сутки)."""
     from app.db.database import async_session_maker
-    from app.config import get_settings as _get_settings
     try:
         async with async_session_maker() as db:
             mc = (await db.execute(select(MediaCard).where(MediaCard.card_id == card_id))).scalar_one_or_none()
@@ -406,20 +410,12 @@ async def _bg_refresh_card(card_id: str) -> None:
                 if not m:
                     return
                 tmdb_id = int(m.group(1))
-                cfg = _get_settings()
-                async with httpx.AsyncClient() as client:
-                    r = await client.get(
-                        f"https://api.themoviedb.org/3/tv/{tmdb_id}",
-                        headers={"Authorization": cfg.TMDB_TOKEN},
-                        params={"language": "ru-RU"},
-                        timeout=15,
-                    )
-                    if r.status_code != 200:
-                        logger.debug(f"_bg_refresh_card {card_id}: TMDB {r.status_code}")
-                        return
-                    data = r.json()
-                    from app.main import upsert_tmdb_cache
-                    await upsert_tmdb_cache("tv", tmdb_id, data)
+                r = await tmdb_client.get(f"/tv/{tmdb_id}", {"language": "ru-RU"})
+                if r.status_code != 200:
+                    logger.debug(f"_bg_refresh_card {card_id}: TMDB {r.status_code}")
+                    return
+                from app.main import upsert_tmdb_cache
+                await upsert_tmdb_cache("tv", tmdb_id, r.data)
                 # Перечитываем после upsert
                 mc = (await db.execute(select(MediaCard).where(MediaCard.card_id == card_id))).scalar_one_or_none()
                 if not mc:
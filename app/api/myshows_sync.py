@@ -13,8 +13,9 @@ from app.db.models import User, Device, Timecode, MediaCard, LampaProfile, Episo
 from app.utils import lampa_hash, build_episode_hash_string
 from app.config import get_settings
 from app.api.dependencies import get_current_user
-from app import rate_limit
-from app.api.timecodes import _trim_to_limit, _merge_favorite_history, _media_card_to_entry, _cleanup_orphan_timecodes
+from app import rate_limit, timecode_cache, episode_registry, tmdb_client, card_progress, profile_changes
+from app.api.timecodes import _trim_to_limit, _merge_favorite_history, _media_card_to_entry, _cleanup_orphan_timecodes, _progress_columns, TIMECODE_KEY
+from app.db.bulk import bulk_upsert
 from app.api.episodes import _should_sync, _parse_air_date
 
 logger = logging.getLogger(__name__)
@@ -41,7 +42,6 @@ async def _myshows_rpc(client: httpx.AsyncClient, token: str, method: str, param
 
 
 async def _find_tmdb_data(
-    client: httpx.AsyncClient,
     title: str,
     original_title: str,
     year: int,
@@ -54,7 +54,6 @@ async def _find_tmdb_data(
     if cache is not None and cache_key in cache:
         return cache[cache_key]
 
-    headers = {"Authorization": settings.TMDB_TOKEN, "Accept": "application/json"}
     title_key = "name" if is_tv else "title"
     orig_key = "original_name" if is_tv else "original_title"
     date_key = "first_air_date" if is_tv else "release_date"
@@ -73,13 +72,12 @@ async def _find_tmdb_data(
     if imdb_id:
         try:
             imdb_clean = str(imdb_id).replace("tt", "")
-            resp = await client.get(
-                f"https://api.themoviedb.org/3/find/tt{imdb_clean}",
-                params={"external_source": "imdb_id", "language": "ru-RU"},
-                headers=headers, timeout=10,
+            resp = await tmdb_client.get(
+                f"/find/tt{imdb_clean}",
+                {"external_source": "imdb_id", "language": "ru-RU"},
             )
             if resp.status_code == 200:
-                results = resp.json().get("tv_results" if is_tv else "movie_results", [])
+                results = resp.data.get("tv_results" if is_tv else "movie_results", [])
                 if results:
                     data = _extract(results[0])
                     # Проверяем, что найденный сериал хоть как-то совпадает с ожидаемым
@@ -104,18 +102,18 @@ async def _find_tmdb_data(
             logger.warning(f"IMDB lookup error for '{title}': {e}")
 
     # 2. By title
-    endpoint = f"https://api.themoviedb.org/3/search/{'tv' if is_tv else 'movie'}"
+    endpoint = f"/search/{'tv' if is_tv else 'movie'}"
     for query in list(dict.fromkeys(q for q in [original_title, title] if q)):
         for search_year in [year, None]:
             try:
                 params = {"query": query, "language": "ru-RU"}
                 if search_year:
                     params["first_air_date_year" if is_tv else "year"] = search_year
-                resp = await client.get(endpoint, params=params, headers=headers, timeout=10)
+                resp = await tmdb_client.get(endpoint, params)
                 if resp.status_code != 200:
                     logger.warning(f"TMDB search {resp.status_code} for '{query}' year={search_year}")
                     continue
-                results = resp.json().get("results", [])
+                results = resp.data.get("results", [])
                 if results:
                     exact = [r for r in results if r.get(orig_key, "").lower() == query.lower()]
                     if exact:
@@ -208,7 +206,7 @@ async def _sync_generator(device: Device, ms_login: str, ms_password: str, db: A
             for idx, movie in enumerate(movies):
                 title = movie.get("title", "")
                 tmdb_data = await _find_tmdb_data(
-                    client, title=title,
+                    title=title,
                     original_title=movie.get("titleOriginal", ""),
                     year=movie.get("year"),
                     imdb_id=movie.get("imdbId"),
@@ -281,7 +279,6 @@ async def _sync_generator(device: Device, ms_login: str, ms_password: str, db: A
 
                     show_title_myshows = show_details.get("titleOriginal") or show_details.get("title", "")
                     show_tmdb_data = await _find_tmdb_data(
-                        client,
                         title=show_details.get("title", ""),
                         original_title=show_details.get("titleOriginal", ""),
                         year=show_details.get("year"),
@@ -435,22 +432,14 @@ async def _sync_generator(device: Device, ms_login: str, ms_password: str, db: A
 
                 values = [
                     {"device_id": device.id, "lampa_profile_id": profile_id, "card_id": tc["card_id"],
-                     "item": tc["item"], "data": tc["data"], "updated_at": tc["updated_at"]}
+                     "item": tc["item"], "data": tc["data"], **_progress_columns(tc["data"]),
+                     "updated_at": tc["updated_at"]}
                     for tc in cleaned
                 ]
-                # asyncpg limit: 32767 params; 6 columns → max 5000 rows per batch
-                chunk_size = 5000
-                for i in range(0, len(values), chunk_size):
-                    chunk = values[i:i + chunk_size]
-                    stmt = pg_insert(Timecode).values(chunk)
-                    stmt = stmt.on_conflict_do_update(
-                        index_elements=[
-                            Timecode.device_id, Timecode.lampa_profile_id,
-                            Timecode.card_id, Timecode.item,
-                        ],
-                        set_={"updated_at": stmt.excluded.updated_at},
-                    )
-                    await db.execute(stmt)
+                await bulk_upsert(
+                    db, Timecode, values, TIMECODE_KEY,
+                    lambda excluded: {"updated_at": excluded.updated_at},
+                )
 
             # ── Save MediaCards ──────────────────────────────────────────────
             if all_media_cards:
@@ -541,6 +530,21 @@ async def _sync_generator(device: Device, ms_login: str, ms_password: str, db: A
                 await _cleanup_orphan_timecodes(db, device.id, profile_id, tv_card_ids)
                 await db.commit()
 
+            if all_timecodes or all_episode_rows:
+                timecode_cache.invalidate(device.id, profile_id)
+            if all_episode_rows:
+                episode_registry.invalidate(all_episode_rows.keys())
+
+            # ── Прогресс карточек: свои таймкоды + новые серии у всех профилей ──
+            if all_timecodes:
+                await card_progress.refresh(db, device.id, profile_id, (tc["card_id"] for tc in all_timecodes))
+                # Массовый импорт — клиенты профиля перечитывают его целиком
+                await profile_changes.reset(db, device.id, profile_id)
+            if all_episode_rows:
+                await card_progress.refresh(db, card_ids=[f"{tid}_tv" for tid in all_episode_rows])
+            if all_timecodes or all_episode_rows:
+                await db.commit()
+
             trimmed = 0
             if all_timecodes:
                 trimmed = await _trim_to_limit(db, device.id, profile_id, user_role)
@@ -10,8 +10,6 @@ WS-сообщения включают lampa_profile_id, клиент приме
 """
 import json
 import logging
-from collections import defaultdict
-from typing import Dict, Set
 
 from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
@@ -22,13 +20,15 @@ from app.db.database import get_db, async_session_maker
 from app.db.models import PluginSettings
 from app.api.dependencies import get_device_by_token
 from app.db.models import Device
+from app import profile_changes
+from app.ws_manager import ConnectionManager
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-# user_id -> set of active WebSocket connections
-_connections: Dict[int, Set[WebSocket]] = defaultdict(set)
+# Соединения /api/plugin-settings/ws этого воркера; рассылка — через ws_broadcast
+manager = ConnectionManager("plugin_settings")
 
 
 async def _get_or_create(
@@ -54,18 +54,15 @@ async def _get_or_create(
     return row
 
 
-async def _broadcast(user_id: int, plugin: str, lampa_profile_id: str, key: str, value) -> None:
+async def _broadcast(user_id: int, plugin: str, lampa_profile_id: str, key: str, value, seq: int) -> None:
     """Отправить обновление всем подключённым устройствам пользователя.
     Клиент применяет только если lampa_profile_id совпадает с текущим профилем.
+    seq — номер в журнале изменений профиля (app/profile_changes.py).
     """
-    msg = json.dumps({"plugin": plugin, "lampa_profile_id": lampa_profile_id, "key": key, "value": value})
-    dead = set()
-    for ws in list(_connections.get(user_id, set())):
-        try:
-            await ws.send_text(msg)
-        except Exception:
-            dead.add(ws)
-    _connections[user_id] -= dead
+    await manager.broadcast(
+        user_id, None,
+        {"plugin": plugin, "lampa_profile_id": lampa_profile_id, "key": key, "value": value, "seq": seq},
+    )
 
 
 # ---------------------------------------------------------------------------
@@ -124,9 +121,12 @@ async def patch_plugin_settings(
 
     data[body.key] = body.value
     row.settings = json.dumps(data, ensure_ascii=False)
+    seq = await profile_changes.record_plugin_setting(
+        db, device.user_id, lampa_profile_id, plugin, body.key
+    )
     await db.commit()
 
-    await _broadcast(device.user_id, plugin, lampa_profile_id, body.key, body.value)
+    await _broadcast(device.user_id, plugin, lampa_profile_id, body.key, body.value, seq)
 
     return {"ok": True}
 
@@ -155,15 +155,11 @@ async def plugin_settings_ws(
 
         user_id = device.user_id
 
-    await websocket.accept()
-    _connections[user_id].add(websocket)
-    logger.debug("WS plugin-settings: user %s connected (%s total)", user_id, len(_connections[user_id]))
-
+    conn_id = await manager.connect(user_id, websocket)
     try:
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
         pass
     finally:
-        _connections[user_id].discard(websocket)
-        logger.debug("WS plugin-settings: user %s disconnected", user_id)
+        manager.disconnect(user_id, conn_id)
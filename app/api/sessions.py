@@ -9,6 +9,7 @@ from sqlalchemy import select, delete
 from app.db.database import get_db
 from app.db.models import User, Session
 from app.api.dependencies import get_current_user
+from app import session_cache
 from app.utils import parse_user_agent
 
 router = APIRouter()
@@ -73,6 +74,7 @@ async def revoke_session(
         is_current = session.key == request.cookies.get(COOKIE_NAME)
         await db.delete(session)
         await db.commit()
+        session_cache.invalidate_key(session.key)
         if is_current:
             response = RedirectResponse("/login", status_code=302)
             response.delete_cookie(COOKIE_NAME)
@@ -92,6 +94,7 @@ async def revoke_all_sessions(
 
     await db.execute(delete(Session).where(Session.user_id == current_user.id))
     await db.commit()
+    session_cache.invalidate_user(current_user.id)
 
     response = RedirectResponse("/login", status_code=302)
     response.delete_cookie(COOKIE_NAME)
@@ -37,7 +37,7 @@ from app.db.models import (
     User,
     USER_ROLES,
 )
-from app import settings_cache
+from app import settings_cache, timecode_cache, card_progress, token_cache, profile_changes
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/tg-app")
@@ -236,6 +236,7 @@ async def miniapp_delete_device(
         raise HTTPException(status_code=404, detail="Device not found")
     await db.delete(device)
     await db.commit()
+    token_cache.invalidate_token(device.token)
     return {"ok": True}
 
 
@@ -255,8 +256,10 @@ async def miniapp_regenerate_token(
         raise HTTPException(status_code=404, detail="Device not found")
 
     from app.utils import generate_profile_api_key
+    old_token = device.token
     device.token = generate_profile_api_key()
     await db.commit()
+    token_cache.invalidate_token(old_token)
     return {"ok": True, "token": device.token}
 
 
@@ -275,8 +278,11 @@ async def miniapp_clear_timecodes(
     if not result.scalar_one_or_none():
         raise HTTPException(status_code=404, detail="Device not found")
 
+    await profile_changes.reset_device(db, device_id)
     await db.execute(sa_delete(Timecode).where(Timecode.device_id == device_id))
+    await card_progress.refresh(db, device_id)
     await db.commit()
+    timecode_cache.invalidate(device_id)
     return {"ok": True}
 
 
@@ -651,6 +657,7 @@ async def miniapp_set_role(
     old_role = user.role
     user.role = body.role
     await db.commit()
+    token_cache.invalidate_user(user_id)
 
     logger.info(
         f"Mini App admin {admin.get('username', admin.get('id'))}: "
@@ -680,6 +687,7 @@ async def miniapp_block_user(
     user.block_reason = body.reason.strip() or None
     await db.execute(sa_delete(Session).where(Session.user_id == user_id))
     await db.commit()
+    token_cache.invalidate_user(user_id)
 
     logger.info(
         f"Mini App admin {admin.get('username', admin.get('id'))}: "
@@ -702,6 +710,7 @@ async def miniapp_unblock_user(
     user.blocked_at = None
     user.block_reason = None
     await db.commit()
+    token_cache.invalidate_user(user_id)
 
     logger.info(
         f"Mini App admin {admin.get('username', admin.get('id'))}: "
@@ -22,29 +22,32 @@ import logging
 import re
 import secrets
 from datetime import date
-from typing import Any
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Coroutine
 
-import httpx
 from fastapi import (
     APIRouter,
     Depends,
     HTTPException,
     Query,
     Body,
+    Request,
     WebSocket,
     WebSocketDisconnect,
 )
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.dialects.postgresql import insert as pg_insert
-from sqlalchemy import select, delete, func, update, case
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy import String, and_, bindparam, select, delete, func, update, case, tuple_
 
-from app.config import get_settings
 from app.db.database import get_db, async_session_maker
+from app.db.bulk import bulk_upsert
 from app import rate_limit
-from app.db.models import Device, Timecode, MediaCard, LampaProfile, User, Episode
-from app.api.dependencies import get_device_by_token
+from app.db.models import Device, Timecode, MediaCard, LampaProfile, User, Episode, ImportJob
+from app.api.dependencies import device_auth, get_device_by_token
 from app import settings_cache
+from app import timecode_cache, tmdb_client, json_stream, import_jobs, card_progress, popular, trending, token_cache
+from app import timecode_writes, profile_changes
 from app.utils import lampa_hash, build_episode_hash_string
 from app.ws_manager import manager as ws_manager
 
@@ -133,7 +136,10 @@ async def _assert_profile_allowed(
 
 
 async def _get_user_role(device: Device, db: AsyncSession) -> str:
-    """Возвращает роль пользователя устройства."""
+    """Возвращает роль пользователя устройства (из кэша авторизации, если есть)."""
+    role = token_cache.role(device.user_id)
+    if role is not None:
+        return role
     user = await db.get(User, device.user_id)
     return user.role if user else "simple"
 
@@ -184,8 +190,13 @@ async def _trim_to_limit(
     )
 
     if oldest_ids:
-        await db.execute(delete(Timecode).where(Timecode.id.in_(oldest_ids)))
+        trimmed = (await db.execute(
+            delete(Timecode).where(Timecode.id.in_(oldest_ids)).returning(Timecode.card_id, Timecode.item)
+        )).all()
+        await card_progress.refresh(db, device_id, lampa_profile_id, (c for c, _ in trimmed))
+        await profile_changes.record_timecodes(db, device_id, lampa_profile_id, trimmed)
         await db.commit()
+        timecode_cache.invalidate(device_id, lampa_profile_id)
         logger.info(
             f"Trimmed {len(oldest_ids)} timecodes: device={device_id} "
             f"profile={lampa_profile_id!r} role={user_role} limit={limit}"
@@ -292,6 +303,162 @@ async def _merge_favorite_history(
         existing_fav = _trim_favorite(existing_fav, limit)
 
     lp.favorite = json.dumps(existing_fav, ensure_ascii=False)
+    await profile_changes.record_favorite(db, device_id, profile_id)
+
+
+def _season_hashes(seasons_json: str | None, original_title: str) -> set[str]:
+    """Хэши серий сериала, вычисленные из seasons_json (без спецвыпусков)."""
+    hashes: set[str] = set()
+    if not seasons_json:
+        return hashes
+    try:
+        seasons = json.loads(seasons_json)
+        for season in seasons:
+            s_num = season.get("season_number")
+            ep_count = season.get("episode_count", 0)
+            if not s_num or not ep_count:
+                continue
+            for ep_num in range(1, ep_count + 1):
+                hashes.add(lampa_hash(
+                    build_episode_hash_string(s_num, ep_num, original_title)
+                ))
+    except Exception:
+        pass
+    return hashes
+
+
+async def _valid_item_hashes(
+    db: AsyncSession, card_ids: list[str]
+) -> dict[str, set[str]]:
+    """
+    Валидные item для карточек — два запроса на весь набор (media_cards, episodes).
+    Фильмы: lampa_hash(original_title).
+    Сериалы: episodes.hash; фолбэк — вычисляем из seasons_json.
+    Карточки, которые проверить нечем (нет MediaCard, original_title или данных
+    о сериях), в результат не попадают — их таймкоды не трогаем.
+    """
+    if not card_ids:
+        return {}
+    mcs = (await db.execute(
+        select(MediaCard.card_id, MediaCard.tmdb_id, MediaCard.original_title, MediaCard.seasons_json)
+        .where(MediaCard.card_id.in_(card_ids), MediaCard.original_title.isnot(None), MediaCard.original_title != "")
+    )).all()
+
+    valid: dict[str, set[str]] = {}
+    shows = {}
+    for mc in mcs:
+        if mc.card_id.endswith("_movie"):
+            valid[mc.card_id] = {lampa_hash(mc.original_title)}
+        elif mc.card_id.endswith("_tv"):
+            shows[mc.tmdb_id] = mc
+    if not shows:
+        return valid
+
+    ep_hashes: dict[int, set[str]] = {}
+    for show_id, ep_hash in (await db.execute(
+        select(Episode.tmdb_show_id, Episode.hash).where(
+            Episode.tmdb_show_id.in_(list(shows)),
+            Episode.hash.isnot(None),
+        )
+    )).all():
+        ep_hashes.setdefault(show_id, set()).add(ep_hash)
+
+    for tmdb_id, mc in shows.items():
+        hashes = ep_hashes.get(tmdb_id) or _season_hashes(mc.seasons_json, mc.original_title)
+        if hashes:
+            valid[mc.card_id] = hashes
+    return valid
+
+
+async def _delete_orphans(
+    db: AsyncSession,
+    valid: dict[str, set[str]],
+    device_id: int | None = None,
+    profile_id: str | None = None,
+    dry_run: bool = False,
+) -> list[tuple[int, str, str, int]]:
+    """
+    Одним запросом удаляет таймкоды карточек из valid, чей item не входит
+    в их валидные хэши (device_id/profile_id=None — по всем устройствам/профилям).
+    dry_run — только считает. Возвращает [(device_id, profile_id, card_id, удалено)].
+    """
+    if not valid:
+        return []
+    pairs_c = [c for c, hashes in valid.items() for _ in hashes]
+    pairs_i = [h for hashes in valid.values() for h in hashes]
+    pairs = select(
+        func.unnest(bindparam("valid_cards", pairs_c, type_=ARRAY(String))).label("card_id"),
+        func.unnest(bindparam("valid_items", pairs_i, type_=ARRAY(String))).label("item"),
+    ).subquery()
+    where = [
+        Timecode.card_id.in_(list(valid)),
+        ~select(pairs.c.item).where(
+            pairs.c.card_id == Timecode.card_id, pairs.c.item == Timecode.item
+        ).correlate(Timecode).exists(),
+    ]
+    if device_id is not None:
+        where.append(Timecode.device_id == device_id)
+    if profile_id is not None:
+        where.append(Timecode.lampa_profile_id == profile_id)
+
+    key = (Timecode.device_id, Timecode.lampa_profile_id, Timecode.card_id)
+    if dry_run:
+        rows = (await db.execute(
+            select(*key, func.count()).where(*where).group_by(*key)
+        )).all()
+        return [tuple(r) for r in rows]
+
+    deleted: dict[tuple[int, str, str], int] = {}
+    for row in (await db.execute(delete(Timecode).where(*where).returning(*key))).all():
+        k = tuple(row)
+        deleted[k] = deleted.get(k, 0) + 1
+    return [(*k, n) for k, n in deleted.items()]
+
+
+async def _prune_emptied_cards(
+    db: AsyncSession, deleted: list[tuple[int, str, str, int]]
+) -> None:
+    """Убирает из истории профилей карточки, у которых после очистки не осталось таймкодов.
+    Журналы изменений затронутых профилей сбрасываются (массовое удаление)."""
+    touched = {(d, p, c) for d, p, c, _ in deleted}
+    if not touched:
+        return
+    for d, p in {(d, p) for d, p, _ in touched}:
+        await profile_changes.reset(db, d, p)
+    remaining = set((await db.execute(
+        select(Timecode.device_id, Timecode.lampa_profile_id, Timecode.card_id)
+        .distinct()
+        .where(tuple_(Timecode.device_id, Timecode.lampa_profile_id, Timecode.card_id).in_(list(touched)))
+    )).all())
+
+    emptied: dict[tuple[int, str], set[int]] = {}
+    for d, p, c in touched:
+        if (d, p, c) in remaining:
+            continue
+        try:
+            emptied.setdefault((d, p), set()).add(int(c.split("_")[0]))
+        except (ValueError, IndexError):
+            pass
+    if not emptied:
+        return
+
+    lps = (await db.execute(
+        select(LampaProfile).where(
+            tuple_(LampaProfile.device_id, LampaProfile.lampa_profile_id).in_(list(emptied))
+        )
+    )).scalars().all()
+    for lp in lps:
+        if not lp.favorite:
+            continue
+        remove_tmdb_ids = emptied[(lp.device_id, lp.lampa_profile_id)]
+        try:
+            fav = json.loads(lp.favorite)
+            fav["history"] = [i for i in fav.get("history", []) if i not in remove_tmdb_ids]
+            fav["card"]    = [c for c in fav.get("card", [])    if c.get("id") not in remove_tmdb_ids]
+            lp.favorite = json.dumps(fav, ensure_ascii=False)
+            logger.info(f"cleanup_orphans: removed {len(remove_tmdb_ids)} cards from history")
+        except Exception as e:
+            logger.warning(f"cleanup_orphans: failed to update favorite: {e}")
 
 
 async def _cleanup_orphan_timecodes(
@@ -305,102 +472,114 @@ async def _cleanup_orphan_timecodes(
     Фильмы: item должен == lampa_hash(original_title).
     Сериалы: item должен быть в episodes.hash; фолбэк — вычисляем из seasons_json.
     Если после удаления у карточки не осталось таймкодов — убирает её из истории профиля.
+    Фиксированное число запросов на весь набор карточек; commit — за вызывающим.
     """
-    from sqlalchemy import delete as sa_delete
+    valid = await _valid_item_hashes(db, card_ids)
+    deleted = await _delete_orphans(db, valid, device_id, profile_id)
+    for _, _, card_id, n in deleted:
+        logger.info(f"cleanup_orphans: {card_id} — удалено {n} мусорных таймкодов")
+    await _prune_emptied_cards(db, deleted)
+    await card_progress.refresh(db, device_id, profile_id, [c for _, _, c, _ in deleted])
 
-    removed_card_ids = []
 
-    # Batch-запрос MediaCard для всех карточек
-    mc_map: dict[str, MediaCard] = {}
-    if card_ids:
-        mc_rows = await db.execute(select(MediaCard).where(MediaCard.card_id.in_(card_ids)))
-        for mc in mc_rows.scalars().all():
-            mc_map[mc.card_id] = mc
+def _progress_columns(data) -> dict:
+    """
+    percent/time/duration из JSON data — значения типизированных колонок Timecode.
+    Отсутствующие или нечисловые поля → None.
+    """
+    try:
+        d = json.loads(data) if isinstance(data, str) else data
+    except (json.JSONDecodeError, TypeError):
+        d = None
+    if not isinstance(d, dict):
+        d = {}
+    out = {}
+    for key in ("percent", "time", "duration"):
+        try:
+            out[key] = float(d[key]) if d.get(key) is not None else None
+        except (TypeError, ValueError):
+            out[key] = None
+    return out
 
-    for card_id in card_ids:
-        mc = mc_map.get(card_id)
-        if not mc or not mc.original_title:
-            continue
 
-        # Строим множество валидных хэшей для этой карточки
-        if card_id.endswith("_movie"):
-            valid_hashes = {lampa_hash(mc.original_title)}
+def _row_percent(percent: float | None, data: str) -> float:
+    """Процент таймкода: из колонки percent, для строк до бэкфилла — из JSON data."""
+    if percent is not None:
+        return percent
+    return _progress_columns(data)["percent"] or 0.0
 
-        elif card_id.endswith("_tv"):
-            # Источник 1: episodes таблица
-            valid_hashes = set((await db.execute(
-                select(Episode.hash).where(
-                    Episode.tmdb_show_id == mc.tmdb_id,
-                    Episode.hash.isnot(None),
-                )
-            )).scalars().all())
 
-            # Источник 2: вычисляем из seasons_json
-            if not valid_hashes and mc.seasons_json:
-                try:
-                    seasons = json.loads(mc.seasons_json)
-                    for season in seasons:
-                        s_num = season.get("season_number")
-                        ep_count = season.get("episode_count", 0)
-                        if not s_num or not ep_count:
-                            continue
-                        for ep_num in range(1, ep_count + 1):
-                            valid_hashes.add(lampa_hash(
-                                build_episode_hash_string(s_num, ep_num, mc.original_title)
-                            ))
-                except Exception:
-                    pass
-
-            if not valid_hashes:
-                continue  # нет данных — не можем валидировать
-        else:
-            continue
+# Ключ уникальности таймкода (uq_timecode_unique) — для ON CONFLICT
+TIMECODE_KEY = ["device_id", "lampa_profile_id", "card_id", "item"]
 
-        tcs = (await db.execute(
-            select(Timecode).where(
+
+async def _count_views(
+    db: AsyncSession,
+    device_id: int,
+    lampa_profile_id: str,
+    rows: list[tuple[str, str, float]],
+    today: date,
+) -> tuple[set[tuple[str, str]], set[tuple[str, str]]]:
+    """
+    Засчитывает просмотры пачкой: rows = [(card_id, item, percent), ...] (пары уникальны).
+    Возвращает (counted, mark_only):
+      counted   — пары, где просмотр засчитан (view_count += 1, counted_at = today);
+      mark_only — существующие пары фильма, уже засчитанного сегодня другим item:
+                  не засчитываются, но получают counted_at = today.
+    Правила:
+      - Засчитываем только если percent >= 90
+      - Лимит: один раз в сутки на item для данного профиля (Timecode.counted_at)
+      - Для фильмов: один раз в сутки на карточку (любой item)
+    Все пары проверяются по состоянию БД до записи пачки — два запроса на всю пачку.
+    """
+    candidates = [
+        (card_id, item) for card_id, item, percent in rows
+        if percent >= 90 and (card_id.endswith("_movie") or card_id.endswith("_tv"))
+    ]
+    if not candidates:
+        return set(), set()
+
+    # Существующие таймкоды пар-кандидатов: (card_id, item) → засчитан ли сегодня
+    pairs = select(
+        func.unnest(bindparam("cards", [c for c, _ in candidates], type_=ARRAY(String))).label("card_id"),
+        func.unnest(bindparam("items", [i for _, i in candidates], type_=ARRAY(String))).label("item"),
+    ).subquery()
+    existing: dict[tuple[str, str], bool] = {
+        (card_id, item): counted_at == today
+        for card_id, item, counted_at in (await db.execute(
+            select(Timecode.card_id, Timecode.item, Timecode.counted_at)
+            .join(pairs, and_(Timecode.card_id == pairs.c.card_id, Timecode.item == pairs.c.item))
+            .where(
                 Timecode.device_id == device_id,
-                Timecode.lampa_profile_id == profile_id,
-                Timecode.card_id == card_id,
+                Timecode.lampa_profile_id == lampa_profile_id,
             )
-        )).scalars().all()
+        )).all()
+    }
 
-        orphan_ids = [tc.id for tc in tcs if tc.item not in valid_hashes]
-        if not orphan_ids:
+    # Фильмы, уже засчитанные сегодня (любым item)
+    movie_cards = list({c for c, _ in candidates if c.endswith("_movie")})
+    movies_today: set[str] = set()
+    if movie_cards:
+        movies_today = set((await db.execute(
+            select(Timecode.card_id).distinct().where(
+                Timecode.device_id == device_id,
+                Timecode.lampa_profile_id == lampa_profile_id,
+                Timecode.card_id.in_(movie_cards),
+                Timecode.counted_at == today,
+            )
+        )).scalars().all())
+
+    counted: set[tuple[str, str]] = set()
+    mark_only: set[tuple[str, str]] = set()
+    for key in candidates:
+        if existing.get(key):
+            continue  # уже засчитано сегодня
+        if key[0] in movies_today:
+            if key in existing:
+                mark_only.add(key)
             continue
-
-        await db.execute(sa_delete(Timecode).where(Timecode.id.in_(orphan_ids)))
-        title = mc.title or mc.original_title or card_id
-        logger.info(f"cleanup_orphans: «{title}» ({card_id}) — удалено {len(orphan_ids)} мусорных таймкодов из {len(tcs)}")
-
-        if len(orphan_ids) == len(tcs):
-            removed_card_ids.append(card_id)
-
-    if not removed_card_ids:
-        return
-
-    # Убираем карточки без таймкодов из истории профиля
-    lp = (await db.execute(
-        select(LampaProfile).where(
-            LampaProfile.device_id == device_id,
-            LampaProfile.lampa_profile_id == profile_id,
-        )
-    )).scalar_one_or_none()
-
-    if lp and lp.favorite:
-        try:
-            fav = json.loads(lp.favorite)
-            remove_tmdb_ids = set()
-            for cid in removed_card_ids:
-                try:
-                    remove_tmdb_ids.add(int(cid.split("_")[0]))
-                except (ValueError, IndexError):
-                    pass
-            fav["history"] = [i for i in fav.get("history", []) if i not in remove_tmdb_ids]
-            fav["card"]    = [c for c in fav.get("card", [])    if c.get("id") not in remove_tmdb_ids]
-            lp.favorite = json.dumps(fav, ensure_ascii=False)
-            logger.info(f"cleanup_orphans: removed {len(remove_tmdb_ids)} cards from history")
-        except Exception as e:
-            logger.warning(f"cleanup_orphans: failed to update favorite: {e}")
+        counted.add(key)
+    return counted, mark_only
 
 
 async def _update_card_views(
@@ -413,50 +592,24 @@ async def _update_card_views(
     today: date,
 ) -> bool:
     """
-    Засчитывает просмотр — инкрементирует Timecode.view_count.
+    Засчитывает просмотр одного таймкода (правила — в _count_views).
     Возвращает True если просмотр засчитан (counted_at надо проставить на Timecode).
-    Правила:
-      - Засчитываем только если percent >= 90
-      - Лимит: один раз в сутки на item для данного профиля (Timecode.counted_at)
-      - Для фильмов: один раз в сутки на карточку (любой item)
     """
-    if percent < 90:
-        return False
-
-    is_movie = card_id.endswith("_movie")
-    is_tv = card_id.endswith("_tv")
-    if not is_movie and not is_tv:
-        return False  # lampa_import или неизвестный формат
-
-    # Ищем текущий Timecode
-    tc = (await db.execute(
-        select(Timecode).where(
-            Timecode.device_id == device_id,
-            Timecode.lampa_profile_id == lampa_profile_id,
-            Timecode.card_id == card_id,
-            Timecode.item == item,
-        )
-    )).scalar_one_or_none()
-
-    if tc is not None and tc.counted_at == today:
-        return False  # уже засчитано сегодня
-
-    # Для фильмов: один просмотр на карточку в сутки (не на item)
-    if is_movie:
-        already_today = (await db.execute(
-            select(func.count()).where(
+    counted, mark_only = await _count_views(
+        db, device_id, lampa_profile_id, [(card_id, item, percent)], today
+    )
+    if mark_only:
+        await db.execute(
+            update(Timecode)
+            .where(
                 Timecode.device_id == device_id,
                 Timecode.lampa_profile_id == lampa_profile_id,
                 Timecode.card_id == card_id,
-                Timecode.counted_at == today,
+                Timecode.item == item,
             )
-        )).scalar() or 0
-        if already_today > 0:
-            if tc is not None:
-                tc.counted_at = today
-            return False
-
-    return True
+            .values(counted_at=today)
+        )
+    return bool(counted)
 
 
 async def _upsert_timecodes(
@@ -464,8 +617,10 @@ async def _upsert_timecodes(
     device_id: int,
     lampa_profile_id: str,
     rows: list[dict],
+    seqs: dict[tuple[str, str], int] | None = None,
 ):
-    """UPSERT списка таймкодов. rows: [{card_id, item, data}]"""
+    """UPSERT списка таймкодов. rows: [{card_id, item, data}]
+    seqs — если передан, заполняется номерами журнала изменений {(card_id, item): seq}."""
     if not rows:
         return 0
 
@@ -475,20 +630,14 @@ async def _upsert_timecodes(
         unique[(r["card_id"], r["item"])] = r
 
     today = date.today()
-    # counted_today: (card_id, item) → True если просмотр засчитан сегодня
-    counted_today: dict[tuple, bool] = {}
-    for r in unique.values():
-        try:
-            data = json.loads(r["data"]) if isinstance(r["data"], str) else r["data"]
-            percent = float(data.get("percent", 0))
-        except Exception:
-            percent = 0.0
-        counted = await _update_card_views(
-            db, device_id, lampa_profile_id,
-            r["card_id"], r["item"], percent, today,
-        )
-        if percent >= 90:
-            counted_today[(r["card_id"], r["item"])] = counted
+    progress: dict[tuple, dict] = {
+        key: _progress_columns(r["data"]) for key, r in unique.items()
+    }
+    counted, mark_only = await _count_views(
+        db, device_id, lampa_profile_id,
+        [(c, i, progress[(c, i)]["percent"] or 0.0) for c, i in unique],
+        today,
+    )
 
     values = []
     for r in unique.values():
@@ -498,32 +647,39 @@ async def _upsert_timecodes(
             "card_id": r["card_id"],
             "item": r["item"],
             "data": r["data"],
+            **progress[(r["card_id"], r["item"])],
         }
-        # view_count=1 если засчитан, 0 если нет — ON CONFLICT просто суммирует
-        if counted_today.get((r["card_id"], r["item"])):
-            row["counted_at"] = today
-            row["view_count"] = 1
-        else:
-            row["view_count"] = 0
+        # view_count=1 если засчитан, 0 если нет — ON CONFLICT просто суммирует;
+        # counted_at=NULL не затирает существующий (coalesce)
+        key = (r["card_id"], r["item"])
+        row["counted_at"] = today if key in counted or key in mark_only else None
+        row["view_count"] = 1 if key in counted else 0
         values.append(row)
 
-    stmt = pg_insert(Timecode).values(values)
-    stmt = stmt.on_conflict_do_update(
-        index_elements=[
-            Timecode.device_id,
-            Timecode.lampa_profile_id,
-            Timecode.card_id,
-            Timecode.item,
-        ],
-        set_={
-            "data": stmt.excluded.data,
-            "updated_at": stmt.excluded.updated_at,
-            "counted_at": func.coalesce(stmt.excluded.counted_at, Timecode.counted_at),
-            "view_count": Timecode.view_count + stmt.excluded.view_count,
+    # Крупные импорты — через COPY в staging-таблицу (app/db/bulk.py)
+    await bulk_upsert(
+        db, Timecode, values, TIMECODE_KEY,
+        lambda excluded: {
+            "data": excluded.data,
+            "percent": excluded.percent,
+            "time": excluded.time,
+            "duration": excluded.duration,
+            "updated_at": excluded.updated_at,
+            "counted_at": func.coalesce(excluded.counted_at, Timecode.counted_at),
+            "view_count": Timecode.view_count + excluded.view_count,
         },
     )
-    await db.execute(stmt)
+    await card_progress.refresh(db, device_id, lampa_profile_id, (v["card_id"] for v in values))
+    keys = [(v["card_id"], v["item"]) for v in values]
+    last_seq = await profile_changes.record_timecodes(db, device_id, lampa_profile_id, keys)
     await db.commit()
+    if seqs is not None and last_seq:
+        seqs.update((key, last_seq - len(keys) + 1 + i) for i, key in enumerate(keys))
+    timecode_cache.patch(
+        device_id, lampa_profile_id,
+        ((v["card_id"], v["item"], v["data"]) for v in values),
+    )
+    trending.record(card_id for card_id, _ in counted)
     return len(values)
 
 
@@ -556,24 +712,20 @@ async def load_device_timecodes(
 
 
 def get_watched_movie_ids(
-    timecodes: dict[str, dict[str, str]],
+    percents: dict[str, dict[str, float]],
     threshold: int | None = None,
 ) -> set[str]:
-    """Возвращает card_id фильмов, где хоть один таймкод >= threshold."""
+    """Возвращает card_id фильмов, где хоть один таймкод >= threshold.
+
+    percents — {card_id: {item: percent}} (см. timecode_cache.Snapshot.percents).
+    """
     if threshold is None:
         threshold = settings_cache.get_int("watched_threshold")
-    watched = set()
-    for card_id, items in timecodes.items():
-        if card_id.endswith("_tv"):
-            continue
-        for data_str in items.values():
-            try:
-                if json.loads(data_str).get("percent", 0) >= threshold:
-                    watched.add(card_id)
-                    break
-            except (json.JSONDecodeError, TypeError):
-                continue
-    return watched
+    return {
+        card_id
+        for card_id, items in percents.items()
+        if not card_id.endswith("_tv") and any(p >= threshold for p in items.values())
+    }
 
 
 # ---------------------------------------------------------------------------
@@ -593,23 +745,15 @@ async def _fetch_and_store_media_card(
     """Фоновая задача: получает метаданные из TMDB и сохраняет/обновляет в media_cards.
     Если переданы device_id/lampa_profile_id — обновляет updated_at таймкодов датой выхода.
     """
-    settings = get_settings()
-    headers = {"Authorization": settings.TMDB_TOKEN, "Accept": "application/json"}
     endpoint = "tv" if media_type == "tv" else "movie"
     title_key = "name" if media_type == "tv" else "title"
     orig_key = "original_name" if media_type == "tv" else "original_title"
     date_key = "first_air_date" if media_type == "tv" else "release_date"
 
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.get(
-                f"https://api.themoviedb.org/3/{endpoint}/{tmdb_id}",
-                headers=headers,
-                params={"language": "ru-RU", "append_to_response": "external_ids"},
-            )
-            if resp.status_code != 200:
-                return
-            data = resp.json()
+        data = await tmdb_client.details(endpoint, tmdb_id, append_to_response="external_ids")
+        if data is None:
+            return
 
         date_val = data.get(date_key) or ""
         values: dict = {
@@ -674,6 +818,8 @@ async def _fetch_and_store_media_card(
                         )
                     except (ValueError, TypeError):
                         pass
+                # last_watched импортированной карточки сдвинулся, у сериала появились серии
+                await card_progress.refresh(db, device_id, lampa_profile_id or "", [card_id])
 
             await db.commit()
 
@@ -742,37 +888,62 @@ async def save_timecode(
     await _assert_profile_allowed(device, lampa_profile_id, db)
 
     user_role = await _get_user_role(device, db)
+    seqs: dict[tuple[str, str], int] = {}
     await _upsert_timecodes(
         db,
         device.id,
         lampa_profile_id,
         [{"card_id": card_id, "item": item, "data": data}],
+        seqs,
     )
     await _trim_to_limit(db, device.id, lampa_profile_id, user_role)
-
-
-    # Авто-сохраняем имя профиля если передано и профиль не дефолтный
-    if lampa_profile_id and profile_name:
-        name = profile_name.strip()[:100]
-        stmt = (
-            pg_insert(LampaProfile)
-            .values(
-                device_id=device.id,
-                lampa_profile_id=lampa_profile_id,
-                name=name,
-            )
-            .on_conflict_do_update(
-                constraint="uq_lampa_profile",
-                set_={"name": name},
-            )
-        )
-        await db.execute(stmt)
-        await db.commit()
+    await _save_profile_name(db, device.id, lampa_profile_id, profile_name)
 
     logger.debug(
         f"Timecode saved: device={device.id}, profile={lampa_profile_id!r}, card={card_id}"
     )
 
+    # None = отправить всем (HTTP-запрос не знает conn_id)
+    _after_timecode_saved(
+        device.user_id, None, lampa_profile_id, card_id, item, data, seqs.get((card_id, item))
+    )
+
+    return {"success": True}
+
+
+async def _save_profile_name(
+    db: AsyncSession, device_id: int, lampa_profile_id: str, profile_name: str | None
+) -> None:
+    """Авто-сохраняет имя профиля если передано и профиль не дефолтный."""
+    if not (lampa_profile_id and profile_name):
+        return
+    name = profile_name.strip()[:100]
+    stmt = (
+        pg_insert(LampaProfile)
+        .values(
+            device_id=device_id,
+            lampa_profile_id=lampa_profile_id,
+            name=name,
+        )
+        .on_conflict_do_update(
+            constraint="uq_lampa_profile",
+            set_={"name": name},
+        )
+    )
+    await db.execute(stmt)
+    await db.commit()
+
+
+def _after_timecode_saved(
+    user_id: int,
+    sender_conn_id: str | None,
+    lampa_profile_id: str,
+    card_id: str,
+    item: str,
+    data: str,
+    seq: int | None = None,
+) -> None:
+    """Фон после записи таймкода плагином: метаданные TMDB, длительность серии, рассылка."""
     m = _CARD_ID_RE.match(card_id)
     if m:
         asyncio.create_task(
@@ -793,10 +964,11 @@ async def save_timecode(
     # Рассылаем обновление другим соединениям того же пользователя
     asyncio.create_task(
         ws_manager.broadcast(
-            device.user_id,
-            None,  # None = отправить всем (HTTP-запрос не знает conn_id)
+            user_id,
+            sender_conn_id,
             {
                 "type": "timecode",
+                "seq": seq,
                 "profile_id": lampa_profile_id,
                 "card_id": card_id,
                 "item": item,
@@ -805,8 +977,6 @@ async def save_timecode(
         )
     )
 
-    return {"success": True}
-
 
 # ---------------------------------------------------------------------------
 # Пакетный импорт
@@ -858,88 +1028,333 @@ async def export_timecodes(
     return timecodes
 
 
+@router.get("/changes")
+async def get_changes(
+    since: int | None = Query(default=None, ge=0),
+    profile_id: str = Query(None),
+    device: Device = Depends(get_device_by_token),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Изменения профиля после since — таймкоды, закладки, настройки плагинов (app/profile_changes.py).
+    Без since — только текущий номер {"seq": N}: клиент запоминает его перед полной
+    синхронизацией (/export, /favorite) и дальше читает ?since=N.
+    Ответ: {"seq", "reset", "more", "changes": [{"seq", "type", ...}]} — changes в формате
+    сообщений /timecode/ws (+ "timecode_delete", "plugin_setting"); more — запросить ещё
+    с since=seq; reset — журнал неполон, нужна полная синхронизация.
+    """
+    _require_device(device)
+    lampa_profile_id = profile_id or ""
+    if since is None:
+        seq, _ = await profile_changes.current(db, device.user_id, lampa_profile_id)
+        return {"seq": seq, "reset": False, "more": False, "changes": []}
+    return await profile_changes.read(db, device, lampa_profile_id, since)
+
+
 # ---------------------------------------------------------------------------
 # Импорт из Lampac (формат all_views)
 # ---------------------------------------------------------------------------
 
+# Сколько таймкодов потокового импорта пишется в БД за одну пачку
+_IMPORT_CHUNK = 2000
+# Фоновый импорт: одновременных догрузок TMDB / длительностей серий на задачу
+_HYDRATE_CONCURRENCY = 4
+
+# Обработчик пачки: (сохранено всего, фоновые корутины пачки)
+ChunkHook = Callable[[int, list[Coroutine]], Awaitable[None]]
+
+
+async def _spawn_background(saved: int, pending: list[Coroutine]) -> None:
+    """Импорт в запросе: фоновые задачи пачки запускаются без ожидания."""
+    for coro in pending:
+        asyncio.create_task(coro)
+
+
+async def _run_limited(coros: list[Coroutine], limit: int) -> None:
+    """Выполняет корутины не больше limit одновременно (ошибки уже ловят они сами)."""
+    it = iter(coros)
+
+    async def worker():
+        for coro in it:
+            await coro
+
+    await asyncio.gather(*(worker() for _ in range(min(limit, len(coros)))))
+
+
+class ImportFormatError(ValueError):
+    """Тело импорта — валидный JSON, но не в формате выгрузки."""
+
+
+async def _import_lampac_chunk(
+    db: AsyncSession,
+    device_id: int,
+    lp: str,
+    user_role: str,
+    rows: list[dict],
+    card_ids: list[str],
+) -> tuple[int, int, list[Coroutine]]:
+    """
+    Сохраняет пачку Lampac-импорта и сразу обрезает профиль до лимита роли —
+    лимит соблюдается, даже если дальше в теле окажется ошибка.
+    Возвращает (сохранено, удалено сверх лимита, корутины догрузки MediaCard /
+    длительностей серий) — как их запускать, решает вызывающий (ChunkHook).
+    """
+    saved = await _upsert_timecodes(db, device_id, lp, rows)
+    trimmed = await _trim_to_limit(db, device_id, lp, user_role)
+
+    # Загрузка MediaCard + обновление даты таймкодов
+    pending: list[Coroutine] = []
+    for card_id in card_ids:
+        m = _CARD_ID_RE.match(card_id)
+        pending.append(
+            _fetch_and_store_media_card(card_id, int(m.group(1)), m.group(2), device_id, lp)
+        )
+
+    # Обновляем duration_sec для серий TV-карточек (порог 40с — импорт считается надёжным источником)
+    for r in rows:
+        m = _CARD_ID_RE.match(r["card_id"])
+        if not m or m.group(2) != "tv":
+            continue
+        dur = _progress_columns(r["data"])["duration"]
+        if dur and round(dur) > 0:
+            pending.append(
+                _update_episode_duration(int(m.group(1)), r["item"], round(dur), threshold=40)
+            )
+    return saved, trimmed, pending
+
+
+async def _finish_lampac_import(
+    db: AsyncSession,
+    device_id: int,
+    lp: str,
+    user_role: str,
+    card_ids: list[str],
+) -> None:
+    """Обработка всех карточек импорта после записи таймкодов: история, затем чистка мусора."""
+    if not card_ids:
+        return
+
+    # Обновляем favorite.history один раз по уже существующим в DB MediaCards.
+    # Новые карточки появятся в истории при следующем импорте (после обогащения TMDB).
+    entries = []
+    for i in range(0, len(card_ids), _IMPORT_CHUNK):
+        mc_result = await db.execute(
+            select(MediaCard).where(MediaCard.card_id.in_(card_ids[i:i + _IMPORT_CHUNK]))
+        )
+        entries.extend(_media_card_to_entry(mc) for mc in mc_result.scalars().all())
+    if entries:
+        await _merge_favorite_history(db, device_id, lp, entries, user_role)
+        await db.commit()
+
+    # Удаляем мусорные таймкоды (невалидные хэши — артефакты старых версий Lampac)
+    for i in range(0, len(card_ids), _IMPORT_CHUNK):
+        await _cleanup_orphan_timecodes(db, device_id, lp, card_ids[i:i + _IMPORT_CHUNK])
+        await db.commit()
+    timecode_cache.invalidate(device_id, lp)
+
+
+async def _stream_lampac(
+    db: AsyncSession,
+    device_id: int,
+    lp: str,
+    user_role: str,
+    chunks: AsyncIterable[bytes],
+    on_chunk: ChunkHook,
+) -> tuple[int, int]:
+    """
+    Потоковый импорт Lampac all_views пачками по _IMPORT_CHUNK.
+    Возвращает (сохранено, удалено сверх лимита). Значение не строка-таймкод —
+    ImportFormatError (уже записанные пачки остаются, как и при невалидном JSON).
+    """
+    saved = trimmed = 0
+    rows: list[dict] = []
+    card_ids: list[str] = []
+    valid_card_ids: list[str] = []
+
+    async def flush():
+        nonlocal saved, trimmed
+        n, t, pending = await _import_lampac_chunk(db, device_id, lp, user_role, rows, card_ids)
+        saved += n
+        trimmed += t
+        await on_chunk(saved, pending)
+
+    async for card_id, items in json_stream.iter_object_items(chunks):
+        if not isinstance(items, dict):
+            raise ImportFormatError(f"{card_id}: ожидался объект {{item: данные}}")
+        for item, tc_data in items.items():
+            if not isinstance(tc_data, str):
+                raise ImportFormatError(f"{card_id}.{item}: данные таймкода должны быть строкой")
+            rows.append({"card_id": card_id, "item": item, "data": tc_data})
+        if _CARD_ID_RE.match(card_id):
+            card_ids.append(card_id)
+        if len(rows) >= _IMPORT_CHUNK:
+            await flush()
+            valid_card_ids.extend(card_ids)
+            rows, card_ids = [], []
+    if rows or card_ids:
+        await flush()
+        valid_card_ids.extend(card_ids)
+    await _finish_lampac_import(db, device_id, lp, user_role, valid_card_ids)
+    return saved, trimmed
+
+
+async def _stream_lampa(
+    db: AsyncSession,
+    device_id: int,
+    lp: str,
+    user_role: str,
+    chunks: AsyncIterable[bytes],
+    on_chunk: ChunkHook,
+) -> tuple[int, int]:
+    """
+    Потоковый импорт Lampa file_view пачками по _IMPORT_CHUNK; профиль обрезается
+    до лимита роли после каждой пачки. Возвращает (сохранено, удалено сверх лимита).
+    """
+    saved = trimmed = 0
+    rows: list[dict] = []
+
+    async def flush():
+        nonlocal saved, trimmed
+        saved += await _upsert_timecodes(db, device_id, lp, rows)
+        trimmed += await _trim_to_limit(db, device_id, lp, user_role)
+        await on_chunk(saved, [])
+
+    async for item_hash, tc_data in json_stream.iter_object_items(chunks):
+        if not isinstance(tc_data, dict):
+            continue
+        normalized = {
+            "time": tc_data.get("time", 0),
+            "duration": tc_data.get("duration", 0),
+            "percent": tc_data.get("percent", 0),
+        }
+        rows.append(
+            {
+                "card_id": "lampa_import",
+                "item": str(item_hash),
+                "data": json.dumps(normalized),
+            }
+        )
+        if len(rows) >= _IMPORT_CHUNK:
+            await flush()
+            rows = []
+    if rows:
+        await flush()
+    return saved, trimmed
+
+
+async def run_import_job(
+    db: AsyncSession,
+    job: ImportJob,
+    chunks: AsyncIterator[bytes],
+    progress: Callable[[int], Awaitable[None]],
+) -> dict:
+    """
+    Обработчик задачи import_jobs: тот же потоковый импорт, что и в запросе,
+    но догрузка TMDB и длительностей серий идёт не больше
+    _HYDRATE_CONCURRENCY за раз и до перехода к следующей пачке.
+    """
+    device = await db.get(Device, job.device_id)
+    if device is None:
+        raise RuntimeError("Устройство удалено")
+    user_role = await _get_user_role(device, db)
+
+    async def on_chunk(saved: int, pending: list[Coroutine]) -> None:
+        await progress(saved)
+        await _run_limited(pending, _HYDRATE_CONCURRENCY)
+
+    try:
+        if job.kind == "lampac":
+            saved, trimmed = await _stream_lampac(
+                db, device.id, job.lampa_profile_id, user_role, chunks, on_chunk
+            )
+        else:
+            saved, trimmed = await _stream_lampa(
+                db, device.id, job.lampa_profile_id, user_role, chunks, on_chunk
+            )
+    except json_stream.JSONStreamError as e:
+        raise RuntimeError(f"Невалидный JSON: {e}") from None
+    except ImportFormatError as e:
+        raise RuntimeError(f"Неверный формат: {e}") from None
+    logger.info(f"Import job {job.id} ({job.kind}): device={device.id}, saved={saved}, trimmed={trimmed}")
+    return {"saved": saved, "trimmed": trimmed}
+
+
+async def _assert_no_active_job(device: Device, db: AsyncSession) -> None:
+    """409 если у устройства уже есть незавершённый фоновый импорт."""
+    active = await db.scalar(
+        select(func.count())
+        .select_from(ImportJob)
+        .where(ImportJob.device_id == device.id, ImportJob.status.in_(import_jobs.ACTIVE))
+    )
+    if active:
+        raise HTTPException(status_code=409, detail="Импорт уже выполняется")
+
+
+async def _enqueue_import(
+    request: Request, device: Device, lp: str, kind: str, db: AsyncSession
+) -> dict:
+    """Сохраняет тело во временный файл и ставит задачу import_jobs."""
+    try:
+        file, size = await import_jobs.spool(request.stream())
+    except import_jobs.TooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    job = ImportJob(
+        device_id=device.id,
+        lampa_profile_id=lp,
+        kind=kind,
+        status="queued",
+        file=file,
+        total_bytes=size,
+        processed_bytes=0,
+        saved=0,
+        trimmed=0,
+    )
+    db.add(job)
+    await db.commit()
+    import_jobs.enqueue(job)
+    logger.info(f"Import job {job.id} queued: device={device.id}, kind={kind}, bytes={size}")
+    return {"success": True, "job_id": job.id, "status": job.status}
+
 
 @router.post("/import/lampac")
 async def import_from_lampac(
-    data: dict[str, dict[str, str]] = Body(...),
+    request: Request,
     profile_id: str = Query(None),
+    background: bool = Query(False),
     device: Device = Depends(get_device_by_token),
     db: AsyncSession = Depends(get_db),
 ):
     """
     Импорт из Lampac /timecode/all_views.
     Body: {"123_movie": {"hash1": '{"percent":100,...}'}, ...}
+
+    Тело разбирается потоково и пишется пачками по _IMPORT_CHUNK таймкодов —
+    память не зависит от размера выгрузки; лимит таймкодов роли применяется
+    после каждой пачки. Уже записанные пачки остаются, если дальше в теле
+    окажется невалидный JSON (400) или значение не в формате all_views (422).
+    ?background=true — импорт ставится задачей (import_jobs), ответ {job_id};
+    прогресс — GET /timecode/import/jobs/{job_id}/events (SSE).
     """
     _require_device(device)
+    if background:
+        await _assert_no_active_job(device, db)
     await _check_import_rate_limit(device, db)
     await _assert_profile_allowed(device, profile_id or "", db)
 
-    rows = []
-    for card_id, items in data.items():
-        for item, tc_data in items.items():
-            rows.append({"card_id": card_id, "item": item, "data": tc_data})
-
-    user_role = await _get_user_role(device, db)
-    saved = await _upsert_timecodes(db, device.id, profile_id or "", rows)
-    trimmed = await _trim_to_limit(db, device.id, profile_id or "", user_role)
-    logger.info(f"Lampac import: device={device.id}, saved={saved}, trimmed={trimmed}")
-
-    # Запускаем фоновую загрузку MediaCard + обновление даты таймкодов
     lp = profile_id or ""
-    valid_card_ids = []
-    for card_id in data.keys():
-        m = _CARD_ID_RE.match(card_id)
-        if m:
-            valid_card_ids.append(card_id)
-            asyncio.create_task(
-                _fetch_and_store_media_card(
-                    card_id,
-                    int(m.group(1)),
-                    m.group(2),
-                    device.id,
-                    lp,
-                )
-            )
+    if background:
+        return await _enqueue_import(request, device, lp, "lampac", db)
 
-    # Обновляем favorite.history один раз по уже существующим в DB MediaCards.
-    # Новые карточки появятся в истории при следующем импорте (после обогащения TMDB).
-    if valid_card_ids:
-        mc_result = await db.execute(
-            select(MediaCard).where(MediaCard.card_id.in_(valid_card_ids))
+    user_role = await _get_user_role(device, db)
+    try:
+        saved, trimmed = await _stream_lampac(
+            db, device.id, lp, user_role, request.stream(), _spawn_background
         )
-        entries = [_media_card_to_entry(mc) for mc in mc_result.scalars().all()]
-        if entries:
-            await _merge_favorite_history(db, device.id, lp, entries, user_role)
-            await db.commit()
-
-    # Обновляем duration_sec для серий TV-карточек (порог 40с — импорт считается надёжным источником)
-    tv_card_ids = [cid for cid in valid_card_ids if cid.endswith("_tv")]
-    for card_id in tv_card_ids:
-        m = _CARD_ID_RE.match(card_id)
-        if not m:
-            continue
-        tmdb_id = int(m.group(1))
-        for item, tc_data in data.get(card_id, {}).items():
-            try:
-                dur = json.loads(tc_data).get("duration")
-                if dur:
-                    dur_int = round(float(dur))
-                    if dur_int > 0:
-                        asyncio.create_task(_update_episode_duration(tmdb_id, item, dur_int, threshold=40))
-            except Exception:
-                pass
-
-    # Удаляем мусорные таймкоды (невалидные хэши — артефакты старых версий Lampac)
-    movie_card_ids = [cid for cid in valid_card_ids if cid.endswith("_movie")]
-    cleanup_ids = tv_card_ids + movie_card_ids
-    if cleanup_ids:
-        await _cleanup_orphan_timecodes(db, device.id, lp, cleanup_ids)
-        await db.commit()
-
+    except json_stream.JSONStreamError as e:
+        raise HTTPException(status_code=400, detail=f"Невалидный JSON: {e}")
+    except ImportFormatError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    logger.info(f"Lampac import: device={device.id}, saved={saved}, trimmed={trimmed}")
     return {"success": True, "saved": saved, "trimmed": trimmed}
 
 
@@ -950,8 +1365,9 @@ async def import_from_lampac(
 
 @router.post("/import/lampa")
 async def import_from_lampa(
-    data: dict[str, Any] = Body(...),
+    request: Request,
     profile_id: str = Query(None),
+    background: bool = Query(False),
     device: Device = Depends(get_device_by_token),
     db: AsyncSession = Depends(get_db),
 ):
@@ -960,31 +1376,25 @@ async def import_from_lampa(
     Body: {"572566331": {"duration": 6450, "time": 2715, "percent": 42, "profile": 0}, ...}
 
     В Lampa формате нет card_id — хранится с card_id="lampa_import".
+    Тело разбирается потоково; ?background=true — как в import_from_lampac.
     """
     _require_device(device)
+    if background:
+        await _assert_no_active_job(device, db)
     await _check_import_rate_limit(device, db)
     await _assert_profile_allowed(device, profile_id or "", db)
 
-    rows = []
-    for item_hash, tc_data in data.items():
-        if not isinstance(tc_data, dict):
-            continue
-        normalized = {
-            "time": tc_data.get("time", 0),
-            "duration": tc_data.get("duration", 0),
-            "percent": tc_data.get("percent", 0),
-        }
-        rows.append(
-            {
-                "card_id": "lampa_import",
-                "item": str(item_hash),
-                "data": json.dumps(normalized),
-            }
-        )
+    lp = profile_id or ""
+    if background:
+        return await _enqueue_import(request, device, lp, "lampa", db)
 
     user_role = await _get_user_role(device, db)
-    saved = await _upsert_timecodes(db, device.id, profile_id or "", rows)
-    trimmed = await _trim_to_limit(db, device.id, profile_id or "", user_role)
+    try:
+        saved, trimmed = await _stream_lampa(
+            db, device.id, lp, user_role, request.stream(), _spawn_background
+        )
+    except json_stream.JSONStreamError as e:
+        raise HTTPException(status_code=400, detail=f"Невалидный JSON: {e}")
     logger.info(f"Lampa import: device={device.id}, saved={saved}, trimmed={trimmed}")
     return {
         "success": True,
@@ -994,6 +1404,45 @@ async def import_from_lampa(
     }
 
 
+# ---------------------------------------------------------------------------
+# Фоновые задачи импорта
+# ---------------------------------------------------------------------------
+
+
+async def _get_own_job(job_id: int, device: Device | None, db: AsyncSession) -> ImportJob:
+    _require_device(device)
+    job = await db.get(ImportJob, job_id)
+    if job is None or job.device_id != device.id:
+        raise HTTPException(status_code=404, detail="Задача импорта не найдена")
+    return job
+
+
+@router.get("/import/jobs/{job_id}")
+async def get_import_job(
+    job_id: int,
+    device: Device = Depends(get_device_by_token),
+    db: AsyncSession = Depends(get_db),
+):
+    """Текущее состояние задачи импорта."""
+    await _get_own_job(job_id, device, db)
+    return await import_jobs.status(job_id)
+
+
+@router.get("/import/jobs/{job_id}/events")
+async def import_job_events(
+    job_id: int,
+    device: Device = Depends(get_device_by_token),
+    db: AsyncSession = Depends(get_db),
+):
+    """SSE-поток прогресса задачи импорта: progress… → done | error."""
+    await _get_own_job(job_id, device, db)
+    return StreamingResponse(
+        import_jobs.events(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ---------------------------------------------------------------------------
 # Удаление таймкода
 # ---------------------------------------------------------------------------
@@ -1018,7 +1467,10 @@ async def delete_timecode(
             Timecode.item == item,
         )
     )
+    await card_progress.refresh(db, device.id, profile_id or "", [card_id])
+    await profile_changes.record_timecodes(db, device.id, profile_id or "", [(card_id, item)])
     await db.commit()
+    timecode_cache.invalidate(device.id, profile_id or "")
     return {"success": True}
 
 
@@ -1041,194 +1493,47 @@ async def get_watch_history(
     """
     _require_device(device)
 
-    result = await db.execute(
-        select(Timecode)
-        .where(
-            Timecode.device_id == device.id,
-            Timecode.lampa_profile_id == (profile_id or ""),
-        )
-        .order_by(Timecode.updated_at.desc())
-    )
-    timecodes = result.scalars().all()
-
-    _WATCHED_PCT = 90
-
-    # Агрегируем по card_id: last_watched + max percent по каждому item (эпизоду)
-    card_agg: dict[str, dict] = {}
-    for tc in timecodes:
-        if not _CARD_ID_RE.match(tc.card_id):
-            continue
-        try:
-            pct = json.loads(tc.data).get("percent", 0)
-        except Exception:
-            pct = 0
-        if tc.card_id not in card_agg:
-            card_agg[tc.card_id] = {"last_watched": tc.updated_at, "items": {}}
-        agg = card_agg[tc.card_id]
-        # Для каждого item (эпизода) храним максимальный процент
-        agg["items"][tc.item] = max(agg["items"].get(tc.item, 0), pct)
-
-    if not card_agg:
+    # Прогресс карточек уже посчитан в card_progress — одна страница по индексу
+    cp = card_progress.grouped(device.id, profile_id or "")
+    total = await db.scalar(select(func.count()).select_from(cp)) or 0
+    if not total:
         return []
 
-    mc_result = await db.execute(
-        select(MediaCard).where(MediaCard.card_id.in_(list(card_agg.keys())))
-    )
-    media_cards = {mc.card_id: mc for mc in mc_result.scalars().all()}
-
-    # Батч-запрос неспешловых эпизодов из MyShows для всех TV-сериалов в истории
-    tv_tmdb_ids = [
-        int(_CARD_ID_RE.match(cid).group(1))
-        for cid in card_agg.keys()
-        if cid.endswith("_tv") and _CARD_ID_RE.match(cid)
-    ]
-    episodes_by_show: dict[int, list[tuple[int, int]]] = {}
-    if tv_tmdb_ids:
-        ep_rows = await db.execute(
-            select(Episode.tmdb_show_id, Episode.season, Episode.episode)
-            .where(
-                Episode.tmdb_show_id.in_(tv_tmdb_ids), Episode.is_special == False, Episode.season > 0,
-                (Episode.air_date == None) | (Episode.air_date <= date.today()),  # noqa: E711, E712
-            )
-            .order_by(Episode.tmdb_show_id, Episode.season, Episode.episode)
-        )
-        for tid, s, e in ep_rows.all():
-            episodes_by_show.setdefault(tid, []).append((s, e))
+    total_pages = max(1, (total + limit - 1) // limit)
+    page = min(page, total_pages)
+    rows = (await db.execute(
+        select(cp, MediaCard)
+        .outerjoin(MediaCard, MediaCard.card_id == cp.c.card_id)
+        .order_by(cp.c.last_watched.desc().nulls_last(), cp.c.card_id)
+        .offset((page - 1) * limit)
+        .limit(limit)
+    )).all()
 
-    today_str = date.today().isoformat()
     history = []
-    for card_id, agg in card_agg.items():
-        mc = media_cards.get(card_id)
-        m = _CARD_ID_RE.match(card_id)
-        items = agg["items"]
-        max_pct = max(items.values(), default=0)
-
-        watched_episodes = total_episodes = None
-        is_ongoing = False
-        progress = max_pct
-
-        if card_id.endswith("_tv") and mc:
-            try:
-                last_ep_s = mc.last_ep_season or 0
-                last_ep_e = mc.last_ep_number or 0
-                today_str = date.today().isoformat()
-
-                # Онгоинг определяем из TMDB (не зависит от источника эпизодов)
-                if mc.next_ep_air_date is not None:
-                    is_ongoing = bool(mc.next_ep_air_date) or bool(
-                        mc.last_air_date and mc.last_air_date > today_str
-                    )
-
-                # Приоритет: MyShows episodes table
-                show_eps = episodes_by_show.get(mc.tmdb_id)
-                if show_eps:
-                    # MyShows хранит только вышедшие серии — фильтр по TMDB last_ep не нужен
-                    aired = show_eps
-
-                    orig = mc.original_title or ""
-                    valid_hashes = {
-                        lampa_hash(build_episode_hash_string(s, e, orig))
-                        for s, e in aired
-                    }
-                    total_aired = len(aired)
-                    watched_episodes = sum(
-                        1
-                        for h, p in items.items()
-                        if h in valid_hashes and p >= _WATCHED_PCT
-                    )
-                    total_episodes = total_aired
-                    if mc.next_ep_air_date is None and mc.seasons_json:
-                        # Онгоинг fallback через seasons_json если next_ep_air_date не заполнен
-                        try:
-                            seasons = json.loads(mc.seasons_json)
-                            total_all = sum(
-                                s.get("episode_count", 0)
-                                for s in seasons
-                                if (s.get("season_number") or 0) > 0
-                            )
-                            is_ongoing = (total_all > total_aired) or bool(
-                                mc.last_air_date and mc.last_air_date > today_str
-                            )
-                        except Exception:
-                            pass
-
-                elif mc.seasons_json:
-                    # Fallback: TMDB seasons_json
-                    seasons = json.loads(mc.seasons_json)
-                    total_aired = 0
-                    total_all = 0
-                    for s in seasons:
-                        snum = s.get("season_number") or 0
-                        if snum == 0:
-                            continue
-                        ep_count = s.get("episode_count") or 0
-                        total_all += ep_count
-                        if last_ep_s > 0:
-                            if snum < last_ep_s:
-                                total_aired += ep_count
-                            elif snum == last_ep_s:
-                                total_aired += last_ep_e
-                        else:
-                            s_air = s.get("air_date") or ""
-                            if s_air and s_air <= today_str:
-                                total_aired += ep_count
-                    watched_episodes = sum(
-                        1 for p in items.values() if p >= _WATCHED_PCT
-                    )
-                    total_episodes = total_aired
-                    if mc.next_ep_air_date is None:
-                        is_ongoing = (total_all > total_aired) or bool(
-                            mc.last_air_date and mc.last_air_date > today_str
-                        )
-
-                if total_episodes is not None and total_episodes > 0:
-                    progress = min(
-                        round((watched_episodes or 0) / total_episodes * 100), 100
-                    )
-            except Exception:
-                pass
-
-        is_complete = (
-            (
-                watched_episodes is not None
-                and total_episodes is not None
-                and watched_episodes >= total_episodes > 0
-            )
-            if card_id.endswith("_tv")
-            else progress >= _WATCHED_PCT
-        )
-
-        entry = {
-            "card_id": card_id,
+    for row in rows:
+        mc = row.MediaCard
+        m = _CARD_ID_RE.match(row.card_id)
+        history.append({
+            "card_id": row.card_id,
             "tmdb_id": mc.tmdb_id if mc else (int(m.group(1)) if m else None),
-            "media_type": mc.media_type if mc else (m.group(2) if m else None),
+            "media_type": mc.media_type if mc else row.media_type,
             "title": mc.title if mc else None,
             "original_title": mc.original_title if mc else None,
             "poster_path": mc.poster_path if mc else None,
             "year": mc.year if mc else None,
-            "last_watched": (
-                agg["last_watched"].isoformat() if agg["last_watched"] else None
-            ),
-            "max_percent": max_pct,
-            "progress": progress,
-            "watched_episodes": watched_episodes,
-            "total_episodes": total_episodes,
-            "is_complete": is_complete,
-            "is_ongoing": is_ongoing,
+            "last_watched": row.last_watched.isoformat() if row.last_watched else None,
+            "max_percent": row.max_percent,
+            "progress": card_progress.progress(row),
+            "watched_episodes": row.watched_episodes,
+            "total_episodes": row.total_episodes,
+            "is_complete": row.is_complete,
+            "is_ongoing": row.is_ongoing,
             "last_ep_season": mc.last_ep_season if mc else None,
             "last_ep_number": mc.last_ep_number if mc else None,
-        }
-        history.append(entry)
-
-    history.sort(key=lambda x: x["last_watched"] or "", reverse=True)
-
-    total = len(history)
-    total_pages = max(1, (total + limit - 1) // limit)
-    page = min(page, total_pages)
-    start = (page - 1) * limit
+        })
 
     return {
-        "results": history[start : start + limit],
+        "results": history,
         "total_pages": total_pages,
     }
 
@@ -1370,8 +1675,12 @@ async def create_profile(
         .where(Timecode.device_id == device.id, Timecode.lampa_profile_id == "")
         .values(lampa_profile_id=profile_id)
     )
+    await card_progress.refresh(db, device.id)
+    await profile_changes.reset(db, device.id, "")
+    await profile_changes.reset(db, device.id, profile_id)
 
     await db.commit()
+    timecode_cache.invalidate(device.id)
     await db.refresh(lp)
 
     return {"ok": True, "profile_id": profile_id, "name": name, "icon": lp.icon}
@@ -1470,8 +1779,11 @@ async def delete_profile(
             Timecode.lampa_profile_id == profile_id,
         )
     )
+    await card_progress.refresh(db, device.id, profile_id)
+    await profile_changes.reset(db, device.id, profile_id)
     await db.delete(lp)
     await db.commit()
+    timecode_cache.invalidate(device.id, profile_id)
     return {"ok": True}
 
 
@@ -1617,6 +1929,7 @@ async def put_favorite(
     lp.favorite = (
         json.dumps(favorite, ensure_ascii=False) if favorite is not None else None
     )
+    seq = await profile_changes.record_favorite(db, device.id, profile_id)
     await db.commit()
 
     # Рассылаем обновление закладок другим соединениям пользователя
@@ -1624,7 +1937,7 @@ async def put_favorite(
         ws_manager.broadcast(
             device.user_id,
             None,
-            {"type": "favorite", "profile_id": profile_id, "favorite": favorite},
+            {"type": "favorite", "seq": seq, "profile_id": profile_id, "favorite": favorite},
         )
     )
 
@@ -1644,47 +1957,20 @@ async def get_popular(
     db: AsyncSession = Depends(get_db),
 ):
     """
-    Глобально популярные карточки за период из настроек приложения (popular_period_days).
-    Вес = completed_count + current_progress / 100 — суммируется по всем профилям всех пользователей.
+    Глобально популярные карточки за период из настроек приложения (popular_period_days) —
+    тот же рейтинг np_popular, что у категории «Популярно в NP» (app/popular.py).
     Возвращает {results, page, total_pages, total_results} — стандартный Lampa-формат.
     """
     from math import ceil
-    from datetime import timedelta
 
     _require_device(device)
 
-    period = settings_cache.get_int("popular_period_days") or 30
-    cutoff = date.today() - timedelta(days=period)
-
-    base_q = (
-        select(CardView.card_id, CardView.completed_count)
-        .join(MediaCard, MediaCard.card_id == CardView.card_id)
-        .where(CardView.updated_at >= cutoff)
-        .order_by(CardView.completed_count.desc())
-    )
-    total = (
-        await db.execute(select(func.count()).select_from(base_q.subquery()))
-    ).scalar() or 0
-
-    rows = (
-        await db.execute(base_q.offset((page - 1) * per_page).limit(per_page))
-    ).fetchall()
-
-    card_ids = [r.card_id for r in rows]
-    mc_map = {
-        mc.card_id: mc
-        for mc in (
-            await db.execute(select(MediaCard).where(MediaCard.card_id.in_(card_ids)))
-        ).scalars().all()
-    } if card_ids else {}
-
+    rows, total = await popular.get_page(db, page, per_page)
     results = []
-    for r in rows:
-        mc = mc_map.get(r.card_id)
-        if mc:
-            entry = _media_card_to_entry(mc)
-            entry["_np_views"] = round(r.completed_count, 2)
-            results.append(entry)
+    for mc, weight in rows:
+        entry = _media_card_to_entry(mc)
+        entry["_np_views"] = round(weight, 2)
+        results.append(entry)
 
     return {
         "results": results,
@@ -1699,25 +1985,161 @@ async def get_popular(
 # ---------------------------------------------------------------------------
 
 
+async def write_ws_batch(db: AsyncSession, writes: list[timecode_writes.Write]) -> None:
+    """Пачка таймкодов из /timecode/ws одной пары устройство/профиль (timecode_writes)."""
+    first = writes[0]
+    seqs: dict[tuple[str, str], int] = {}
+    await _upsert_timecodes(
+        db,
+        first.device_id,
+        first.lampa_profile_id,
+        [{"card_id": w.card_id, "item": w.item, "data": w.data} for w in writes],
+        seqs,
+    )
+    for w in writes:
+        w.seq = seqs.get((w.card_id, w.item))
+    await _trim_to_limit(db, first.device_id, first.lampa_profile_id, first.role)
+    names = [w.profile_name for w in writes if w.profile_name]
+    await _save_profile_name(db, first.device_id, first.lampa_profile_id, names[-1] if names else None)
+
+
+def _parse_ws_write(text: str) -> dict | None:
+    """Кадр записи таймкода от клиента или None (прочие кадры игнорируются)."""
+    try:
+        msg = json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    if not isinstance(msg, dict) or msg.get("type") != "timecode" or "seq" not in msg:
+        return None
+    return msg
+
+
+def _ws_write_error(msg: dict) -> str | None:
+    for key in ("card_id", "item", "data"):
+        if not isinstance(msg.get(key), str) or not msg[key]:
+            return f"{key} обязателен"
+    try:
+        json.loads(msg["data"])
+    except json.JSONDecodeError:
+        return "data должна быть JSON-строкой"
+    return None
+
+
+async def _send_missed_changes(
+    device: Device, conn_id: str, lampa_profile_id: str, since: int
+) -> None:
+    """Досылает изменения профиля после since — по сообщению {"type": "changes", ...} на страницу."""
+    async with async_session_maker() as db:
+        while True:
+            page = await profile_changes.read(db, device, lampa_profile_id, since)
+            ws_manager.send(
+                device.user_id, conn_id,
+                {"type": "changes", "profile_id": lampa_profile_id, **page},
+            )
+            since = page["seq"]
+            if not page["more"]:
+                break
+
+
 @router.websocket("/ws")
 async def ws_timecode(
     websocket: WebSocket,
+    since: int | None = Query(default=None, ge=0),
+    profile_id: str = Query(None),
     device: Device = Depends(get_device_by_token),
 ):
     """
-    WebSocket для получения обновлений таймкодов от других устройств пользователя в реальном времени.
-    Подключение: ws://BASE_URL/timecode/ws?token=KEY
-    Сообщения: {"type": "timecode", "profile_id": "", "card_id": "123_movie", "item": "hash", "data": "..."}
+    WebSocket таймкодов: обновления от других устройств пользователя и запись своих.
+    Подключение: ws://BASE_URL/timecode/ws?token=KEY[&since=N&profile_id=ID]
+    Сервер → клиент: {"type": "timecode", "seq": N, "profile_id": "", "card_id": "123_movie", "item": "hash", "data": "..."}
+      seq — номер в журнале изменений профиля. С ?since=N после подключения досылаются
+      пропущенные изменения: {"type": "changes", "seq", "reset", "more", "changes": [...]}
+      по странице, как GET /timecode/changes; reset — нужна полная синхронизация.
+    Клиент → сервер (вместо POST /timecode):
+      {"type": "timecode", "seq": 1, "profile_id": "", "profile_name": "...",
+       "card_id": "123_movie", "item": "hash", "data": "{...}"}
+      Ответ после записи в БД: {"type": "ack", "seq": 1, "ok": true}
+      или {"type": "ack", "seq": 1, "ok": false, "error": "..."} — при ошибке клиент
+      может повторить запись через HTTP. Прочие кадры игнорируются.
+    Лимит профиля проверяется при первой записи в профиль. Token и блокировка
+    пользователя — перед каждой записью (token_cache, без запроса при попадании):
+    после смены token, удаления устройства или блокировки — ack с ошибкой и close 4001.
     """
     if not device:
         await websocket.close(code=4001)
         return
 
-    conn_id = await ws_manager.connect(device.user_id, websocket)
+    user_id = device.user_id
+    conn_id = await ws_manager.connect(user_id, websocket)
+    allowed_profiles: set[str] = set()
+
+    def ack(seq, error: str | None = None) -> None:
+        msg = {"type": "ack", "seq": seq, "ok": error is None}
+        if error is not None:
+            msg["error"] = error
+        ws_manager.send(user_id, conn_id, msg)
+
+    def on_written(msg: dict, fut) -> None:
+        if fut.cancelled() or fut.exception() is not None:
+            ack(msg["seq"], "не удалось сохранить")
+            return
+        ack(msg["seq"])
+        _after_timecode_saved(
+            user_id, conn_id, msg["lampa_profile_id"], msg["card_id"], msg["item"], msg["data"],
+            fut.result(),
+        )
+
     try:
+        if since is not None:
+            # Соединение уже получает новые сообщения — пропущенное досылается следом
+            await _send_missed_changes(device, conn_id, profile_id or "", since)
         while True:
-            await websocket.receive_text()  # держим соединение, ping/pong
+            msg = _parse_ws_write(await websocket.receive_text())
+            if msg is None:
+                continue
+            error = _ws_write_error(msg)
+            if error is not None:
+                ack(msg["seq"], error)
+                continue
+
+            lampa_profile_id = msg.get("profile_id") or ""
+            if lampa_profile_id not in allowed_profiles:
+                try:
+                    async with async_session_maker() as db:
+                        await _assert_profile_allowed(device, lampa_profile_id, db)
+                except HTTPException as e:
+                    ack(msg["seq"], e.detail)
+                    continue
+                allowed_profiles.add(lampa_profile_id)
+
+            # Сокет живёт дольше token: права на запись — на момент кадра
+            async with async_session_maker() as db:
+                auth = await device_auth(device.token, db)
+            if auth is None or auth.device_id != device.id:
+                await ws_manager.close(
+                    user_id, conn_id, 4001,
+                    {"type": "ack", "seq": msg["seq"], "ok": False, "error": "Токен недействителен"},
+                )
+                break
+
+            msg["lampa_profile_id"] = lampa_profile_id
+            try:
+                done = timecode_writes.submit(timecode_writes.Write(
+                    device_id=device.id,
+                    role=auth.role,
+                    lampa_profile_id=lampa_profile_id,
+                    profile_name=msg.get("profile_name") if isinstance(msg.get("profile_name"), str) else None,
+                    card_id=msg["card_id"],
+                    item=msg["item"],
+                    data=msg["data"],
+                ))
+            except timecode_writes.Overloaded as e:
+                ack(msg["seq"], str(e))
+                continue
+            done.add_done_callback(lambda fut, msg=msg: on_written(msg, fut))
     except WebSocketDisconnect:
-        ws_manager.disconnect(device.user_id, conn_id)
-    except Exception:
-        ws_manager.disconnect(device.user_id, conn_id)
+        pass
+    except Exception as e:
+        logger.debug(f"WS timecode: conn={conn_id} closed: {e!r}")
+    finally:
+        ws_manager.disconnect(user_id, conn_id)
@@ -38,7 +38,7 @@ from sqlalchemy import select, func
 
 from app.db.database import async_session_maker
 from app.db.models import TelegramUser, TelegramLinkCode, User, Device, SupportMessage
-from app import settings_cache
+from app import settings_cache, token_cache
 
 logger = logging.getLogger(__name__)
 
@@ -442,6 +442,7 @@ async def _set_role(message: types.Message, username: str, role: str):
         old_role = user.role
         user.role = role
         await db.commit()
+        token_cache.invalidate_user(user.id)
 
     role_labels = {"simple": "Базовый", "premium": "Премиум", "super": "Супер"}
     await message.answer(
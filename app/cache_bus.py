@@ -0,0 +1,65 @@
+"""
+Сброс per-process кэшей (token_cache, session_cache) на всех воркерах.
+
+Кэши живут в памяти процесса, а смена token, блокировка, logout и т.п.
+обрабатываются одним воркером. invalidate_* кэша сбрасывает запись у себя
+и вызывает notify(): сообщение уходит через ws_broadcast (канал "cache"),
+остальные воркеры и инстансы применяют тот же сброс. Без REDIS_URL
+рассылка идёт только внутри процесса — такой режим рассчитан на один
+воркер; иначе другие воркеры видят изменения лишь по истечении TTL кэша.
+"""
+import asyncio
+import logging
+import uuid
+from typing import Any, Callable
+
+from app import ws_broadcast
+
+logger = logging.getLogger(__name__)
+
+_CHANNEL = "cache"
+# Своё сообщение процесс уже применил — получатели его пропускают
+_ORIGIN = uuid.uuid4().hex
+
+# (op, arg) → сброс у себя
+Apply = Callable[[str, Any], None]
+
+_handlers: dict[str, Apply] = {}
+_pending: set[asyncio.Task] = set()
+_stats = {"sent": 0, "applied": 0}
+
+
+def register(cache: str, apply: Apply) -> None:
+    """Сброс кэша по сообщению другого воркера (вызывается при импорте модуля кэша)."""
+    _handlers[cache] = apply
+
+
+def notify(cache: str, op: str, arg: Any = None) -> None:
+    """Рассылает сброс остальным воркерам. Вне event loop (скрипты миграций) — нечего рассылать."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _stats["sent"] += 1
+    task = loop.create_task(
+        ws_broadcast.publish(_CHANNEL, 0, _ORIGIN, {"cache": cache, "op": op, "arg": arg})
+    )
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+async def _deliver(user_id: int, sender: str | None, message: dict) -> None:
+    if sender == _ORIGIN:
+        return
+    apply = _handlers.get(message.get("cache"))
+    if apply is None:
+        return
+    apply(message["op"], message.get("arg"))
+    _stats["applied"] += 1
+
+
+ws_broadcast.register(_CHANNEL, _deliver)
+
+
+def info() -> dict:
+    return dict(_stats)
@@ -0,0 +1,282 @@
+"""
+Сводный прогресс карточек — таблица card_progress.
+
+Одна строка на (device_id, lampa_profile_id, card_id): last_watched, max_percent,
+watched_episodes / total_episodes, is_complete, is_ongoing. watched_episodes и
+is_complete — по порогу истории WATCHED_PCT; для «Продолжить просмотр» с порогом
+запроса хранится watched_by_pct — число серий при каждом целом пороге 1..100.
+История просмотра
+и «Продолжить просмотр» читают её одним индексированным запросом с пагинацией,
+а не собирают прогресс из всех таймкодов профиля на каждый запрос.
+
+Строки пересчитываются refresh() — из таймкодов затронутых карточек,
+media_cards и реестра эпизодов (episode_registry):
+  - при записи/удалении таймкодов — рядом с timecode_cache.patch/invalidate;
+  - при обновлении MediaCard и синхронизации эпизодов — по всем профилям карточки;
+  - раз в сутки — для онгоингов (вышедших серий становится больше без записей в БД).
+Сам пересчёт не коммитит — вызывающий коммитит вместе со своей записью.
+"""
+import json
+import logging
+from datetime import date
+from typing import Iterable
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import episode_registry
+from app.db.bulk import bulk_upsert
+from app.db.models import CardProgress, MediaCard, Timecode
+
+logger = logging.getLogger(__name__)
+
+WATCHED_PCT = 90
+CARD_RE = r"^\d+_(movie|tv)$"
+
+KEY = ["device_id", "lampa_profile_id", "card_id"]
+_COLUMNS = (
+    "media_type", "last_watched", "max_percent",
+    "watched_episodes", "total_episodes", "watched_by_pct", "is_complete", "is_ongoing",
+)
+
+
+def _watched_by_pct(percents: Iterable[float]) -> list[int]:
+    """[k-1] — число процентов >= k для k = 1..100; нулевой хвост отброшен."""
+    hist = [0] * 101
+    for p in percents:
+        hist[max(0, min(100, int(p)))] += 1
+    out = []
+    n = 0
+    for k in range(100, 0, -1):
+        n += hist[k]
+        out.append(n)
+    out.reverse()
+    while out and out[-1] == 0:
+        out.pop()
+    return out
+
+
+def _seasons_totals(mc: MediaCard, today_str: str) -> tuple[int, int]:
+    """(вышедших, всего) эпизодов по TMDB seasons_json, без спецвыпусков."""
+    last_ep_s = mc.last_ep_season or 0
+    last_ep_e = mc.last_ep_number or 0
+    total_aired = 0
+    total_all = 0
+    for s in json.loads(mc.seasons_json):
+        snum = s.get("season_number") or 0
+        if snum == 0:
+            continue
+        ep_count = s.get("episode_count") or 0
+        total_all += ep_count
+        if last_ep_s > 0:
+            if snum < last_ep_s:
+                total_aired += ep_count
+            elif snum == last_ep_s:
+                total_aired += last_ep_e
+        else:
+            s_air = s.get("air_date") or ""
+            if s_air and s_air <= today_str:
+                total_aired += ep_count
+    return total_aired, total_all
+
+
+def compute(card_id: str, mc: MediaCard | None, items: dict[str, float]) -> dict:
+    """
+    Прогресс карточки по max-проценту каждого item.
+    Сериалы: просмотренные/вышедшие серии — по таблице episodes (MyShows),
+    фолбэк — TMDB seasons_json; episode_registry должен быть загружен для шоу.
+    """
+    max_pct = max(items.values(), default=0)
+    watched_episodes = total_episodes = watched_by_pct = None
+    is_ongoing = False
+
+    if card_id.endswith("_tv") and mc:
+        try:
+            today_str = date.today().isoformat()
+            # Онгоинг определяем из TMDB (не зависит от источника эпизодов)
+            if mc.next_ep_air_date is not None:
+                is_ongoing = bool(mc.next_ep_air_date) or bool(
+                    mc.last_air_date and mc.last_air_date > today_str
+                )
+
+            # Приоритет: MyShows episodes table (только вышедшие серии)
+            show_eps = episode_registry.aired(mc.tmdb_id)
+            if show_eps:
+                valid_hashes = episode_registry.aired_hashes(mc.tmdb_id, mc.original_title or "")
+                episode_pcts = [p for h, p in items.items() if h in valid_hashes]
+                watched_episodes = sum(1 for p in episode_pcts if p >= WATCHED_PCT)
+                watched_by_pct = _watched_by_pct(episode_pcts)
+                total_episodes = len(show_eps)
+                if mc.next_ep_air_date is None and mc.seasons_json:
+                    # Онгоинг fallback через seasons_json если next_ep_air_date не заполнен
+                    try:
+                        _, total_all = _seasons_totals(mc, today_str)
+                        is_ongoing = (total_all > total_episodes) or bool(
+                            mc.last_air_date and mc.last_air_date > today_str
+                        )
+                    except Exception:
+                        pass
+
+            elif mc.seasons_json:
+                # Fallback: TMDB seasons_json
+                total_episodes, total_all = _seasons_totals(mc, today_str)
+                watched_episodes = sum(1 for p in items.values() if p >= WATCHED_PCT)
+                watched_by_pct = _watched_by_pct(items.values())
+                if mc.next_ep_air_date is None:
+                    is_ongoing = (total_all > total_episodes) or bool(
+                        mc.last_air_date and mc.last_air_date > today_str
+                    )
+        except Exception:
+            pass
+
+    if card_id.endswith("_tv"):
+        is_complete = (
+            watched_episodes is not None
+            and total_episodes is not None
+            and watched_episodes >= total_episodes > 0
+        )
+    else:
+        is_complete = max_pct >= WATCHED_PCT
+
+    return {
+        "media_type": "tv" if card_id.endswith("_tv") else "movie",
+        "max_percent": max_pct,
+        "watched_episodes": watched_episodes,
+        "total_episodes": total_episodes,
+        "watched_by_pct": watched_by_pct,
+        "is_complete": is_complete,
+        "is_ongoing": is_ongoing,
+    }
+
+
+def progress(row) -> int | float:
+    """Процент для отображения: доля просмотренных серий, иначе max_percent."""
+    if row.total_episodes:
+        return min(round((row.watched_episodes or 0) / row.total_episodes * 100), 100)
+    return row.max_percent
+
+
+def grouped(device_id: int, profile_id: str | None = None, threshold: int | None = None):
+    """
+    card_progress устройства, свёрнутый по card_id — подзапрос для истории
+    и «Продолжить просмотр». profile_id=None — по всем профилям устройства.
+    threshold — добавляет колонку watched_at_threshold: серий с процентом >= threshold.
+    """
+    where = [CardProgress.device_id == device_id]
+    if profile_id is not None:
+        where.append(CardProgress.lampa_profile_id == profile_id)
+    columns = [
+        CardProgress.card_id,
+        func.max(CardProgress.media_type).label("media_type"),
+        func.max(CardProgress.last_watched).label("last_watched"),
+        func.max(CardProgress.max_percent).label("max_percent"),
+        func.max(CardProgress.watched_episodes).label("watched_episodes"),
+        func.max(CardProgress.total_episodes).label("total_episodes"),
+        func.bool_or(CardProgress.is_complete).label("is_complete"),
+        func.bool_or(CardProgress.is_ongoing).label("is_ongoing"),
+    ]
+    if threshold is not None:
+        # Элемент за концом массива — NULL: серий с таким процентом нет
+        k = max(1, min(100, threshold))
+        columns.append(
+            func.max(func.coalesce(CardProgress.watched_by_pct[k], 0)).label("watched_at_threshold")
+        )
+    return (
+        select(*columns)
+        .where(*where)
+        .group_by(CardProgress.card_id)
+        .subquery()
+    )
+
+
+async def refresh(
+    db: AsyncSession,
+    device_id: int | None = None,
+    profile_id: str | None = None,
+    card_ids: Iterable[str] | None = None,
+) -> None:
+    """
+    Пересчитывает строки card_progress (без commit).
+    device_id=None — все устройства (тогда нужен card_ids), profile_id=None —
+    все профили устройства, card_ids=None — все карточки.
+    Фиксированное число запросов на весь набор.
+    """
+    tc_where = [Timecode.card_id.regexp_match(CARD_RE)]
+    cp_where = []
+    if device_id is not None:
+        tc_where.append(Timecode.device_id == device_id)
+        cp_where.append(CardProgress.device_id == device_id)
+    if profile_id is not None:
+        tc_where.append(Timecode.lampa_profile_id == profile_id)
+        cp_where.append(CardProgress.lampa_profile_id == profile_id)
+    if card_ids is not None:
+        card_ids = list(set(card_ids))
+        if not card_ids:
+            return
+        tc_where.append(Timecode.card_id.in_(card_ids))
+        cp_where.append(CardProgress.card_id.in_(card_ids))
+    if not cp_where:
+        raise ValueError("card_progress.refresh: нужен device_id или card_ids")
+
+    # (device, profile, card) → процент каждого item и последняя дата
+    # (item уникален в профиле — uq_timecode_unique)
+    agg: dict[tuple[int, str, str], dict] = {}
+    for dev, lp, card_id, item, pct, updated in (await db.execute(
+        select(
+            Timecode.device_id, Timecode.lampa_profile_id, Timecode.card_id, Timecode.item,
+            func.coalesce(Timecode.percent, 0), Timecode.updated_at,
+        ).where(*tc_where)
+    )).all():
+        a = agg.setdefault((dev, lp, card_id), {"items": {}, "last": None})
+        a["items"][item] = float(pct or 0)
+        if updated is not None and (a["last"] is None or updated > a["last"]):
+            a["last"] = updated
+
+    # Область пересчёта пишется заново: строки карточек без таймкодов пропадают
+    await db.execute(delete(CardProgress).where(*cp_where))
+    if not agg:
+        return
+
+    cards = list({card_id for _, _, card_id in agg})
+    mc_map = {
+        mc.card_id: mc
+        for mc in (await db.execute(
+            select(MediaCard).where(MediaCard.card_id.in_(cards))
+        )).scalars().all()
+    }
+    await episode_registry.load(
+        db, [mc.tmdb_id for mc in mc_map.values() if mc.card_id.endswith("_tv")]
+    )
+
+    values = [
+        {
+            "device_id": dev,
+            "lampa_profile_id": lp,
+            "card_id": card_id,
+            "last_watched": a["last"],
+            **compute(card_id, mc_map.get(card_id), a["items"]),
+        }
+        for (dev, lp, card_id), a in agg.items()
+    ]
+    await bulk_upsert(
+        db, CardProgress, values, KEY,
+        lambda excluded: {c: excluded[c] for c in _COLUMNS},
+    )
+
+
+async def refresh_ongoing(db: AsyncSession, chunk: int = 500) -> int:
+    """
+    Ежедневный пересчёт онгоингов (и сериалов без известного числа серий):
+    число вышедших серий растёт без записей в БД, досмотренный сериал снова
+    становится недосмотренным. Коммитит по пачкам карточек.
+    """
+    card_ids = list((await db.execute(
+        select(CardProgress.card_id).distinct().where(
+            CardProgress.media_type == "tv",
+            CardProgress.is_ongoing | CardProgress.total_episodes.is_(None),
+        )
+    )).scalars().all())
+    for i in range(0, len(card_ids), chunk):
+        await refresh(db, card_ids=card_ids[i:i + chunk])
+        await db.commit()
+    return len(card_ids)
@@ -0,0 +1,232 @@
+"""
+In-memory хранилище распарсенных категорий из RELEASES_DIR.
+
+Каждый <category>.json (gzip) декодируется один раз и держится в памяти.
+Файл перечитывается только при изменении mtime/size: watchdog-наблюдатель
+заранее перезагружает изменённые файлы в фоне, а get() дополнительно сверяет
+stat — на случай пропущенного события (например, на сетевых томах).
+
+Декодирование выполняется в пуле потоков (не блокирует event loop).
+Новая версия подменяет старую одной записью в dict — запрос всегда видит
+либо старую, либо новую категорию целиком, но никогда не половину файла.
+Если файл ещё дописывается и не парсится — остаётся предыдущая версия.
+"""
+import asyncio
+import gzip
+import json
+import logging
+from pathlib import Path
+from typing import Any, Callable, NamedTuple
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+RELEASES_DIR: Path = get_settings().releases_dir_path
+
+# Пауза перед перечиткой после события watchdog: NUMParser пишет файл
+# несколькими write(), ждём пока поток событий утихнет.
+_RELOAD_DEBOUNCE_SEC = 1.0
+
+
+class _Entry(NamedTuple):
+    mtime_ns: int
+    size: int
+    data: Any
+
+
+_entries: dict[str, _Entry] = {}
+# Категории, чей файл не удалось распарсить и предыдущей версии нет
+_failed: set[str] = set()
+_locks: dict[str, asyncio.Lock] = {}
+_pending: dict[str, asyncio.TimerHandle] = {}
+_listeners: list[Callable[[str, Any], None]] = []
+_observer = None
+_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _path(category: str) -> Path:
+    return RELEASES_DIR / f"{category}.json"
+
+
+def _stat(path: Path) -> tuple[int, int] | None:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _decode(path: Path) -> Any:
+    with gzip.open(path, "rt") as f:
+        return json.load(f)
+
+
+def _is_fresh(entry: _Entry | None, st: tuple[int, int]) -> bool:
+    return entry is not None and (entry.mtime_ns, entry.size) == st
+
+
+def add_listener(callback: Callable[[str, Any], None]) -> None:
+    """Подписка на смену версии категории: callback(category, data | None).
+
+    Вызывается в event loop сразу после подмены (None — файл удалён).
+    """
+    _listeners.append(callback)
+
+
+def _notify(category: str, data: Any) -> None:
+    for cb in _listeners:
+        try:
+            cb(category, data)
+        except Exception as e:
+            logger.error(f"category_store listener {cb!r}: {e}")
+
+
+def _drop(category: str) -> None:
+    _failed.discard(category)
+    if _entries.pop(category, None) is not None:
+        _notify(category, None)
+
+
+def peek(category: str) -> Any | None:
+    """Текущая версия категории в памяти без обращения к диску."""
+    entry = _entries.get(category)
+    return entry.data if entry else None
+
+
+def loaded() -> list[str]:
+    """Категории, уже загруженные в память."""
+    return list(_entries)
+
+
+def failed() -> list[str]:
+    """Категории, которые не загрузились (битый файл) — ждут следующей версии файла."""
+    return list(_failed)
+
+
+async def _load(category: str) -> Any | None:
+    """Перечитывает категорию, если файл изменился. Возвращает актуальные данные или None."""
+    path = _path(category)
+    lock = _locks.setdefault(category, asyncio.Lock())
+    async with lock:
+        st = _stat(path)
+        if st is None:
+            _drop(category)
+            return None
+        entry = _entries.get(category)
+        if _is_fresh(entry, st):
+            return entry.data  # перечитал конкурентный запрос
+        try:
+            data = await asyncio.to_thread(_decode, path)
+        except Exception as e:
+            if entry is not None:
+                logger.warning(f"Категория {category}: файл не читается ({e}), отдаю предыдущую версию")
+                return entry.data
+            logger.error(f"Ошибка загрузки файла {path}: {e}")
+            _failed.add(category)
+            raise
+        # stat после чтения: если файл успели переписать — следующий get() перечитает
+        _entries[category] = _Entry(st[0], st[1], data)
+        _failed.discard(category)
+        logger.debug(f"Категория {category} загружена в память")
+        _notify(category, data)
+        return data
+
+
+async def get(category: str) -> Any | None:
+    """Распарсенное содержимое категории или None, если файла нет."""
+    st = _stat(_path(category))
+    if st is None:
+        _drop(category)
+        return None
+    entry = _entries.get(category)
+    if _is_fresh(entry, st):
+        return entry.data
+    return await _load(category)
+
+
+def categories() -> list[str]:
+    """Имена доступных категорий (по файлам на диске)."""
+    if not RELEASES_DIR or not RELEASES_DIR.exists():
+        return []
+    return [p.stem for p in RELEASES_DIR.glob("*.json")]
+
+
+def info() -> dict:
+    return {"categories": len(_entries), "failed": len(_failed)}
+
+
+# ---------------------------------------------------------------------------
+# watchdog: фоновая перезагрузка изменённых файлов
+# ---------------------------------------------------------------------------
+
+async def _reload(category: str) -> None:
+    _pending.pop(category, None)
+    try:
+        await _load(category)
+    except Exception:
+        pass  # уже залогировано в _load, следующий get() попробует снова
+
+
+def _schedule_reload(category: str) -> None:
+    """Вызывается в event loop; откладывает перечитку на _RELOAD_DEBOUNCE_SEC."""
+    handle = _pending.pop(category, None)
+    if handle:
+        handle.cancel()
+    _pending[category] = _loop.call_later(
+        _RELOAD_DEBOUNCE_SEC, lambda: asyncio.ensure_future(_reload(category))
+    )
+
+
+def _on_fs_event(src_path: str) -> None:
+    """Вызывается из потока watchdog."""
+    path = Path(src_path)
+    if path.suffix != ".json" or path.parent != RELEASES_DIR:
+        return
+    if _loop is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_schedule_reload, path.stem)
+
+
+def start() -> None:
+    """Прогрев и наблюдение за RELEASES_DIR. Вызывается из lifespan."""
+    global _observer, _loop
+    if _observer is not None or not RELEASES_DIR or not RELEASES_DIR.exists():
+        return
+
+    # Прогрев: декодируем все категории в фоне, не задерживая старт
+    for category in categories():
+        asyncio.ensure_future(_reload(category))
+
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        logger.warning("watchdog не установлен — категории проверяются только по stat при запросе")
+        return
+
+    class _Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory:
+                return
+            _on_fs_event(event.src_path)
+            dest = getattr(event, "dest_path", None)
+            if dest:
+                _on_fs_event(dest)
+
+    _loop = asyncio.get_running_loop()
+    _observer = Observer()
+    _observer.schedule(_Handler(), str(RELEASES_DIR), recursive=False)
+    _observer.daemon = True
+    _observer.start()
+    logger.info(f"Наблюдение за {RELEASES_DIR} запущено")
+
+
+def stop() -> None:
+    global _observer
+    for handle in _pending.values():
+        handle.cancel()
+    _pending.clear()
+    if _observer is not None:
+        _observer.stop()
+        _observer.join(timeout=5)
+        _observer = None
@@ -22,6 +22,11 @@ class Settings(BaseSettings):
     ADMIN_USERNAMES: str = ""
 
     TMDB_TOKEN: str
+    # Базовый URL TMDB API (можно направить на локальный stub для тестов)
+    TMDB_API_URL: str = "https://api.themoviedb.org/3"
+    # Ограничения общего TMDB-клиента: запросов в секунду и одновременно
+    TMDB_MAX_RPS: float = 40
+    TMDB_MAX_CONCURRENCY: int = 20
     MYSHOWS_API: str
     MYSHOWS_AUTH_URL: str
 
@@ -58,6 +63,10 @@ class Settings(BaseSettings):
     IMAGE_PROXY_USER: str = ""
     IMAGE_PROXY_PASS: str = ""
 
+    # Redis для рассылки WebSocket-сообщений между воркерами (redis://host:6379/0).
+    # Пусто — рассылка внутри одного процесса
+    REDIS_URL: str = ""
+
     @property
     def releases_dir_path(self) -> Path:
         p = Path(self.RELEASES_DIR)
@@ -0,0 +1,92 @@
+"""
+Массовый UPSERT для импортов (Lampac, Lampa, MyShows).
+
+Небольшие пачки идут обычным INSERT ... VALUES ... ON CONFLICT, нарезанным
+так, чтобы не упереться в лимит asyncpg 32767 параметров на запрос.
+Большие — через COPY во временную staging-таблицу и один
+INSERT ... SELECT ... ON CONFLICT: без гигантской SQL-строки и без
+тысяч параметров, время почти линейно по числу строк.
+
+Обе ветки строят одинаковое ON CONFLICT DO UPDATE — set_ получает
+`excluded` и возвращает словарь колонок, как в on_conflict_do_update.
+Строки должны быть дедуплицированы по index_elements (ON CONFLICT
+не обновляет одну строку дважды за запрос).
+"""
+import itertools
+import logging
+from typing import Any, Callable
+
+from sqlalchemy import column, select, table, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+_MAX_PARAMS = 32767
+# С какого размера пачки выгоднее COPY + staging
+_COPY_MIN_ROWS = 2000
+
+_stage_seq = itertools.count(1)
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+async def _copy_upsert(
+    db: AsyncSession,
+    model: Any,
+    rows: list[dict],
+    columns: list[str],
+    index_elements: list[str],
+    set_: Callable[[Any], dict],
+) -> None:
+    tbl = model.__table__
+    stage = f"_stage_{tbl.name}_{next(_stage_seq)}"
+    cols_sql = ", ".join(_quote(c) for c in columns)
+
+    conn = await db.connection()
+    # Типы колонок — как в целевой таблице; таблица живёт до конца транзакции
+    await conn.execute(text(
+        f"CREATE TEMP TABLE {stage} ON COMMIT DROP AS "
+        f"SELECT {cols_sql} FROM {_quote(tbl.name)} WITH NO DATA"
+    ))
+    raw = await conn.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(
+        stage,
+        records=(tuple(r[c] for c in columns) for r in rows),
+        columns=columns,
+    )
+
+    src = table(stage, *(column(c) for c in columns))
+    stmt = pg_insert(model).from_select(columns, select(*(src.c[c] for c in columns)))
+    stmt = stmt.on_conflict_do_update(index_elements=index_elements, set_=set_(stmt.excluded))
+    await db.execute(stmt)
+    await conn.execute(text(f"DROP TABLE {stage}"))
+
+
+async def bulk_upsert(
+    db: AsyncSession,
+    model: Any,
+    rows: list[dict],
+    index_elements: list[str],
+    set_: Callable[[Any], dict],
+) -> int:
+    """UPSERT строк в таблицу модели (без commit). Возвращает число строк.
+
+    rows — словари с одинаковым набором ключей; set_(excluded) → SET для ON CONFLICT.
+    """
+    if not rows:
+        return 0
+    columns = list(rows[0])
+
+    if len(rows) >= _COPY_MIN_ROWS:
+        await _copy_upsert(db, model, rows, columns, index_elements, set_)
+        return len(rows)
+
+    chunk_size = max(1, _MAX_PARAMS // len(columns))
+    for i in range(0, len(rows), chunk_size):
+        stmt = pg_insert(model).values(rows[i:i + chunk_size])
+        stmt = stmt.on_conflict_do_update(index_elements=index_elements, set_=set_(stmt.excluded))
+        await db.execute(stmt)
+    return len(rows)
@@ -1,4 +1,5 @@
 from sqlalchemy import (
+    ARRAY,
     Column,
     Integer,
     BigInteger,
@@ -10,6 +11,7 @@ from sqlalchemy import (
     Float,
     ForeignKey,
     UniqueConstraint,
+    Index,
     Text,
     JSON,
 )
@@ -131,6 +133,10 @@ class Timecode(Base):
     card_id = Column(String(100), nullable=False, index=True)  # "{tmdb_id}_movie" или "_tv"
     item = Column(String(100), nullable=False, index=True)     # хэш эпизода/фильма (lampa_hash)
     data = Column(Text, nullable=False)                        # JSON: {duration, time, percent}
+    # Типизированные копии полей data — для фильтров в SQL без разбора JSON
+    percent = Column(Float, nullable=True)
+    time = Column(Float, nullable=True)        # сек
+    duration = Column(Float, nullable=True)    # сек
     counted_at = Column(Date, nullable=True)   # дата последнего засчитанного просмотра (лимит 1/день)
     view_count = Column(Integer, nullable=False, default=0, server_default="0")  # кол-во просмотров этого item
     updated_at = Column(
@@ -142,12 +148,142 @@ class Timecode(Base):
             "device_id", "lampa_profile_id", "card_id", "item",
             name="uq_timecode_unique"
         ),
+        # «Просмотрено / не досмотрено» по профилю — index-only scan
+        Index(
+            "ix_timecode_profile_percent",
+            "device_id", "lampa_profile_id", "percent",
+            postgresql_include=["card_id", "item"],
+        ),
     )
 
     def __repr__(self):
         return f"<Timecode(device_id={self.device_id}, card_id={self.card_id}, item={self.item})>"
 
 
+class CardProgress(Base):
+    """Сводный прогресс карточки в профиле — для истории и «Продолжить просмотр».
+    Пересчитывается app/card_progress.py при записи таймкодов и синхронизации эпизодов."""
+
+    __tablename__ = "card_progress"
+
+    device_id        = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), primary_key=True)
+    lampa_profile_id = Column(String(100), primary_key=True, server_default="")
+    card_id          = Column(String(100), primary_key=True)
+    media_type       = Column(String(10), nullable=False)       # "movie" | "tv"
+    last_watched     = Column(DateTime(timezone=True), nullable=True)  # max(timecodes.updated_at)
+    max_percent      = Column(Float, nullable=False, default=0, server_default="0")
+    watched_episodes = Column(Integer, nullable=True)            # только сериалы
+    total_episodes   = Column(Integer, nullable=True)            # вышедших серий
+    # Сериалы: [k-1] — вышедших серий с процентом >= k (хвост нулей отброшен) —
+    # «Продолжить просмотр» с порогом запроса (min_progress / watched_threshold)
+    watched_by_pct   = Column(ARRAY(Integer), nullable=True)
+    is_complete      = Column(Boolean, nullable=False, default=False, server_default="false")
+    is_ongoing       = Column(Boolean, nullable=False, default=False, server_default="false")
+
+    __table_args__ = (
+        # История / «Продолжить просмотр» профиля — по убыванию last_watched
+        Index("ix_card_progress_recent", "device_id", "lampa_profile_id", "last_watched"),
+        # Пересчёт по карточке у всех профилей (MediaCard, эпизоды)
+        Index("ix_card_progress_card", "card_id"),
+    )
+
+    def __repr__(self):
+        return f"<CardProgress(device_id={self.device_id}, card_id={self.card_id})>"
+
+
+class PopularCard(Base):
+    """Рейтинг «Популярно в NP» — пересобирается фоном (app/popular.py), читается по rank."""
+
+    __tablename__ = "np_popular"
+
+    card_id      = Column(String(100), primary_key=True)
+    media_type   = Column(String(10), nullable=False)   # "movie" | "tv"
+    weight       = Column(Float, nullable=False)         # трендовый счёт (сериалы — на серию)
+    last_counted = Column(Date, nullable=True)           # дата card_trending.scored_at
+    rank         = Column(Integer, nullable=False, index=True)  # 1 — самая популярная
+
+    def __repr__(self):
+        return f"<PopularCard(card_id={self.card_id}, rank={self.rank})>"
+
+
+class CardTrending(Base):
+    """Трендовый счёт карточки — затухающая сумма засчитанных просмотров (app/trending.py)."""
+
+    __tablename__ = "card_trending"
+
+    card_id   = Column(String(100), primary_key=True)
+    score     = Column(Float, nullable=False, default=0, server_default="0")  # на момент scored_at
+    scored_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return f"<CardTrending(card_id={self.card_id}, score={self.score})>"
+
+
+class ProfileChangeSeq(Base):
+    """Счётчик журнала изменений профиля (user_id, lampa_profile_id) — app/profile_changes.py."""
+
+    __tablename__ = "profile_change_seq"
+
+    user_id          = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    lampa_profile_id = Column(String(100), primary_key=True, server_default="")
+    seq              = Column(BigInteger, nullable=False, default=0, server_default="0")  # последний номер
+    floor            = Column(BigInteger, nullable=False, default=0, server_default="0")  # since < floor — полная синхронизация
+
+    def __repr__(self):
+        return f"<ProfileChangeSeq(user_id={self.user_id}, profile={self.lampa_profile_id!r}, seq={self.seq})>"
+
+
+class ProfileChange(Base):
+    """Запись журнала изменений профиля: что изменилось, без самих данных (они читаются текущими)."""
+
+    __tablename__ = "profile_changes"
+
+    id               = Column(BigInteger, primary_key=True)
+    user_id          = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    lampa_profile_id = Column(String(100), nullable=False, server_default="")
+    seq              = Column(BigInteger, nullable=False)
+    # NULL — изменение всех устройств пользователя (настройки плагинов)
+    device_id        = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=True)
+    kind             = Column(String(20), nullable=False)   # "timecode" | "favorite" | "plugin_setting"
+    ref              = Column(String(100), nullable=False, server_default="")  # card_id / plugin
+    item             = Column(Text, nullable=False, server_default="")         # item / ключ настройки
+    created_at       = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_profile_changes_seq", "user_id", "lampa_profile_id", "seq"),
+        Index("ix_profile_changes_created", "created_at"),
+    )
+
+    def __repr__(self):
+        return f"<ProfileChange(user_id={self.user_id}, seq={self.seq}, kind={self.kind})>"
+
+
+class ImportJob(Base):
+    """Фоновый импорт таймкодов (Lampac / Lampa JSON). Тело лежит во временном файле до завершения."""
+
+    __tablename__ = "import_jobs"
+
+    id               = Column(Integer, primary_key=True, index=True)
+    device_id        = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False, index=True)
+    lampa_profile_id = Column(String(100), nullable=False, default="", server_default="")
+    kind             = Column(String(20), nullable=False)   # "lampac" | "lampa"
+    # queued → running → done | error
+    status           = Column(String(20), nullable=False, default="queued", server_default="queued")
+    file             = Column(String(100), nullable=False)  # имя файла в каталоге import_jobs
+    total_bytes      = Column(BigInteger, nullable=False, default=0, server_default="0")
+    processed_bytes  = Column(BigInteger, nullable=False, default=0, server_default="0")
+    saved            = Column(Integer, nullable=False, default=0, server_default="0")
+    trimmed          = Column(Integer, nullable=False, default=0, server_default="0")
+    error            = Column(Text, nullable=True)
+    created_at       = Column(DateTime(timezone=True), server_default=func.now())
+    # Пульс running-задачи: обновляется с прогрессом; давно не менялся — воркер умер
+    updated_at       = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    finished_at      = Column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<ImportJob(id={self.id}, device_id={self.device_id}, status={self.status})>"
+
+
 class MediaCard(Base):
     """Базовые TMDB-метаданные для карточек истории просмотра."""
 
@@ -0,0 +1,187 @@
+"""
+Общий (per-process) реестр вышедших эпизодов сериалов.
+
+tmdb_show_id → вышедшие неспешловые эпизоды (season, episode) и frozenset их
+lampa-хэшей. Хэши берутся из episodes.hash (посчитаны в sync_episodes по
+media_cards.original_title); для другого оригинального названия считаются
+один раз и запоминаются. Проверка «сериал досмотрен» сводится к
+`aired_hashes <= watched_hashes` — одна и та же для всех пользователей.
+
+Шоу подгружаются из БД одним запросом на пачку (load); sync_episodes
+кладёт свежие эпизоды сразу (put), прочие записи в таблицу episodes
+сбрасывают шоу (invalidate). «Вышедшие» пересчитываются при смене даты.
+
+Fallback без таблицы episodes — TMDB seasons + last_episode_to_air —
+мемоизируется в tmdb_aired_hashes().
+"""
+import logging
+import time
+from collections import OrderedDict
+from datetime import date
+from functools import lru_cache
+from typing import Iterable
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import Episode, MediaCard
+from app.utils import lampa_hash, build_episode_hash_string
+
+logger = logging.getLogger(__name__)
+
+_MAX_SHOWS = 20000
+# Страховка от записей в episodes мимо реестра (миграции, ручные правки)
+_TTL_SEC = 6 * 3600
+
+
+class _Show:
+    __slots__ = ("title", "rows", "loaded_at", "_day", "_aired", "_hashes")
+
+    def __init__(self, title: str, rows: list[tuple[int, int, date | None, str | None]]):
+        self.title = title          # original_title, по которому посчитан episodes.hash
+        self.rows = sorted(rows)    # (season, episode, air_date, hash), только неспешловые
+        self.loaded_at = time.monotonic()
+        self._day: date | None = None
+        self._aired: tuple[tuple[int, int], ...] = ()
+        self._hashes: dict[str, frozenset[str]] = {}
+
+    def _refresh(self) -> None:
+        today = date.today()
+        if self._day == today:
+            return
+        aired = tuple(
+            (s, e) for s, e, air, _ in self.rows
+            if air is None or air <= today
+        )
+        if aired != self._aired or self._day is None:
+            self._aired = aired
+            self._hashes = {}
+            stored = [h for s, e, air, h in self.rows if (air is None or air <= today)]
+            # episodes.hash посчитан по названию на момент синхронизации —
+            # доверяем ему, только если выборочная проверка совпала с текущим title
+            if stored and all(stored) and stored[0] == lampa_hash(
+                build_episode_hash_string(aired[0][0], aired[0][1], self.title)
+            ):
+                self._hashes[self.title] = frozenset(stored)
+        self._day = today
+
+    def aired(self) -> tuple[tuple[int, int], ...]:
+        self._refresh()
+        return self._aired
+
+    def aired_hashes(self, original_title: str) -> frozenset[str]:
+        self._refresh()
+        hashes = self._hashes.get(original_title)
+        if hashes is None:
+            hashes = frozenset(
+                lampa_hash(build_episode_hash_string(s, e, original_title))
+                for s, e in self._aired
+            )
+            self._hashes[original_title] = hashes
+        return hashes
+
+
+_shows: "OrderedDict[int, _Show]" = OrderedDict()
+
+
+def _store(tmdb_id: int, show: _Show) -> None:
+    _shows[tmdb_id] = show
+    _shows.move_to_end(tmdb_id)
+    while len(_shows) > _MAX_SHOWS:
+        _shows.popitem(last=False)
+
+
+def _get(tmdb_id: int) -> _Show | None:
+    show = _shows.get(tmdb_id)
+    if show is not None and time.monotonic() - show.loaded_at >= _TTL_SEC:
+        del _shows[tmdb_id]
+        return None
+    return show
+
+
+async def load(db: AsyncSession, tmdb_ids: Iterable[int]) -> None:
+    """Подгружает в реестр шоу, которых в нём ещё нет (один запрос на всю пачку)."""
+    missing = {tid for tid in tmdb_ids if _get(tid) is None}
+    if not missing:
+        return
+
+    titles: dict[int, str] = {}
+    mc_rows = await db.execute(
+        select(MediaCard.tmdb_id, MediaCard.original_title).where(
+            MediaCard.tmdb_id.in_(missing), MediaCard.media_type == "tv"
+        )
+    )
+    for tid, orig in mc_rows.all():
+        titles[tid] = orig or ""
+
+    rows: dict[int, list] = {tid: [] for tid in missing}
+    ep_rows = await db.execute(
+        select(Episode.tmdb_show_id, Episode.season, Episode.episode, Episode.air_date, Episode.hash)
+        .where(
+            Episode.tmdb_show_id.in_(missing),
+            Episode.is_special == False,  # noqa: E712
+            Episode.season > 0,
+        )
+    )
+    for tid, s, e, air, h in ep_rows.all():
+        rows[tid].append((s, e, air, h))
+
+    for tid in missing:
+        _store(tid, _Show(titles.get(tid, ""), rows[tid]))
+
+
+def put(tmdb_id: int, original_title: str, episode_rows: list[dict]) -> None:
+    """Кладёт свежесинхронизированные эпизоды шоу (строки как для pg_insert(Episode))."""
+    _store(tmdb_id, _Show(original_title or "", [
+        (r["season"], r["episode"], r.get("air_date"), r.get("hash"))
+        for r in episode_rows
+        if not r.get("is_special") and (r.get("season") or 0) > 0
+    ]))
+
+
+def invalidate(tmdb_ids: Iterable[int]) -> None:
+    for tid in tmdb_ids:
+        _shows.pop(tid, None)
+
+
+def aired(tmdb_id: int) -> tuple[tuple[int, int], ...]:
+    """Вышедшие неспешловые эпизоды шоу; () — нет данных (или шоу не загружено)."""
+    show = _shows.get(tmdb_id)
+    return show.aired() if show is not None else ()
+
+
+def aired_hashes(tmdb_id: int, original_title: str) -> frozenset[str] | None:
+    """Хэши вышедших эпизодов; None — в таблице episodes нет данных по шоу."""
+    show = _shows.get(tmdb_id)
+    if show is None or not show.aired():
+        return None
+    return show.aired_hashes(original_title)
+
+
+@lru_cache(maxsize=8192)
+def tmdb_aired_hashes(
+    original_title: str,
+    seasons: tuple[tuple[int, int], ...],
+    last_season: int,
+    last_episode: int,
+) -> frozenset[str]:
+    """Хэши вышедших эпизодов по данным TMDB: seasons = ((season_number, episode_count), ...).
+
+    last_season/last_episode — last_episode_to_air (0, 0 — нет данных: все эпизоды сезонов).
+    """
+    hashes = set()
+    if last_season:
+        season_ep_count = dict(seasons)
+        for sn in range(1, last_season + 1):
+            ep_count = last_episode if sn == last_season else season_ep_count.get(sn, 0)
+            for ep in range(1, ep_count + 1):
+                hashes.add(lampa_hash(build_episode_hash_string(sn, ep, original_title)))
+    else:
+        for sn, ep_count in seasons:
+            for ep in range(1, ep_count + 1):
+                hashes.add(lampa_hash(build_episode_hash_string(sn, ep, original_title)))
+    return frozenset(hashes)
+
+
+def info() -> dict:
+    return {"shows": len(_shows), "tmdb_fallback": tmdb_aired_hashes.cache_info()._asdict()}
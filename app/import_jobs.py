@@ -0,0 +1,310 @@
+"""
+Очередь фоновых импортов таймкодов.
+
+POST /timecode/import/{lampac,lampa}?background=true не обрабатывает тело
+в запросе: оно пишется во временный файл, в import_jobs создаётся запись
+со статусом queued, а id задачи ставится сюда. _WORKERS воркеров разбирают
+файлы тем же потоковым импортом (timecodes.run_import_job) — одновременно
+идёт не больше _WORKERS импортов, каждый со своей сессией БД.
+
+Задачу забирает тот воркер (процесс), чей UPDATE ... WHERE status='queued'
+сработал первым, — при нескольких процессах одна задача не выполняется
+дважды. Прогресс (прочитано байт файла, сохранено таймкодов) пишется в
+строку задачи после каждой пачки и раз в _HEARTBEAT_SEC, так что SSE-эндпоинт
+любого процесса видит его из БД; процесс, выполняющий задачу, отдаёт его из памяти.
+
+Раз в _RESUME_SEC каждый процесс подбирает queued-задачи, а running-задачи
+без пульса дольше _STALE_SEC (процесс перезапустился или упал) возвращает
+в очередь: повторный UPSERT тех же таймкодов безопасен. Если файла уже нет —
+задача помечается ошибкой. Поэтому _SPOOL_DIR должен быть общим для всех
+процессов (воркеры uvicorn одного хоста или общий том).
+"""
+import asyncio
+import json
+import logging
+import secrets
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.database import async_session_maker
+from app.db.models import ImportJob
+
+logger = logging.getLogger(__name__)
+
+_WORKERS = 2
+_SPOOL_DIR = Path(tempfile.gettempdir()) / "movies-api-imports"
+_MAX_BYTES = 100 * 1024 * 1024
+_READ_CHUNK = 64 * 1024
+_KEEP_DAYS = 7
+_POLL_SEC = 0.5
+_HEARTBEAT_SEC = 30
+_STALE_SEC = 600
+_RESUME_SEC = 60
+
+ACTIVE = ("queued", "running")
+
+# (db, job, чанки файла, await progress(saved)) → {"saved", "trimmed"}
+Runner = Callable[
+    [AsyncSession, ImportJob, AsyncIterator[bytes], Callable[[int], Awaitable[None]]],
+    Awaitable[dict],
+]
+
+_run: Runner | None = None
+_queue: asyncio.Queue | None = None
+_workers: list[asyncio.Task] = []
+# id задач в локальной очереди — периодический подбор не ставит их повторно
+_enqueued: set[int] = set()
+# job_id → снимок состояния задачи, выполняемой этим процессом
+_progress: dict[int, dict] = {}
+_stats = {"done": 0, "failed": 0}
+
+
+class TooLarge(ValueError):
+    """Тело импорта больше _MAX_BYTES."""
+
+
+def _snapshot(job: ImportJob) -> dict:
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "total_bytes": job.total_bytes,
+        "processed_bytes": job.processed_bytes,
+        "saved": job.saved,
+        "trimmed": job.trimmed,
+        "error": job.error,
+    }
+
+
+async def spool(chunks: AsyncIterable[bytes]) -> tuple[str, int]:
+    """Пишет тело запроса во временный файл. Возвращает (имя файла, размер)."""
+    _SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    name = f"{secrets.token_hex(8)}.json"
+    path = _SPOOL_DIR / name
+    size = 0
+    try:
+        with path.open("wb") as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > _MAX_BYTES:
+                    raise TooLarge(f"тело импорта больше {_MAX_BYTES // (1024 * 1024)} МБ")
+                f.write(chunk)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return name, size
+
+
+def enqueue(job: ImportJob) -> None:
+    """Ставит сохранённую задачу в очередь воркеров этого процесса."""
+    if _queue is not None and job.id not in _enqueued:
+        _enqueued.add(job.id)
+        _queue.put_nowait(job.id)
+
+
+async def _read_file(path: Path, state: dict) -> AsyncIterator[bytes]:
+    with path.open("rb") as f:
+        while chunk := f.read(_READ_CHUNK):
+            state["processed_bytes"] += len(chunk)
+            yield chunk
+
+
+async def _finish(job_id: int, **values) -> None:
+    async with async_session_maker() as db:
+        await db.execute(
+            update(ImportJob)
+            .where(ImportJob.id == job_id)
+            .values(finished_at=datetime.now(timezone.utc), **values)
+        )
+        await db.commit()
+
+
+async def _save_progress(job_id: int, state: dict) -> None:
+    """Пишет прогресс в строку задачи (заодно обновляет пульс updated_at)."""
+    async with async_session_maker() as db:
+        await db.execute(
+            update(ImportJob)
+            .where(ImportJob.id == job_id, ImportJob.status == "running")
+            .values(processed_bytes=state["processed_bytes"], saved=state["saved"])
+        )
+        await db.commit()
+
+
+async def _heartbeat(job_id: int, state: dict) -> None:
+    """Пульс задачи, пока пачка долго догружает TMDB и прогресс не меняется."""
+    while True:
+        await asyncio.sleep(_HEARTBEAT_SEC)
+        try:
+            await _save_progress(job_id, state)
+        except Exception as e:
+            logger.warning(f"import_jobs: пульс задачи {job_id} не записан: {e}")
+
+
+async def _claim(db: AsyncSession, job_id: int) -> bool:
+    """Атомарно переводит задачу queued → running. False — её забрал другой воркер или процесс."""
+    claimed = (await db.execute(
+        update(ImportJob)
+        .where(ImportJob.id == job_id, ImportJob.status == "queued")
+        .values(status="running", processed_bytes=0)
+        .returning(ImportJob.id)
+    )).scalar_one_or_none()
+    await db.commit()
+    return claimed is not None
+
+
+async def _process(job_id: int) -> None:
+    async with async_session_maker() as db:
+        if not await _claim(db, job_id):
+            return
+        job = await db.get(ImportJob, job_id)
+        state = _progress[job_id] = _snapshot(job)
+        path = _SPOOL_DIR / job.file
+
+        async def progress(saved: int) -> None:
+            state["saved"] = saved
+            await _save_progress(job_id, state)
+
+        heartbeat = asyncio.create_task(_heartbeat(job_id, state))
+        # При отмене (остановка сервера) файл остаётся — задачу подберёт _resume
+        try:
+            if not path.exists():
+                raise RuntimeError("Файл импорта не найден (сервер перезапускался)")
+            result = await _run(db, job, _read_file(path, state), progress)
+            state.update(status="done", processed_bytes=state["total_bytes"], **result)
+            await _finish(
+                job_id, status="done",
+                processed_bytes=state["total_bytes"],
+                saved=result["saved"], trimmed=result["trimmed"],
+            )
+            _stats["done"] += 1
+        except Exception as e:
+            logger.error(f"import_jobs: задача {job_id} завершилась ошибкой: {e}")
+            await db.rollback()
+            state.update(status="error", error=str(e))
+            await _finish(job_id, status="error", error=str(e), saved=state["saved"])
+            _stats["failed"] += 1
+        finally:
+            heartbeat.cancel()
+            _progress.pop(job_id, None)
+    path.unlink(missing_ok=True)
+
+
+async def _worker() -> None:
+    while True:
+        job_id = await _queue.get()
+        _enqueued.discard(job_id)
+        try:
+            await _process(job_id)
+        except Exception as e:
+            logger.error(f"import_jobs: не удалось обработать задачу {job_id}: {e}")
+
+
+async def _resume() -> None:
+    """Подбирает queued-задачи и running без пульса, чистит старые завершённые."""
+    now = datetime.now(timezone.utc)
+    async with async_session_maker() as db:
+        await db.execute(
+            delete(ImportJob).where(
+                ImportJob.status.notin_(ACTIVE),
+                ImportJob.created_at < now - timedelta(days=_KEEP_DAYS),
+            )
+        )
+        stale = (await db.execute(
+            update(ImportJob)
+            .where(
+                ImportJob.status == "running",
+                func.coalesce(ImportJob.updated_at, ImportJob.created_at)
+                < now - timedelta(seconds=_STALE_SEC),
+            )
+            .values(status="queued")
+            .returning(ImportJob.id)
+        )).scalars().all()
+        jobs = (await db.execute(
+            select(ImportJob).where(ImportJob.status == "queued").order_by(ImportJob.id)
+        )).scalars().all()
+        await db.commit()
+    for job in jobs:
+        enqueue(job)
+    if stale:
+        logger.info(f"import_jobs: возобновлено {len(stale)} прерванных задач")
+
+
+async def _resume_loop() -> None:
+    while True:
+        try:
+            await _resume()
+        except Exception as e:
+            logger.error(f"import_jobs: ошибка подбора задач: {e}")
+        await asyncio.sleep(_RESUME_SEC)
+
+
+def start(run: Runner) -> None:
+    """Запускает воркеры. Вызывается из lifespan."""
+    global _run, _queue
+    _run = run
+    if _workers:
+        return
+    _queue = asyncio.Queue()
+    _workers.extend(asyncio.create_task(_worker()) for _ in range(_WORKERS))
+    _workers.append(asyncio.create_task(_resume_loop()))
+
+
+def stop() -> None:
+    for task in _workers:
+        task.cancel()
+    _workers.clear()
+    _enqueued.clear()
+
+
+async def status(job_id: int) -> dict | None:
+    """Состояние задачи: выполняемой этим процессом — из памяти, иначе из БД."""
+    state = _progress.get(job_id)
+    if state is not None:
+        return dict(state)
+    async with async_session_maker() as db:
+        job = await db.get(ImportJob, job_id)
+        return _snapshot(job) if job else None
+
+
+def _sse(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def events(job_id: int) -> AsyncIterator[str]:
+    """SSE-поток прогресса задачи до done/error (формат как у /myshows/sync)."""
+    last = None
+    while True:
+        state = await status(job_id)
+        if state is None:
+            yield _sse({"type": "error", "message": "Задача импорта не найдена"})
+            return
+        if state["status"] == "done":
+            trim_note = f" Удалено старых: {state['trimmed']} (превышен лимит)." if state["trimmed"] else ""
+            yield _sse({
+                "type": "done",
+                "saved": state["saved"],
+                "trimmed": state["trimmed"],
+                "message": f"Импортировано: {state['saved']}.{trim_note}",
+            })
+            return
+        if state["status"] == "error":
+            yield _sse({"type": "error", "message": state["error"] or "Ошибка импорта"})
+            return
+        if state != last:
+            yield _sse({"type": "progress", **state})
+            last = state
+        await asyncio.sleep(_POLL_SEC)
+
+
+def info() -> dict:
+    return {
+        "workers": _WORKERS if _workers else 0,
+        "queued": _queue.qsize() if _queue is not None else 0,
+        "active": len(_progress),
+        **_stats,
+    }
@@ -0,0 +1,120 @@
+"""
+Потоковый разбор JSON-объекта верхнего уровня.
+
+Импорты таймкодов приходят одним объектом {ключ: значение, ...} на мегабайты.
+iter_object_items читает тело кусками и отдаёт пары (ключ, значение) по одной:
+в памяти держится только текущее значение и непрочитанный хвост буфера,
+а не весь документ и дерево объектов. Сами значения разбирает стандартный
+json.JSONDecoder.raw_decode — отдельная зависимость (ijson) не нужна.
+"""
+import codecs
+import json
+from typing import Any, AsyncIterable, AsyncIterator
+
+_WS = " \t\n\r"
+# Что может идти сразу после числа: иначе число на границе куска прочитано
+# не целиком ("1." → 1, "1.5e" → 1.5)
+_AFTER_NUMBER = _WS + ",}]"
+# Значение верхнего уровня крупнее этого считается ошибкой — иначе
+# битое тело дочитывалось бы в буфер целиком
+_MAX_VALUE = 8 * 1024 * 1024
+
+_decoder = json.JSONDecoder()
+
+
+class JSONStreamError(ValueError):
+    """Тело не является корректным JSON-объектом."""
+
+
+class _Reader:
+    def __init__(self, chunks: AsyncIterable[bytes]):
+        self._chunks = chunks.__aiter__()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    async def more(self) -> bool:
+        """Дочитывает следующий кусок. False — тело закончилось."""
+        if self.eof:
+            return False
+        # Разобранное отбрасываем, чтобы буфер не рос вместе с телом
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        try:
+            try:
+                text = self._utf8.decode(await self._chunks.__anext__())
+            except StopAsyncIteration:
+                self.eof = True
+                text = self._utf8.decode(b"", final=True)
+        except UnicodeDecodeError as e:
+            raise JSONStreamError(f"некорректный UTF-8: {e}") from None
+        self.buf += text
+        return True
+
+    async def peek(self) -> str | None:
+        """Пропускает пробелы и возвращает следующий символ (None — конец тела)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WS:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not await self.more():
+                return None
+
+    async def expect(self, chars: str, what: str) -> str:
+        ch = await self.peek()
+        if ch is None or ch not in chars:
+            raise JSONStreamError(f"ожидалось {what}")
+        self.pos += 1
+        return ch
+
+    async def value(self) -> Any:
+        """Разбирает JSON-значение с текущей позиции (пробелы уже пропущены)."""
+        while True:
+            try:
+                val, end = _decoder.raw_decode(self.buf, self.pos)
+                # Число на границе куска могло прочитаться не полностью
+                complete = end < len(self.buf) and (
+                    not isinstance(val, (int, float)) or self.buf[end] in _AFTER_NUMBER
+                )
+                if complete or self.eof:
+                    self.pos = end
+                    return val
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise JSONStreamError(str(e)) from None
+            # Значение не поместилось — дочитываем, пока буфер не вырастет вдвое
+            # (повторный разбор с начала значения остаётся линейным в сумме)
+            need = 2 * (len(self.buf) - self.pos)
+            if need > 2 * _MAX_VALUE:
+                raise JSONStreamError("слишком большое значение")
+            while len(self.buf) - self.pos < need and await self.more():
+                pass
+
+
+async def iter_object_items(chunks: AsyncIterable[bytes]) -> AsyncIterator[tuple[str, Any]]:
+    """
+    Пары (ключ, значение) JSON-объекта из потока байтов, по мере чтения.
+    Дубликаты ключей отдаются как есть (json.loads оставил бы последний).
+    Бросает JSONStreamError на невалидном теле — возможно, после того как
+    часть пар уже отдана.
+    """
+    r = _Reader(chunks)
+    await r.expect("{", "JSON-объект")
+    if await r.peek() == "}":
+        r.pos += 1
+    else:
+        while True:
+            if await r.peek() != '"':
+                raise JSONStreamError("ожидался ключ-строка")
+            key = await r.value()
+            await r.expect(":", "':'")
+            if await r.peek() is None:
+                raise JSONStreamError("неожиданный конец тела")
+            yield key, await r.value()
+            if await r.expect(",}", "',' или '}'") == "}":
+                break
+    if await r.peek() is not None:
+        raise JSONStreamError("лишние данные после объекта")
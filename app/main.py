@@ -1,18 +1,15 @@
 import asyncio
-import gzip
 import json
 import logging
 import re
 import httpx
-from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from datetime import datetime, date as _date
+from datetime import datetime
 from math import ceil
 from pathlib import Path
-from typing import Any, Dict, Tuple
+from typing import NamedTuple
 from logging import DEBUG, INFO
 
-import requests
 from fastapi import FastAPI, Header, Query, status, Request, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
@@ -20,12 +17,12 @@ from fastapi.responses import JSONResponse, PlainTextResponse, HTMLResponse, Res
 from app.templates import get_templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
-from sqlalchemy import select, func, case, Float
+from sqlalchemy import select, func, and_, or_
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.db.database import init_db, async_session_maker
-from app.db.models import MediaCard, User, Timecode, Episode
+from app.db.models import MediaCard, User, Device
 from app.api.dependencies import get_current_user
 from app.config import get_settings
 from app.api import auth, myshows_sync, timecodes as timecodes_router
@@ -37,9 +34,25 @@ from app.api import episodes as episodes_router
 from app.api import plugin_settings as plugin_settings_router
 from app.admin import router as admin_router
 from app.api.dependencies import get_device_by_token
-from app.api.timecodes import load_device_timecodes, get_watched_movie_ids
-from app.utils import lampa_hash, build_episode_hash_string
 from app import settings_cache as _sc
+from app import category_store
+from app import search_index
+from app import timecode_cache
+from app import episode_registry
+from app import card_progress
+from app import popular
+from app import trending
+from app import token_cache
+from app import session_cache
+from app import timecode_writes
+from app import profile_changes
+from app import ws_broadcast
+from app import cache_bus
+from app.ws_manager import manager as ws_timecode_manager
+from app import tmdb_client
+from app import tmdb_cache
+from app import tmdb_enrich
+from app import import_jobs
 from app.db.database import get_db
 
 settings = get_settings()
@@ -47,14 +60,12 @@ settings = get_settings()
 from app import myshows
 from app import stats
 
-TMDB_TOKEN = settings.TMDB_TOKEN
 RELEASES_DIR = settings.releases_dir_path
 BANNED_PATTERNS = settings.banned_patterns_list
 
 # Получаем путь к директории, где находится текущий скрипт
 BASE_DIR = Path(__file__).parent.parent
 BLOCKED_JSON_PATH = BASE_DIR / "blocked.json"
-tmdb_cache: Dict[Tuple[str, int], Any] = None
 with open(BLOCKED_JSON_PATH, "r", encoding="utf-8") as f:
     BLOCKED_RESPONSE = json.load(f)
 
@@ -78,8 +89,6 @@ logging.getLogger("httpcore").setLevel(logging.WARNING)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Собственный обработчик жизненного цикла приложения"""
-    global tmdb_cache
-
     stats.init_stats()
 
     # === Startup ===
@@ -92,9 +101,6 @@ async def lifespan(app: FastAPI):
     async with async_session_maker() as _settings_db:
         await settings_cache.load(_settings_db)
 
-    # Загрузка TMDB-кэша из PostgreSQL
-    tmdb_cache = await load_cache_from_db()
-    logger.info(f"TMDB кэш загружен из БД, записей: {len(tmdb_cache)}")
     logger.info(f"Рабочая директория: {BASE_DIR}")
     logger.info(f"Директория с релизами: {RELEASES_DIR}")
 
@@ -126,9 +132,36 @@ async def lifespan(app: FastAPI):
     from app.tasks import start_tasks
     start_tasks()
 
+    # Категории из RELEASES_DIR: прогрев и перезагрузка по изменению файлов,
+    # поисковый индекс перестраивается вслед за каждой категорией
+    search_index.init(tmdb_cache.titles)
+    category_store.start()
+    # TMDB-кэш прогревается в фоне — запросы принимаются сразу (см. /ready)
+    tmdb_cache.start()
+    tmdb_enrich.start(fetch_tmdb_batch)
+    # Фоновые импорты таймкодов (?background=true)
+    import_jobs.start(timecodes_router.run_import_job)
+    # Трендовый счёт карточек: засчитанные просмотры пишутся в БД пачками
+    trending.start()
+    # Запись таймкодов из /timecode/ws микро-пачками
+    timecode_writes.start(timecodes_router.write_ws_batch)
+    # Статистика обращений копится в памяти и пишется пачками
+    stats.start()
+    # Рассылка WebSocket между воркерами (Redis, если задан REDIS_URL)
+    await ws_broadcast.start()
+
     yield  # Приложение работает
 
     # Shutdown
+    await ws_broadcast.stop()
+    await timecode_writes.stop()
+    await trending.stop()
+    await stats.stop()
+    import_jobs.stop()
+    tmdb_enrich.stop()
+    tmdb_cache.stop()
+    category_store.stop()
+    await tmdb_client.close()
     from app.tasks import stop_tasks
     stop_tasks()
     if settings.TELEGRAM_BOT_TOKEN:
@@ -232,91 +265,6 @@ def is_banned_origin(origin: str | None) -> bool:
 
 logger.debug("Настройки окружения загружены успешно")
 
-executor = ThreadPoolExecutor(max_workers=10)  # Пул потоков для запросов
-
-
-def _extract_tmdb_fields(media_type: str, data: dict) -> dict:
-    """Извлекает только нужные поля из полного ответа TMDB API для in-memory кэша."""
-    base = {
-        "poster_path": data.get("poster_path", ""),
-        "backdrop_path": data.get("backdrop_path", ""),
-        "overview": data.get("overview", ""),
-        "vote_average": data.get("vote_average", 0),
-    }
-    if media_type == "movie":
-        base.update(
-            {
-                "title": data.get("title", ""),
-                "original_title": data.get("original_title", ""),
-                "release_date": data.get("release_date", ""),
-            }
-        )
-    else:  # tv
-        base.update(
-            {
-                "name": data.get("name", ""),
-                "original_name": data.get("original_name", ""),
-                "first_air_date": data.get("first_air_date", ""),
-                "last_air_date": data.get("last_air_date", ""),
-                "number_of_seasons": data.get("number_of_seasons", 0),
-                "seasons": data.get("seasons", []),
-                "last_episode_to_air": data.get("last_episode_to_air"),
-            }
-        )
-    return base
-
-
-async def load_cache_from_db() -> Dict[Tuple[str, int], Any]:
-    """Загружает TMDB-кэш из таблицы media_cards."""
-    try:
-        async with async_session_maker() as db:
-            result = await db.execute(select(MediaCard))
-            rows = result.scalars().all()
-
-        cache: Dict[Tuple[str, int], Any] = {}
-        for mc in rows:
-            key = (mc.media_type, mc.tmdb_id)
-            if mc.media_type == "movie":
-                cache[key] = {
-                    "title": mc.title or "",
-                    "original_title": mc.original_title or "",
-                    "poster_path": mc.poster_path or "",
-                    "backdrop_path": mc.backdrop_path or "",
-                    "overview": mc.overview or "",
-                    "vote_average": mc.vote_average or 0,
-                    "release_date": mc.release_date or "",
-                }
-            else:  # tv
-                seasons = []
-                if mc.seasons_json:
-                    try:
-                        seasons = json.loads(mc.seasons_json)
-                    except Exception:
-                        pass
-                last_ep = None
-                if mc.last_ep_season and mc.last_ep_number:
-                    last_ep = {
-                        "season_number": mc.last_ep_season,
-                        "episode_number": mc.last_ep_number,
-                    }
-                cache[key] = {
-                    "name": mc.title or "",
-                    "original_name": mc.original_title or "",
-                    "poster_path": mc.poster_path or "",
-                    "backdrop_path": mc.backdrop_path or "",
-                    "overview": mc.overview or "",
-                    "vote_average": mc.vote_average or 0,
-                    "first_air_date": mc.release_date or "",
-                    "last_air_date": mc.last_air_date or "",
-                    "number_of_seasons": mc.number_of_seasons or 0,
-                    "seasons": seasons,
-                    "last_episode_to_air": last_ep,
-                }
-        return cache
-    except Exception as e:
-        logger.error(f"Ошибка загрузки TMDB кэша из БД: {e}")
-        return {}
-
 
 async def upsert_tmdb_cache(media_type: str, tmdb_id: int, data: dict) -> None:
     """Сохраняет TMDB-данные в media_cards (upsert)."""
@@ -430,51 +378,34 @@ def get_quality_text(video_quality: int) -> str:
     return ""
 
 
-def load_data(category: str):
-    """Загружает данные из файла в releases/"""
-    path = RELEASES_DIR / f"{category}.json"
-
-    if not path.exists():
+async def load_data(category: str):
+    """Данные категории из releases/ (распарсенные, из in-memory хранилища)"""
+    data = await category_store.get(category)
+    if data is None:
         raise HTTPException(status_code=404, detail="Not found")
-
-    try:
-        with gzip.open(path, "rt") as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Ошибка загрузки файла {path}: {str(e)}")
-        raise
+    return data
 
 
 async def fetch_tmdb_batch(requests_list: list) -> dict:
-    """Пакетный запрос к TMDB API"""
+    """Пакетный запрос к TMDB API (параллельно, через общий tmdb_client)"""
     results = {}
 
-    def make_request(media_type, tmdb_id):
+    async def make_request(media_type, tmdb_id):
         try:
-            url = f"https://api.themoviedb.org/3/{media_type}/{tmdb_id}"
-            headers = {"Authorization": TMDB_TOKEN}
-            params = {"language": "ru-RU"}
-            response = requests.get(url, headers=headers, params=params, timeout=5)
-            response.raise_for_status()
-            return (media_type, tmdb_id), response.json()
+            return (media_type, tmdb_id), await tmdb_client.details(media_type, tmdb_id)
         except Exception as e:
             logger.error(f"Ошибка запроса к TMDB {media_type}/{tmdb_id}: {str(e)}")
             return (media_type, tmdb_id), None
 
-    # Выполняем запросы в пуле потоков
-    loop = asyncio.get_running_loop()
-    futures = [
-        loop.run_in_executor(executor, make_request, media_type, tmdb_id)
-        for media_type, tmdb_id in requests_list
-    ]
-
-    for future in asyncio.as_completed(futures):
-        key, data = await future
+    for key, data in await asyncio.gather(
+        *(make_request(media_type, tmdb_id) for media_type, tmdb_id in requests_list)
+    ):
         if data:  # Сохраняем только успешные ответы
             media_type, tmdb_id = key
-            cleaned = _extract_tmdb_fields(media_type, data)
-            results[key] = cleaned
-            tmdb_cache[key] = cleaned
+            record = tmdb_cache.from_tmdb(media_type, data)
+            results[key] = record
+            tmdb_cache.put(key, record)
+            search_index.note_tmdb(media_type, tmdb_id, record)
             asyncio.create_task(upsert_tmdb_cache(media_type, tmdb_id, data))
 
     return results
@@ -596,14 +527,15 @@ def _item_card_id(item: dict) -> str | None:
 
 def _tv_show_watched(
     item: dict,
-    item_timecodes: dict[str, str],
+    item_percents: dict[str, float],
     threshold: int | None = None,
-    show_episodes: list[tuple[int, int]] | None = None,
+    tmdb_id: int | None = None,
 ) -> bool:
     """
     Проверяет, все ли нужные эпизоды сериала просмотрены.
 
-    Приоритет: show_episodes из таблицы episodes (MyShows, без спешлов).
+    Приоритет: вышедшие эпизоды из таблицы episodes (MyShows, без спешлов) —
+    из episode_registry (шоу должны быть подгружены через episode_registry.load).
     Fallback: TMDB seasons + last_episode_to_air.
     """
     if threshold is None:
@@ -613,67 +545,53 @@ def _tv_show_watched(
         return False
 
     # Хеши эпизодов с достаточным прогрессом
-    watched_hashes: set[str] = set()
-    for h, data_str in item_timecodes.items():
-        try:
-            if json.loads(data_str).get("percent", 0) >= threshold:
-                watched_hashes.add(h)
-        except (json.JSONDecodeError, TypeError):
-            pass
+    watched_hashes = {h for h, pct in item_percents.items() if pct >= threshold}
 
     # Приоритет: MyShows episodes table (только вышедшие, без спешлов)
-    if show_episodes:
-        for sn, ep in show_episodes:
-            h = lampa_hash(build_episode_hash_string(sn, ep, original_name))
-            if h not in watched_hashes:
-                return False
-        return True
+    aired = episode_registry.aired_hashes(tmdb_id, original_name) if tmdb_id else None
+    if aired:
+        return aired <= watched_hashes
 
     # Fallback: TMDB seasons + last_episode_to_air
-    seasons = [s for s in item.get("seasons", []) if s.get("season_number", 0) > 0]
+    seasons = tuple(
+        (s["season_number"], s.get("episode_count", 0))
+        for s in item.get("seasons", []) if s.get("season_number", 0) > 0
+    )
     if not seasons:
         return False
 
     last_ep = item.get("last_episode_to_air")
+    last_season = last_episode = 0
     if last_ep:
         last_season = last_ep.get("season_number", 0)
         last_episode = last_ep.get("episode_number", 0)
         if not last_season or not last_episode:
             return False
-        season_ep_count = {s["season_number"]: s["episode_count"] for s in seasons}
-        for sn in range(1, last_season + 1):
-            ep_count = last_episode if sn == last_season else season_ep_count.get(sn, 0)
-            for ep in range(1, ep_count + 1):
-                h = lampa_hash(build_episode_hash_string(sn, ep, original_name))
-                if h not in watched_hashes:
-                    return False
-    else:
-        for s in seasons:
-            sn = s["season_number"]
-            for ep in range(1, s.get("episode_count", 0) + 1):
-                if lampa_hash(build_episode_hash_string(sn, ep, original_name)) not in watched_hashes:
-                    return False
 
-    return True
+    return episode_registry.tmdb_aired_hashes(
+        original_name, seasons, last_season, last_episode
+    ) <= watched_hashes
 
 
 def _item_watched(
     item: dict,
-    timecodes: dict[str, dict[str, str]],
+    timecodes: dict[str, dict[str, float]],
     watched_movies: set[str],
     threshold: int | None = None,
-    episodes_by_show: dict[int, list[tuple[int, int]]] | None = None,
 ) -> bool:
-    """True если элемент уже полностью просмотрен и должен быть скрыт."""
+    """True если элемент уже полностью просмотрен и должен быть скрыт.
+
+    timecodes — {card_id: {item: percent}} (timecode_cache.Snapshot.percents).
+    """
     card_id = _item_card_id(item)
     if not card_id:
         return False
     if card_id.endswith("_tv"):
         if card_id not in timecodes:
             return False
-        tmdb_id = item.get("id")
-        show_eps = episodes_by_show.get(tmdb_id) if episodes_by_show and tmdb_id else None
-        return _tv_show_watched(item, timecodes[card_id], threshold=threshold, show_episodes=show_eps)
+        return _tv_show_watched(
+            item, timecodes[card_id], threshold=threshold, tmdb_id=int(card_id[:-3])
+        )
     return card_id in watched_movies
 
 
@@ -682,6 +600,29 @@ async def health_check():
     return {"status": "ok"}
 
 
+@app.get("/ready")
+async def readiness_check():
+    """Готовность к трафику: прогрет TMDB-кэш и загружены категории.
+
+    503 — пока идёт прогрев (для healthcheck / upstream nginx);
+    приложение при этом уже отвечает, промахи кэша идут в БД.
+    """
+    warm = tmdb_cache.warm_up_status()
+    available = len(category_store.categories())
+    loaded = len(category_store.loaded())
+    # Битый файл не держит 503: попытка загрузки завершена, категория ждёт новой версии
+    failed = len(category_store.failed())
+    ready = warm["state"] in ("done", "failed") and loaded + failed >= available
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "tmdb_cache": {**warm, "size": tmdb_cache.size()},
+            "categories": {"loaded": loaded, "failed": failed, "available": available},
+        },
+    )
+
+
 @app.get("/imgproxy/{path:path}")
 async def image_proxy(path: str):
     """Проксирует изображения TMDB через настроенный прокси-сервер."""
@@ -729,71 +670,38 @@ def _normalize_poster_path(path: str) -> str:
 
 @app.get("/api/search")
 async def api_search(q: str = Query(..., min_length=3)):
-    """Глобальный поиск по всем категориям."""
-    if not RELEASES_DIR or not RELEASES_DIR.exists():
-        return {"results": [], "total": 0}
-
+    """Глобальный поиск по всем категориям (по предпостроенному индексу)."""
     sq = q.strip().lower()
     PER_CAT = 5
 
-    def _search_file(path):
-        try:
-            with gzip.open(path, "rt") as f:
-                data = json.load(f)
-        except Exception as e:
-            logger.debug(f"_search_file {path}: {e}")
-            return []
-        cat_id   = path.stem
-        cat_name = _category_display_name(cat_id)
-
-        if isinstance(data, list):
-            items = data
-        elif "results" in data:
-            items = data["results"]
-        elif "items" in data:
-            items = data["items"]
-        else:
-            return []
+    # Дедупликация: один фильм может быть в нескольких категориях
+    groups = search_index.search(sq, PER_CAT)
+    records = await tmdb_cache.get_many(
+        key for _, matches in groups for _, key in matches if key is not None
+    )
 
-        found = []
-        for item in items:
+    seen: set[tuple] = set()
+    flat: list[dict] = []
+    for cat_id, matches in groups:
+        cat_name = _category_display_name(cat_id)
+        for item, key in matches:
+            src = records.get(key) or item
             tmdb_id    = item.get("id")
             media_type = item.get("media_type") or ("tv" if item.get("name") else "movie")
-            cached     = tmdb_cache.get((media_type, int(tmdb_id))) if tmdb_id else None
-            src        = cached or item
-            title  = src.get("title") or src.get("name") or ""
-            orig   = src.get("original_title") or src.get("original_name") or ""
-            if not title and not orig:
+            key = (tmdb_id, media_type)
+            if key in seen:
                 continue
-            if sq in title.lower() or sq in orig.lower():
-                found.append({
-                    "id":             tmdb_id,
-                    "media_type":     media_type,
-                    "title":          title,
-                    "original_title": orig,
-                    "poster_path":    _normalize_poster_path(src.get("poster_path") or ""),
-                    "year":           (src.get("release_date") or src.get("first_air_date") or "")[:4],
-                    "category_id":    cat_id,
-                    "category_name":  cat_name,
-                })
-                if len(found) >= PER_CAT:
-                    break
-        return found
-
-    loop = asyncio.get_event_loop()
-    tasks = [loop.run_in_executor(None, _search_file, p)
-             for p in RELEASES_DIR.glob("*.json")]
-    groups = await asyncio.gather(*tasks)
-
-    # Дедупликация: один фильм может быть в нескольких категориях
-    seen: set[tuple] = set()
-    flat: list[dict] = []
-    for group in groups:
-        for item in group:
-            key = (item["id"], item["media_type"])
-            if key not in seen:
-                seen.add(key)
-                flat.append(item)
+            seen.add(key)
+            flat.append({
+                "id":             tmdb_id,
+                "media_type":     media_type,
+                "title":          src.get("title") or src.get("name") or "",
+                "original_title": src.get("original_title") or src.get("original_name") or "",
+                "poster_path":    _normalize_poster_path(src.get("poster_path") or ""),
+                "year":           (src.get("release_date") or src.get("first_air_date") or "")[:4],
+                "category_id":    cat_id,
+                "category_name":  cat_name,
+            })
 
     flat.sort(key=lambda x: x["title"].lower())
     return {"results": flat[:100], "total": len(flat)}
@@ -811,9 +719,7 @@ async def api_categories():
 
     # 0. Виртуальные категории (без файла) — показываем только если есть данные
     async with async_session_maker() as _db:
-        has_popular = (await _db.execute(
-            select(func.count()).select_from(Timecode).where(Timecode.view_count > 0)
-        )).scalar() or 0
+        has_popular = await popular.exists(_db)
     if has_popular:
         result.append({"id": "np_popular", "name": "Популярно в NP"})
 
@@ -915,422 +821,436 @@ async def card_detail_page(
     })
 
 
-@app.get("/{category}")
-async def get_category(
+class _PendingPage(NamedTuple):
+    """Страница NUMParser-категории до обогащения TMDB (см. _enrich_pages)."""
+    page: int
+    per_page: int
+    total: int
+    items: list
+    next_items: list  # следующая страница — для фоновой предзагрузки TMDB
+
+
+async def _profile_context(
+    db: AsyncSession, token: str | None, profile_id: str | None, min_progress: int | None
+) -> tuple[Device | None, dict, set[str]]:
+    """Устройство и таймкоды профиля для фильтрации каталога — один раз на запрос."""
+    timecodes: dict = {}
+    watched_movies: set[str] = set()
+    device = None
+    if token:
+        device = await get_device_by_token(token=token, db=db)
+        if device:
+            # Снимок таймкодов профиля из памяти (БД — только при промахе)
+            snapshot = await timecode_cache.get_snapshot(db, device.id, profile_id or "")
+            timecodes = snapshot.percents
+            watched_movies = snapshot.watched_movies(min_progress)
+            # Эпизоды из MyShows для TV-шоу (приоритет над TMDB при фильтрации)
+            await episode_registry.load(db, snapshot.tv_tmdb_ids())
+    return device, timecodes, watched_movies
+
+
+async def _category_page(
     category: str,
     request: Request,
-    page: int = 1,
-    per_page: int = 20,
-    language: str = "ru",
-    token: str = Query(None),
-    profile_id: str = Query(None),
-    min_progress: int = Query(None, ge=1, le=100),
-    search: str = Query(None),
-    db: AsyncSession = Depends(get_db),
-):
-    if not re.match(r"^[\w\-]+$", category):
-        raise HTTPException(status_code=404, detail="Not found")
-
-    try:
-        logger.debug(
-            f"Запрос: {category}, страница {page}, token={'yes' if token else 'no'}"
-        )
-
-        # Загружаем таймкоды устройства (если передан token)
-        timecodes: dict = {}
-        watched_movies: set[str] = set()
-        episodes_by_show: dict[int, list[tuple[int, int]]] = {}
-        if token:
-            device = await get_device_by_token(token=token, db=db)
-            if device:
-                timecodes = await load_device_timecodes(db, device.id, profile_id or "")
-                watched_movies = get_watched_movie_ids(timecodes, threshold=min_progress)
-                # Загружаем эпизоды из MyShows для TV-шоу (приоритет над TMDB при фильтрации)
-                tv_tmdb_ids = [
-                    int(k[:-3]) for k in timecodes
-                    if k.endswith("_tv") and k[:-3].isdigit()
-                ]
-                if tv_tmdb_ids:
-                    from sqlalchemy import select as _select
-                    ep_rows = await db.execute(
-                        _select(Episode.tmdb_show_id, Episode.season, Episode.episode)
-                        .where(
-                            Episode.tmdb_show_id.in_(tv_tmdb_ids),
-                            Episode.is_special == False,  # noqa: E712
-                            Episode.season > 0,
-                            (Episode.air_date == None) | (Episode.air_date <= _date.today()),  # noqa: E711
-                        )
-                        .order_by(Episode.tmdb_show_id, Episode.season, Episode.episode)
-                    )
-                    for tid, s, e in ep_rows.all():
-                        episodes_by_show.setdefault(tid, []).append((s, e))
-
-        # ── "Продолжить просмотр" — незавершённые из таймкодов ──────────────────
-        if category == "continues" or category.startswith("continues_"):
-            if not token:
-                return {"results": [], "page": 1, "total_pages": 1, "total_results": 0}
-
-            media_filter = None
-            if category == "continues_movie":
-                media_filter = "movie"
-            elif category in ("continues_tv", "continues_anime"):
-                media_filter = "tv"
-            # continues — без фильтра, все типы
-
-            device = await get_device_by_token(token=token, db=db)
-            if not device:
-                return {"results": [], "page": 1, "total_pages": 1, "total_results": 0}
-
-            tc_where = [Timecode.device_id == device.id]
-            if profile_id is not None:
-                tc_where.append(Timecode.lampa_profile_id == profile_id)
-            tc_result = await db.execute(select(Timecode).where(*tc_where))
-            all_tc = tc_result.scalars().all()
-
-            # Группируем: card_id → {max_pct, last_watched, items}
-            agg: dict[str, dict] = {}
-            for tc in all_tc:
-                if not re.match(r"^\d+_(movie|tv)$", tc.card_id):
-                    continue
-                if media_filter and not tc.card_id.endswith(f"_{media_filter}"):
-                    continue
-                try:
-                    pct = float(json.loads(tc.data).get("percent", 0))
-                except Exception:
-                    pct = 0
-                if tc.card_id not in agg:
-                    agg[tc.card_id] = {"max_pct": pct, "last_watched": tc.updated_at, "items": {}}
-                else:
-                    if pct > agg[tc.card_id]["max_pct"]:
-                        agg[tc.card_id]["max_pct"] = pct
-                    if tc.updated_at and (
-                        not agg[tc.card_id]["last_watched"]
-                        or tc.updated_at > agg[tc.card_id]["last_watched"]
-                    ):
-                        agg[tc.card_id]["last_watched"] = tc.updated_at
-                agg[tc.card_id]["items"][tc.item] = max(
-                    agg[tc.card_id]["items"].get(tc.item, 0), pct
-                )
-
-            # Загружаем MediaCard для всех card_id (нужны seasons_json для сериалов)
-            mc_all_result = await db.execute(
-                select(MediaCard).where(MediaCard.card_id.in_(list(agg.keys())))
+    page: int,
+    per_page: int,
+    token: str | None,
+    profile_id: str | None,
+    min_progress: int | None,
+    search: str | None,
+    device: Device | None,
+    timecodes: dict,
+    watched_movies: set[str],
+    db: AsyncSession,
+) -> dict | _PendingPage:
+    """Страница категории: готовый ответ или _PendingPage (NUMParser), который
+    обогащается TMDB-данными отдельно — чтобы пакетный запрос делал это один раз."""
+    # ── "Продолжить просмотр" — незавершённые из таймкодов ──────────────────
+    if category == "continues" or category.startswith("continues_"):
+        if not token:
+            return {"results": [], "page": 1, "total_pages": 1, "total_results": 0}
+
+        media_filter = None
+        if category == "continues_movie":
+            media_filter = "movie"
+        elif category in ("continues_tv", "continues_anime"):
+            media_filter = "tv"
+        # continues — без фильтра, все типы
+
+        if not device:
+            return {"results": [], "page": 1, "total_pages": 1, "total_results": 0}
+
+        _thr = min_progress if min_progress is not None else _sc.get_int("watched_threshold")
+
+        # Прогресс карточек — из card_progress (пересчитывается при записи таймкодов).
+        # Незавершённые: сериал с известным числом вышедших серий — не все просмотрены
+        # с порогом _thr, остальное — max_percent ниже порога
+        cp = card_progress.grouped(device.id, profile_id, threshold=_thr)
+        where = [
+            or_(
+                and_(cp.c.total_episodes > 0, cp.c.watched_at_threshold < cp.c.total_episodes),
+                and_(func.coalesce(cp.c.total_episodes, 0) == 0, cp.c.max_percent < _thr),
             )
-            mc_map = {mc.card_id: mc for mc in mc_all_result.scalars().all()}
-
-            today_str = _date.today().isoformat()
-
-            def _is_unfinished(cid: str, v: dict) -> bool:
-                mc = mc_map.get(cid)
-                if cid.endswith("_tv") and mc and mc.seasons_json:
-                    try:
-                        seasons = json.loads(mc.seasons_json)
-                        last_s = mc.last_ep_season or 0
-                        last_e = mc.last_ep_number or 0
-                        total_aired = 0
-                        for s in seasons:
-                            snum = s.get("season_number") or 0
-                            if snum == 0:
-                                continue
-                            ep_count = s.get("episode_count") or 0
-                            if last_s > 0:
-                                if snum < last_s:
-                                    total_aired += ep_count
-                                elif snum == last_s:
-                                    total_aired += last_e
-                            else:
-                                s_air = s.get("air_date") or ""
-                                if s_air and s_air <= today_str:
-                                    total_aired += ep_count
-                        _thr = min_progress if min_progress is not None else _sc.get_int("watched_threshold")
-                        watched = sum(1 for p in v["items"].values() if p >= _thr)
-                        return watched < total_aired
-                    except Exception:
-                        pass
-                _thr = min_progress if min_progress is not None else _sc.get_int("watched_threshold")
-                return v["max_pct"] < _thr
-
-            unfinished = [
-                (cid, v["max_pct"], v["last_watched"])
-                for cid, v in agg.items()
-                if _is_unfinished(cid, v)
-            ]
-            unfinished.sort(key=lambda x: x[2] or datetime.min, reverse=True)
-
-            total = len(unfinished)
-            start = (page - 1) * per_page
-            page_items = unfinished[start : start + per_page]
-
-            if not page_items:
-                return {
-                    "results": [],
-                    "page": page,
-                    "total_pages": ceil(total / per_page) or 1,
-                    "total_results": total,
-                }
-
-            # mc_map уже загружен выше
-
-            results = []
-            for cid, pct, _ in page_items:
-                mc = mc_map.get(cid)
-                if not mc:
-                    continue
-                item: dict = {
-                    "id": mc.tmdb_id,
-                    "poster_path": mc.poster_path,
-                    "backdrop_path": mc.backdrop_path or "",
-                    "overview": mc.overview or "",
-                    "vote_average": mc.vote_average or 0,
-                }
-                if mc.media_type == "tv":
-                    item["name"] = mc.title
-                    item["original_name"] = mc.original_title
-                    item["first_air_date"] = mc.release_date or ""
-                    item["media_type"] = "tv"
-                else:
-                    item["title"] = mc.title
-                    item["original_title"] = mc.original_title
-                    item["release_date"] = mc.release_date or ""
-                    item["media_type"] = "movie"
-                results.append(item)
-
+        ]
+        if media_filter:
+            where.append(cp.c.media_type == media_filter)
+
+        total = await db.scalar(select(func.count()).select_from(cp).where(*where)) or 0
+        page_cards = (await db.execute(
+            select(MediaCard)
+            .join(cp, cp.c.card_id == MediaCard.card_id)
+            .where(*where)
+            .order_by(cp.c.last_watched.desc().nulls_last(), cp.c.card_id)
+            .offset((page - 1) * per_page)
+            .limit(per_page)
+        )).scalars().all()
+
+        if not page_cards:
             return {
-                "results": results,
+                "results": [],
                 "page": page,
                 "total_pages": ceil(total / per_page) or 1,
                 "total_results": total,
             }
 
-        # ── "Популярно в NP" — глобальный рейтинг просмотров ───────────────────
-        if category == "np_popular":
-            from datetime import timedelta
-            from app.api.timecodes import _media_card_to_entry
-            period = _sc.get_int("popular_period_days") or 30
-            cutoff = _date.today() - timedelta(days=period)
-
-            # Реальное кол-во серий: episodes (без спецвыпусков) → media_cards → COUNT(DISTINCT item)
-            ep_count_sq = (
-                select(Episode.tmdb_show_id, func.count().label("n_ep"))
-                .where(Episode.is_special == False)
-                .group_by(Episode.tmdb_show_id)
-            ).subquery()
-            # Фолбэк 3: COUNT(DISTINCT item) — уникальные серии из самих timecodes
-            actual_n_ep = func.count(func.distinct(Timecode.item))
-            effective_n_ep = func.coalesce(
-                ep_count_sq.c.n_ep,
-                MediaCard.number_of_episodes,
-                actual_n_ep,
-            )
+        results = []
+        for mc in page_cards:
+            item: dict = {
+                "id": mc.tmdb_id,
+                "poster_path": mc.poster_path,
+                "backdrop_path": mc.backdrop_path or "",
+                "overview": mc.overview or "",
+                "vote_average": mc.vote_average or 0,
+            }
+            if mc.media_type == "tv":
+                item["name"] = mc.title
+                item["original_name"] = mc.original_title
+                item["first_air_date"] = mc.release_date or ""
+                item["media_type"] = "tv"
+            else:
+                item["title"] = mc.title
+                item["original_title"] = mc.original_title
+                item["release_date"] = mc.release_date or ""
+                item["media_type"] = "movie"
+            results.append(item)
 
-            # Вес карточки: для фильмов = SUM(view_count),
-            # для сериалов = SUM(view_count) / effective_n_ep
-            _weight = case(
-                (MediaCard.media_type == "movie",
-                 func.sum(Timecode.view_count).cast(Float)),
-                else_=(func.sum(Timecode.view_count).cast(Float)
-                       / func.nullif(effective_n_ep, 0)),
-            )
-            weight_expr = _weight.label("weight")
+        return {
+            "results": results,
+            "page": page,
+            "total_pages": ceil(total / per_page) or 1,
+            "total_results": total,
+        }
 
-            pop_filter = [
-                Timecode.view_count > 0,
-                Timecode.counted_at >= cutoff,
-            ]
-            if search:
-                like = f"%{search}%"
-                pop_filter.append(
-                    MediaCard.title.ilike(like) | MediaCard.original_title.ilike(like)
-                )
-            base_q = (
-                select(Timecode.card_id, weight_expr)
-                .join(MediaCard, MediaCard.card_id == Timecode.card_id)
-                .outerjoin(ep_count_sq, ep_count_sq.c.tmdb_show_id == MediaCard.tmdb_id)
-                .where(*pop_filter)
-                .group_by(
-                    Timecode.card_id, MediaCard.media_type,
-                    ep_count_sq.c.n_ep, MediaCard.number_of_episodes,
-                )
-                .having(_weight > 0)
-                .order_by(_weight.desc(), func.max(Timecode.counted_at).desc())
-            )
-            total_pop = (
-                await db.execute(select(func.count()).select_from(base_q.subquery()))
-            ).scalar() or 0
-            pop_rows = (
-                await db.execute(
-                    base_q.offset((page - 1) * per_page).limit(per_page)
-                )
-            ).fetchall()
-            pop_ids = [r.card_id for r in pop_rows]
-            mc_map_pop = {
-                mc.card_id: mc
-                for mc in (
-                    await db.execute(select(MediaCard).where(MediaCard.card_id.in_(pop_ids)))
-                ).scalars().all()
-            } if pop_ids else {}
-            pop_results = []
-            for r in pop_rows:
-                mc = mc_map_pop.get(r.card_id)
-                if mc:
-                    entry = _media_card_to_entry(mc)
-                    entry["_np_views"] = round(r.weight, 2)
-                    pop_results.append(entry)
-            return {
-                "results": pop_results,
-                "page": page,
-                "total_pages": ceil(total_pop / per_page) if total_pop else 1,
-                "total_results": total_pop,
-            }
+    # ── "Популярно в NP" — глобальный рейтинг просмотров ───────────────────
+    if category == "np_popular":
+        from app.api.timecodes import _media_card_to_entry
+        # Рейтинг пересчитывается фоном (app/popular.py) — здесь только чтение по rank
+        pop_rows, total_pop = await popular.get_page(db, page, per_page, search)
+        pop_results = []
+        for mc, weight in pop_rows:
+            entry = _media_card_to_entry(mc)
+            entry["_np_views"] = round(weight, 2)
+            pop_results.append(entry)
+        return {
+            "results": pop_results,
+            "page": page,
+            "total_pages": ceil(total_pop / per_page) if total_pop else 1,
+            "total_results": total_pop,
+        }
 
-        # Загрузка данных из файла
-        data = load_data(category)
-
-        stats.track_api_user(request)
-        stats.track_category_request(request, category)
-
-        # ── Lampac-формат: {"results": [...]} или [...]  ─────────────────────
-        if "results" in data or isinstance(data, list):
-            items = data["results"] if "results" in data else data
-
-            if timecodes or watched_movies:
-
-                def _enrich_lampac_item(item: dict) -> dict:
-                    """Подмешивает поля из tmdb_cache нужные для фильтрации сериалов."""
-                    tmdb_id = item.get("id")
-                    if not tmdb_id:
-                        return item
-                    media_type = item.get("media_type")
-                    if not media_type:
-                        if (
-                            item.get("seasons") is not None
-                            or item.get("last_episode_to_air") is not None
-                        ):
-                            media_type = "tv"
-                        else:
-                            return item  # фильм
-                    if media_type != "tv":
-                        return item
-                    cached = tmdb_cache.get((media_type, int(tmdb_id)))
-                    if not cached:
-                        return item
-                    patch = {}
-                    if not item.get("original_name") and cached.get("original_name"):
-                        patch["original_name"] = cached["original_name"]
-                    if not item.get("seasons") and cached.get("seasons"):
-                        patch["seasons"] = cached["seasons"]
-                    if cached.get("last_episode_to_air"):
-                        patch["last_episode_to_air"] = cached["last_episode_to_air"]
-                    return {**item, **patch} if patch else item
-
-                items = [
-                    i
-                    for i in map(_enrich_lampac_item, items)
-                    if not _item_watched(i, timecodes, watched_movies, threshold=min_progress, episodes_by_show=episodes_by_show)
-                ]
-
-            if search:
-                sq = search.lower()
-                items = [i for i in items if sq in (i.get("title") or i.get("name") or "").lower()
-                         or sq in (i.get("original_title") or i.get("original_name") or "").lower()]
-
-            total = len(items)
-            start = (page - 1) * per_page
-            return {
-                "page": page,
-                "results": items[start : start + per_page],
-                "total_pages": ceil(total / per_page) if per_page else 1,
-                "total_results": total,
-            }
+    # Загрузка данных из файла
+    data = await load_data(category)
 
-        # ── NUMParser-формат: {"items": [...]} с обогащением TMDB  ───────────
-        if "items" not in data:
-            raise ValueError("Неизвестный формат данных")
+    stats.track_api_user(request)
+    stats.track_category_request(request, category)
 
-        all_items = data["items"]
+    # ── Lampac-формат: {"results": [...]} или [...]  ─────────────────────
+    if "results" in data or isinstance(data, list):
+        items = data["results"] if "results" in data else data
 
-        # Фильтруем ДО обогащения TMDB — экономим запросы к API
-        # Но подмешиваем last_episode_to_air из кэша для корректной фильтрации сериалов
         if timecodes or watched_movies:
+            tv_records = await tmdb_cache.get_many(
+                ("tv", int(i["id"])) for i in items
+                if i.get("id") and (
+                    i.get("media_type") == "tv"
+                    or (not i.get("media_type") and (
+                        i.get("seasons") is not None or i.get("last_episode_to_air") is not None
+                    ))
+                )
+            )
 
-            def _enrich_numparser_item(item: dict) -> dict:
-                if item.get("media_type") != "tv":
+            def _enrich_lampac_item(item: dict) -> dict:
+                """Подмешивает поля из tmdb_cache нужные для фильтрации сериалов."""
+                tmdb_id = item.get("id")
+                if not tmdb_id:
                     return item
-                cached = (
-                    tmdb_cache.get(("tv", int(item["id"]))) if item.get("id") else None
-                )
+                media_type = item.get("media_type")
+                if not media_type:
+                    if (
+                        item.get("seasons") is not None
+                        or item.get("last_episode_to_air") is not None
+                    ):
+                        media_type = "tv"
+                    else:
+                        return item  # фильм
+                if media_type != "tv":
+                    return item
+                cached = tv_records.get((media_type, int(tmdb_id)))
                 if not cached:
                     return item
                 patch = {}
-                if not item.get("original_name") and cached.get("original_name"):
-                    patch["original_name"] = cached["original_name"]
-                if not item.get("seasons") and cached.get("seasons"):
-                    patch["seasons"] = cached["seasons"]
-                if cached.get("last_episode_to_air"):
-                    patch["last_episode_to_air"] = cached["last_episode_to_air"]
+                if not item.get("original_name") and cached.original_title:
+                    patch["original_name"] = cached.original_title
+                if not item.get("seasons") and cached.seasons:
+                    patch["seasons"] = cached.get("seasons")
+                if cached.last_ep:
+                    patch["last_episode_to_air"] = cached.get("last_episode_to_air")
                 return {**item, **patch} if patch else item
 
-            all_items = [
+            items = [
                 i
-                for i in map(_enrich_numparser_item, all_items)
-                if not _item_watched(i, timecodes, watched_movies, episodes_by_show=episodes_by_show)
+                for i in map(_enrich_lampac_item, items)
+                if not _item_watched(i, timecodes, watched_movies, threshold=min_progress)
             ]
 
         if search:
             sq = search.lower()
-            def _matches_search(item):
-                cached = tmdb_cache.get((item.get("media_type"), int(item["id"]))) if item.get("id") else None
-                t  = (cached or item).get("title") or (cached or item).get("name") or ""
-                ot = (cached or item).get("original_title") or (cached or item).get("original_name") or ""
-                return sq in t.lower() or sq in ot.lower()
-            all_items = [i for i in all_items if _matches_search(i)]
-
-        total = len(all_items)
+            items = [i for i in items if sq in (i.get("title") or i.get("name") or "").lower()
+                     or sq in (i.get("original_title") or i.get("original_name") or "").lower()]
+
+        total = len(items)
         start = (page - 1) * per_page
-        page_items = all_items[start : start + per_page]
+        return {
+            "page": page,
+            "results": items[start : start + per_page],
+            "total_pages": ceil(total / per_page) if per_page else 1,
+            "total_results": total,
+        }
 
-        # Подготовка запросов к TMDB
-        requests_to_make = []
-        cached_results = {}
+    # ── NUMParser-формат: {"items": [...]} с обогащением TMDB  ───────────
+    if "items" not in data:
+        raise ValueError("Неизвестный формат данных")
 
-        for item in page_items:
-            if "media_type" in item and "id" in item:
-                try:
-                    media_type = str(item["media_type"])
-                    tmdb_id = int(item["id"])
-                    cache_key = (media_type, tmdb_id)
-                    if cache_key in tmdb_cache and isinstance(
-                        tmdb_cache[cache_key], dict
-                    ):
-                        cached_results[cache_key] = tmdb_cache[cache_key]
-                    else:
-                        requests_to_make.append((media_type, tmdb_id))
-                except (ValueError, TypeError) as e:
-                    logger.warning(f"Некорректные данные в item: {item}, ошибка: {e}")
+    all_items = data["items"]
+
+    def _record_key(item: dict) -> tuple | None:
+        try:
+            return (str(item["media_type"]), int(item["id"]))
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    # Записи TMDB-кэша для фильтрации/поиска — одной пачкой на весь список
+    records: dict = {}
+    if timecodes or watched_movies or search:
+        records = await tmdb_cache.get_many(
+            k for k in map(_record_key, all_items)
+            if k is not None and (search or k[0] == "tv")
+        )
+
+    # Фильтруем ДО обогащения TMDB — экономим запросы к API
+    # Но подмешиваем last_episode_to_air из кэша для корректной фильтрации сериалов
+    if timecodes or watched_movies:
+
+        def _enrich_numparser_item(item: dict) -> dict:
+            if item.get("media_type") != "tv":
+                return item
+            cached = records.get(_record_key(item))
+            if not cached:
+                return item
+            patch = {}
+            if not item.get("original_name") and cached.original_title:
+                patch["original_name"] = cached.original_title
+            if not item.get("seasons") and cached.seasons:
+                patch["seasons"] = cached.get("seasons")
+            if cached.last_ep:
+                patch["last_episode_to_air"] = cached.get("last_episode_to_air")
+            return {**item, **patch} if patch else item
+
+        all_items = [
+            i
+            for i in map(_enrich_numparser_item, all_items)
+            if not _item_watched(i, timecodes, watched_movies)
+        ]
+
+    if search:
+        sq = search.lower()
+        def _matches_search(item):
+            cached = records.get(_record_key(item))
+            t  = (cached or item).get("title") or (cached or item).get("name") or ""
+            ot = (cached or item).get("original_title") or (cached or item).get("original_name") or ""
+            return sq in t.lower() or sq in ot.lower()
+        all_items = [i for i in all_items if _matches_search(i)]
+
+    total = len(all_items)
+    start = (page - 1) * per_page
+    page_items = all_items[start : start + per_page]
+    next_items = all_items[start + per_page : start + 2 * per_page]
+    return _PendingPage(page, per_page, total, page_items, next_items)
+
+
+def _item_keys(items: list) -> list[tuple[str, int]]:
+    keys = []
+    for item in items:
+        if "media_type" in item and "id" in item:
+            try:
+                keys.append((str(item["media_type"]), int(item["id"])))
+            except (ValueError, TypeError) as e:
+                logger.warning(f"Некорректные данные в item: {item}, ошибка: {e}")
+    return keys
+
+
+async def _enrich_pages(pages: list[_PendingPage], nowait: bool = False) -> list[dict]:
+    """Обогащает страницы NUMParser-категорий TMDB-данными за один проход:
+    одна выборка из кэша/media_cards и один пакет запросов к TMDB на все страницы.
+
+    nowait — не ждать TMDB: карточки без данных отдаются с полями из файла
+    и пометкой "_np_pending": true, догрузка идёт в фоне (tmdb_enrich).
+    Следующие страницы ставятся в фоновую предзагрузку в обоих режимах.
+    """
+    # Подготовка запросов к TMDB: кэш → media_cards → TMDB API
+    page_keys = [k for p in pages for k in _item_keys(p.items)]
+
+    cached_results = await tmdb_cache.get_many(page_keys)
+    requests_to_make = [k for k in dict.fromkeys(page_keys) if k not in cached_results]
 
-        if requests_to_make:
-            logger.debug(f"Запросы к TMDB: {len(requests_to_make)} элементов")
-            tmdb_batch = await fetch_tmdb_batch(requests_to_make)
-            tmdb_cache.update(tmdb_batch)
-            cached_results.update(tmdb_batch)
+    if requests_to_make and nowait:
+        tmdb_enrich.enqueue(requests_to_make)
+    elif requests_to_make:
+        logger.debug(f"Запросы к TMDB: {len(requests_to_make)} элементов")
+        tmdb_batch = await fetch_tmdb_batch(requests_to_make)
+        cached_results.update(tmdb_batch)
 
+    out = []
+    for p in pages:
         results = []
-        for item in page_items:
+        for item in p.items:
             if "media_type" in item and "id" in item:
                 try:
                     cache_key = (str(item["media_type"]), int(item["id"]))
-                    enhanced = enhance_with_tmdb(item, cached_results.get(cache_key))
+                    tmdb_data = cached_results.get(cache_key)
+                    if tmdb_data is None and nowait:
+                        # Поля элемента файла в формате TMDB — пока нет данных TMDB
+                        enhanced = enhance_with_tmdb(item, item)
+                        enhanced["_np_pending"] = True
+                    else:
+                        enhanced = enhance_with_tmdb(item, tmdb_data)
                     if enhanced:
                         results.append(enhanced)
                 except (ValueError, TypeError) as e:
                     logger.warning(f"Ошибка обработки item: {item}, ошибка: {e}")
-
-        return {
-            "page": page,
+        out.append({
+            "page": p.page,
             "results": results,
-            "total_pages": ceil(total / per_page) if per_page else 1,
-            "total_results": total,
-        }
+            "total_pages": ceil(p.total / p.per_page) if p.per_page else 1,
+            "total_results": p.total,
+        })
+
+    tmdb_enrich.enqueue(k for p in pages for k in _item_keys(p.next_items))
+    return out
+
+
+_BATCH_MAX_CATEGORIES = 40
+
+
+@app.get("/api/categories/batch")
+async def get_categories_batch(
+    request: Request,
+    categories: str = Query(...),
+    per_page: int = 20,
+    token: str = Query(None),
+    profile_id: str = Query(None),
+    min_progress: int = Query(None, ge=1, le=100),
+    nowait: bool = Query(False),
+    db: AsyncSession = Depends(get_db),
+):
+    """Несколько категорий одним запросом — для главного экрана плагина.
+
+    categories — id через запятую; у каждого можно указать страницу:
+    `lampac_movies_new,lampac_all_tv_shows:2` (по умолчанию 1-я).
+    Устройство, таймкоды и обогащение TMDB — один раз на весь пакет;
+    nowait — как у /{category}.
+    Ответ: {"categories": [{"id", "page", "results", ...} | {"id", "error"}]}
+    в порядке запроса.
+    """
+    requested: list[tuple[str, int]] = []
+    for part in categories.split(","):
+        cat, _, pg = part.strip().partition(":")
+        if not cat:
+            continue
+        try:
+            pg_num = max(1, int(pg)) if pg else 1
+        except ValueError:
+            pg_num = 1
+        requested.append((cat, pg_num))
+    if len(requested) > _BATCH_MAX_CATEGORIES:
+        raise HTTPException(status_code=400, detail=f"Не больше {_BATCH_MAX_CATEGORIES} категорий")
+
+    device, timecodes, watched_movies = await _profile_context(db, token, profile_id, min_progress)
+
+    payloads: list = []
+    for cat, pg_num in requested:
+        if not re.match(r"^[\w\-]+$", cat):
+            payloads.append({"error": "Not found"})
+            continue
+        try:
+            payloads.append(await _category_page(
+                cat, request, pg_num, per_page, token, profile_id, min_progress, None,
+                device, timecodes, watched_movies, db,
+            ))
+        except HTTPException as e:
+            payloads.append({"error": e.detail})
+        except Exception as e:
+            logger.error(f"Ошибка категории {cat}: {str(e)}", exc_info=True)
+            payloads.append({"error": "Внутренняя ошибка сервера"})
+
+    pending = [p for p in payloads if isinstance(p, _PendingPage)]
+    enriched = iter(await _enrich_pages(pending, nowait)) if pending else iter(())
+
+    result = []
+    for (cat, _), payload in zip(requested, payloads):
+        if isinstance(payload, _PendingPage):
+            payload = next(enriched)
+        result.append({"id": cat, **payload})
+    return {"categories": result}
+
+
+@app.get("/{category}")
+async def get_category(
+    category: str,
+    request: Request,
+    page: int = 1,
+    per_page: int = 20,
+    language: str = "ru",
+    token: str = Query(None),
+    profile_id: str = Query(None),
+    min_progress: int = Query(None, ge=1, le=100),
+    search: str = Query(None),
+    nowait: bool = Query(False),
+    db: AsyncSession = Depends(get_db),
+):
+    """Страница категории.
+
+    nowait=1 — не ждать TMDB: недостающие данные догружаются в фоне,
+    такие карточки помечены "_np_pending": true (перезапросите страницу позже).
+    """
+    if not re.match(r"^[\w\-]+$", category):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    try:
+        logger.debug(
+            f"Запрос: {category}, страница {page}, token={'yes' if token else 'no'}"
+        )
+
+        # Загружаем таймкоды устройства (если передан token)
+        device, timecodes, watched_movies = await _profile_context(db, token, profile_id, min_progress)
+
+        payload = await _category_page(
+            category, request, page, per_page, token, profile_id, min_progress, search,
+            device, timecodes, watched_movies, db,
+        )
+        if isinstance(payload, _PendingPage):
+            payload = (await _enrich_pages([payload], nowait))[0]
+        return payload
     except Exception as e:
         logger.error(f"Ошибка: {str(e)}", exc_info=True)
         return JSONResponse(
@@ -1383,7 +1303,7 @@ async def get_cache_path():
     """Возвращает информацию об источнике TMDB-кэша"""
     return {
         "source": "PostgreSQL (media_cards table)",
-        "cache_size": len(tmdb_cache),
+        "cache_size": tmdb_cache.size(),
     }
 
 
@@ -1397,8 +1317,7 @@ async def clear_cache(x_password: str = Header(..., alias="X-Password")):
             "Неверный пароль для очистки кэша\n", status_code=status.HTTP_403_FORBIDDEN
         )
 
-    global tmdb_cache
-    tmdb_cache = {}
+    tmdb_cache.clear()
 
     return PlainTextResponse("Кэш успешно очищен\n", status_code=200)
 
@@ -1407,9 +1326,27 @@ async def clear_cache(x_password: str = Header(..., alias="X-Password")):
 async def cache_info():
     """Возвращает информацию о кэше"""
     return {
-        "cache_size": len(tmdb_cache),
+        "cache_size": tmdb_cache.size(),
         "source": "PostgreSQL",
-        "sample_keys": [f"{k[0]}_{k[1]}" for k in list(tmdb_cache.keys())[:5]],
+        "tmdb_cache": tmdb_cache.info(),
+        "category_store": category_store.info(),
+        "search_index": search_index.info(),
+        "timecode_cache": timecode_cache.info(),
+        "episode_registry": episode_registry.info(),
+        "tmdb_client": tmdb_client.info(),
+        "tmdb_enrich": tmdb_enrich.info(),
+        "import_jobs": import_jobs.info(),
+        "np_popular": popular.info(),
+        "trending": trending.info(),
+        "token_cache": token_cache.info(),
+        "session_cache": session_cache.info(),
+        "ws_broadcast": ws_broadcast.info(),
+        "cache_bus": cache_bus.info(),
+        "timecode_writes": timecode_writes.info(),
+        "profile_changes": profile_changes.info(),
+        "stats": stats.info(),
+        "ws_timecode": ws_timecode_manager.info(),
+        "ws_plugin_settings": plugin_settings_router.manager.info(),
     }
 
 
@@ -1488,4 +1425,4 @@ async def proxy_m3u(url: str, request: Request):
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_ping_interval=20, ws_ping_timeout=20)
@@ -0,0 +1,122 @@
+"""
+Рейтинг «Популярно в NP» — таблица np_popular.
+
+Вес карточки — трендовый счёт из card_trending (app/trending.py): затухающая
+сумма засчитанных просмотров всех профилей всех пользователей, τ =
+popular_period_days. Для сериалов счёт делится на число серий (episodes без
+спецвыпусков → media_cards → COUNT(DISTINCT item) по индексу card_id — только
+если первых двух нет). refresh() пересобирает таблицу одним INSERT ... SELECT
+в транзакции — до commit читатели видят прежний рейтинг.
+
+Страница категории, /timecode/popular и проверка «есть ли категория»
+читают np_popular по индексу rank. Вызов refresh — из цикла в app/tasks.py
+(раз в REFRESH_SEC); смена popular_period_days применяется со следующим
+пересчётом.
+"""
+import logging
+import time
+
+from sqlalchemy import Date, case, cast, delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import trending
+from app.db.models import CardTrending, Episode, MediaCard, PopularCard, Timecode
+
+logger = logging.getLogger(__name__)
+
+REFRESH_SEC = 600
+
+_stats = {"rows": 0, "refreshed_at": None, "duration_ms": None}
+
+
+async def refresh(db: AsyncSession) -> int:
+    """Пересобирает np_popular (с commit). Возвращает число карточек в рейтинге."""
+    started = time.monotonic()
+    await trending.prune(db)
+
+    # Реальное кол-во серий: episodes (без спецвыпусков) → media_cards → COUNT(DISTINCT item)
+    ep_count_sq = (
+        select(Episode.tmdb_show_id, func.count().label("n_ep"))
+        .where(Episode.is_special == False)
+        .group_by(Episode.tmdb_show_id)
+    ).subquery()
+    # COALESCE вычисляет аргументы лениво — подзапрос к timecodes только для сериалов без данных
+    timecode_items = (
+        select(func.count(func.distinct(Timecode.item)))
+        .where(Timecode.card_id == CardTrending.card_id)
+        .scalar_subquery()
+    )
+    effective_n_ep = func.coalesce(
+        ep_count_sq.c.n_ep,
+        MediaCard.number_of_episodes,
+        timecode_items,
+    )
+    score = trending.decayed()
+    weight = case(
+        (MediaCard.media_type == "movie", score),
+        else_=score / func.nullif(effective_n_ep, 0),
+    )
+
+    ranked = (
+        select(
+            CardTrending.card_id,
+            MediaCard.media_type,
+            weight,
+            cast(CardTrending.scored_at, Date),
+            func.row_number().over(order_by=(weight.desc(), CardTrending.card_id)),
+        )
+        .join(MediaCard, MediaCard.card_id == CardTrending.card_id)
+        .outerjoin(ep_count_sq, ep_count_sq.c.tmdb_show_id == MediaCard.tmdb_id)
+        .where(score >= trending.MIN_SCORE)
+    )
+
+    await db.execute(delete(PopularCard))
+    result = await db.execute(
+        insert(PopularCard).from_select(
+            ["card_id", "media_type", "weight", "last_counted", "rank"], ranked
+        )
+    )
+    await db.commit()
+
+    _stats.update(
+        rows=result.rowcount,
+        refreshed_at=time.time(),
+        duration_ms=round((time.monotonic() - started) * 1000),
+    )
+    return result.rowcount
+
+
+async def exists(db: AsyncSession) -> bool:
+    """Есть ли что показать в «Популярно в NP»."""
+    return (await db.scalar(select(PopularCard.card_id).limit(1))) is not None
+
+
+async def get_page(
+    db: AsyncSession, page: int, per_page: int, search: str | None = None
+) -> tuple[list[tuple[MediaCard, float]], int]:
+    """Страница рейтинга: ([(MediaCard, weight)], всего карточек)."""
+    where = []
+    if search:
+        like = f"%{search}%"
+        where.append(MediaCard.title.ilike(like) | MediaCard.original_title.ilike(like))
+
+    count_q = select(func.count()).select_from(PopularCard)
+    if where:
+        count_q = count_q.join(MediaCard, MediaCard.card_id == PopularCard.card_id).where(*where)
+    total = await db.scalar(count_q) or 0
+    if not total:
+        return [], 0
+
+    rows = (await db.execute(
+        select(MediaCard, PopularCard.weight)
+        .join(PopularCard, PopularCard.card_id == MediaCard.card_id)
+        .where(*where)
+        .order_by(PopularCard.rank)
+        .offset((page - 1) * per_page)
+        .limit(per_page)
+    )).all()
+    return [(mc, weight) for mc, weight in rows], total
+
+
+def info() -> dict:
+    return dict(_stats)
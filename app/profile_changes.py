@@ -0,0 +1,309 @@
+"""
+Журнал изменений профиля — таблицы profile_changes и profile_change_seq.
+
+Поток изменений — на (user_id, lampa_profile_id): туда же, куда WebSocket
+рассылает обновления (все устройства пользователя). Каждая запись таймкода,
+закладок и настроек плагина получает следующий номер seq потока — в той же
+транзакции, что и сама запись: счётчик потока обновляется UPSERT'ом и
+держит блокировку строки до commit, поэтому номера видны читателям строго
+по порядку, без «дыр», которые заполнятся позже.
+
+В журнале только что изменилось (kind, ref, item, устройство), без данных:
+read(since) берёт ключи, изменённые после since (последний номер на ключ),
+и отдаёт их текущее состояние — таймкод, удаление таймкода, закладки,
+значение настройки. Так клиенту после переподключения приходят только
+изменённые ключи, а не весь профиль (GET /timecode/export, /favorite).
+
+Массовые удаления (очистка/удаление профиля, лимиты, чистка сирот) не
+пишут ключи поштучно — reset() сдвигает floor потока, и клиенты с since
+ниже floor получают reset: сделать полную синхронизацию. Так же floor
+сдвигает prune() — записи старше KEEP_DAYS удаляются фоновой задачей.
+
+Запись не коммитит — вызывающий коммитит вместе со своей записью.
+"""
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Iterable
+
+from sqlalchemy import String, and_, bindparam, delete, func, literal, or_, select, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import (
+    Device,
+    LampaProfile,
+    PluginSettings,
+    ProfileChange,
+    ProfileChangeSeq,
+    Timecode,
+)
+
+logger = logging.getLogger(__name__)
+
+KEEP_DAYS = 14
+PAGE_SIZE = 1000
+
+TIMECODE = "timecode"
+FAVORITE = "favorite"
+PLUGIN_SETTING = "plugin_setting"
+
+_stats = {"recorded": 0, "resets": 0, "pruned_streams": 0}
+
+
+async def _allocate(
+    db: AsyncSession, n: int, profile_id: str, *, device_id: int | None = None, user_id: int | None = None
+) -> tuple[int, int] | None:
+    """Резервирует n номеров потока. Возвращает (user_id, последний номер)."""
+    if user_id is not None:
+        source = select(literal(user_id), literal(profile_id), literal(n))
+    else:
+        source = select(Device.user_id, literal(profile_id), literal(n)).where(Device.id == device_id)
+    stmt = pg_insert(ProfileChangeSeq).from_select(["user_id", "lampa_profile_id", "seq"], source)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "lampa_profile_id"],
+        set_={"seq": ProfileChangeSeq.seq + stmt.excluded.seq},
+    ).returning(ProfileChangeSeq.user_id, ProfileChangeSeq.seq)
+    row = (await db.execute(stmt)).first()
+    return (row[0], row[1]) if row else None
+
+
+async def _record(
+    db: AsyncSession,
+    profile_id: str,
+    kind: str,
+    refs: list[tuple[str, str]],
+    *,
+    device_id: int | None = None,
+    user_id: int | None = None,
+) -> int:
+    if not refs:
+        return 0
+    allocated = await _allocate(db, len(refs), profile_id, device_id=device_id, user_id=user_id)
+    if allocated is None:
+        return 0  # устройство уже удалено
+    user_id, last = allocated
+    first = last - len(refs) + 1
+
+    rows = func.unnest(
+        bindparam("change_refs", [r for r, _ in refs], type_=ARRAY(String)),
+        bindparam("change_items", [i for _, i in refs], type_=ARRAY(String)),
+    ).table_valued("ref", "item", with_ordinality="ord")
+    await db.execute(
+        pg_insert(ProfileChange).from_select(
+            ["user_id", "lampa_profile_id", "device_id", "kind", "ref", "item", "seq"],
+            select(
+                literal(user_id),
+                literal(profile_id),
+                literal(device_id, type_=ProfileChange.device_id.type),
+                literal(kind),
+                rows.c.ref,
+                rows.c.item,
+                rows.c.ord + (first - 1),
+            ),
+        )
+    )
+    _stats["recorded"] += len(refs)
+    return last
+
+
+async def record_timecodes(
+    db: AsyncSession, device_id: int, profile_id: str, keys: Iterable[tuple[str, str]]
+) -> int:
+    """Записанные или удалённые таймкоды [(card_id, item)]. Номер i-го ключа — last - n + 1 + i."""
+    return await _record(db, profile_id, TIMECODE, list(keys), device_id=device_id)
+
+
+async def record_deleted_timecodes(
+    db: AsyncSession, device_id: int, rows: Iterable[tuple[str, str, str]]
+) -> None:
+    """Удалённые таймкоды устройства из разных профилей [(lampa_profile_id, card_id, item)]."""
+    by_profile: dict[str, list[tuple[str, str]]] = {}
+    for profile_id, card_id, item in rows:
+        by_profile.setdefault(profile_id, []).append((card_id, item))
+    for profile_id, keys in by_profile.items():
+        await record_timecodes(db, device_id, profile_id, keys)
+
+
+async def record_favorite(db: AsyncSession, device_id: int, profile_id: str) -> int:
+    return await _record(db, profile_id, FAVORITE, [("", "")], device_id=device_id)
+
+
+async def record_plugin_setting(
+    db: AsyncSession, user_id: int, profile_id: str, plugin: str, key: str
+) -> int:
+    return await _record(db, profile_id, PLUGIN_SETTING, [(plugin, key)], user_id=user_id)
+
+
+async def reset(db: AsyncSession, device_id: int, profile_id: str) -> None:
+    """Массовое изменение профиля: клиенты с since до него — на полную синхронизацию."""
+    allocated = await _allocate(db, 1, profile_id, device_id=device_id)
+    if allocated is None:
+        return
+    user_id, last = allocated
+    await db.execute(
+        ProfileChangeSeq.__table__.update()
+        .where(
+            ProfileChangeSeq.user_id == user_id,
+            ProfileChangeSeq.lampa_profile_id == profile_id,
+        )
+        .values(floor=last)
+    )
+    _stats["resets"] += 1
+
+
+async def reset_device(db: AsyncSession, device_id: int) -> None:
+    """reset() всех профилей устройства (вызывать до удаления его таймкодов)."""
+    profiles = set((await db.execute(
+        select(Timecode.lampa_profile_id).distinct().where(Timecode.device_id == device_id)
+    )).scalars().all())
+    profiles.update((await db.execute(
+        select(LampaProfile.lampa_profile_id).where(LampaProfile.device_id == device_id)
+    )).scalars().all())
+    for profile_id in profiles:
+        await reset(db, device_id, profile_id)
+
+
+async def current(db: AsyncSession, user_id: int, profile_id: str) -> tuple[int, int]:
+    """(seq, floor) потока; (0, 0) — изменений ещё не было."""
+    row = (await db.execute(
+        select(ProfileChangeSeq.seq, ProfileChangeSeq.floor).where(
+            ProfileChangeSeq.user_id == user_id,
+            ProfileChangeSeq.lampa_profile_id == profile_id,
+        )
+    )).first()
+    return (row[0], row[1]) if row else (0, 0)
+
+
+async def read(
+    db: AsyncSession, device: Device, profile_id: str, since: int, limit: int = PAGE_SIZE
+) -> dict:
+    """
+    Изменения профиля после since для устройства:
+      {"seq": N, "reset": bool, "more": bool, "changes": [{"seq", "type", ...}]}
+    seq — с какого номера продолжать; more — есть следующая страница;
+    reset — журнал неполон (since до floor или из другого потока): нужна полная синхронизация.
+    """
+    seq, floor = await current(db, device.user_id, profile_id)
+    if since > seq or since < floor:
+        return {"seq": seq, "reset": True, "more": False, "changes": []}
+
+    last_seq = func.max(ProfileChange.seq).label("last_seq")
+    keys = (await db.execute(
+        select(ProfileChange.kind, ProfileChange.ref, ProfileChange.item, last_seq)
+        .where(
+            ProfileChange.user_id == device.user_id,
+            ProfileChange.lampa_profile_id == profile_id,
+            ProfileChange.seq > since,
+            or_(ProfileChange.device_id == device.id, ProfileChange.device_id.is_(None)),
+        )
+        .group_by(ProfileChange.kind, ProfileChange.ref, ProfileChange.item)
+        .order_by(last_seq)
+        .limit(limit + 1)
+    )).all()
+    more = len(keys) > limit
+    keys = keys[:limit]
+
+    changes = await _resolve(db, device, profile_id, keys)
+    # Следующая страница — после последнего отданного ключа; последняя — до конца потока
+    return {
+        "seq": keys[-1].last_seq if more else seq,
+        "reset": False,
+        "more": more,
+        "changes": changes,
+    }
+
+
+async def _resolve(db: AsyncSession, device: Device, profile_id: str, keys: list) -> list[dict]:
+    """Текущее состояние изменённых ключей в формате сообщений WebSocket."""
+    tc_keys = [(k.ref, k.item) for k in keys if k.kind == TIMECODE]
+    timecodes: dict[tuple[str, str], str] = {}
+    if tc_keys:
+        timecodes = {
+            (c, i): data
+            for c, i, data in (await db.execute(
+                select(Timecode.card_id, Timecode.item, Timecode.data).where(
+                    Timecode.device_id == device.id,
+                    Timecode.lampa_profile_id == profile_id,
+                    tuple_(Timecode.card_id, Timecode.item).in_(tc_keys),
+                )
+            )).all()
+        }
+
+    favorite = None
+    if any(k.kind == FAVORITE for k in keys):
+        favorite = await db.scalar(
+            select(LampaProfile.favorite).where(
+                LampaProfile.device_id == device.id,
+                LampaProfile.lampa_profile_id == profile_id,
+            )
+        )
+
+    plugins = {k.ref for k in keys if k.kind == PLUGIN_SETTING}
+    settings: dict[str, dict] = {}
+    if plugins:
+        for plugin, raw in (await db.execute(
+            select(PluginSettings.plugin, PluginSettings.settings).where(
+                PluginSettings.user_id == device.user_id,
+                PluginSettings.lampa_profile_id == profile_id,
+                PluginSettings.plugin.in_(plugins),
+            )
+        )).all():
+            try:
+                settings[plugin] = json.loads(raw)
+            except Exception:
+                settings[plugin] = {}
+
+    out = []
+    for k in keys:
+        msg: dict = {"seq": k.last_seq, "profile_id": profile_id}
+        if k.kind == TIMECODE:
+            data = timecodes.get((k.ref, k.item))
+            if data is None:
+                msg.update(type="timecode_delete", card_id=k.ref, item=k.item)
+            else:
+                msg.update(type="timecode", card_id=k.ref, item=k.item, data=data)
+        elif k.kind == FAVORITE:
+            msg.update(type="favorite", favorite=json.loads(favorite) if favorite else None)
+        elif k.kind == PLUGIN_SETTING:
+            msg.update(
+                type="plugin_setting", plugin=k.ref, key=k.item,
+                value=settings.get(k.ref, {}).get(k.item),
+            )
+        else:
+            continue
+        out.append(msg)
+    return out
+
+
+async def prune(db: AsyncSession) -> int:
+    """Удаляет записи старше KEEP_DAYS и сдвигает floor их потоков (с commit).
+    Возвращает число затронутых потоков."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=KEEP_DAYS)
+    removed = (
+        delete(ProfileChange)
+        .where(ProfileChange.created_at < cutoff)
+        .returning(ProfileChange.user_id, ProfileChange.lampa_profile_id, ProfileChange.seq)
+        .cte("removed")
+    )
+    floors = (
+        select(removed.c.user_id, removed.c.lampa_profile_id, func.max(removed.c.seq).label("seq"))
+        .group_by(removed.c.user_id, removed.c.lampa_profile_id)
+        .subquery()
+    )
+    result = await db.execute(
+        ProfileChangeSeq.__table__.update()
+        .add_cte(removed)
+        .where(and_(
+            ProfileChangeSeq.user_id == floors.c.user_id,
+            ProfileChangeSeq.lampa_profile_id == floors.c.lampa_profile_id,
+        ))
+        .values(floor=func.greatest(ProfileChangeSeq.floor, floors.c.seq))
+    )
+    await db.commit()
+    _stats["pruned_streams"] += result.rowcount
+    return result.rowcount
+
+
+def info() -> dict:
+    return {"keep_days": KEEP_DAYS, **_stats}
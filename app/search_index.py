@@ -0,0 +1,210 @@
+"""
+Глобальный поисковый индекс по категориям для /api/search.
+
+Для каждой категории строится триграммный инвертированный индекс по
+title/name и original_title/original_name — как из самого файла, так и из
+TMDB-названий (media_cards, подгружаются пачкой при построении и хранятся
+в самом индексе — не зависят от вытеснения из tmdb_cache). Индекс
+перестраивается только для изменившейся категории (подписка на
+category_store), новые TMDB-названия дописываются в него точечно через
+note_tmdb().
+
+Индекс даёт надмножество кандидатов; итоговая проверка `q in title/orig`
+идёт по названиям, которые увидит пользователь (TMDB, если есть, иначе
+файл) — результат совпадает с полным перебором файлов.
+Запрос не трогает ни файловую систему, ни БД.
+"""
+import asyncio
+import logging
+from bisect import bisect_left, insort
+from typing import Any, Awaitable, Callable
+
+from app import category_store
+
+logger = logging.getLogger(__name__)
+
+# [(media_type, tmdb_id), ...] → {(media_type, tmdb_id): (title, original_title)}
+TitlesLoader = Callable[[list[tuple]], Awaitable[dict[tuple, tuple[str, str]]]]
+_titles_loader: TitlesLoader | None = None
+
+
+class _CategoryIndex:
+    __slots__ = ("cat_id", "source", "items", "keys", "tmdb_titles", "grams", "by_key")
+
+    def __init__(self, cat_id: str, source: Any):
+        self.cat_id = cat_id
+        self.source = source                       # версия данных из category_store
+        self.items: list[dict] = []                # элементы категории в исходном порядке
+        self.keys: list[tuple | None] = []         # (media_type, tmdb_id) или None
+        self.tmdb_titles: dict[int, tuple[str, str]] = {}  # позиция → TMDB (title, original)
+        self.grams: dict[str, list[int]] = {}      # триграмма → отсортированные позиции
+        self.by_key: dict[tuple, list[int]] = {}   # (media_type, tmdb_id) → позиции
+
+    def add_text(self, pos: int, text: str) -> None:
+        for g in _trigrams(text.lower()):
+            postings = self.grams.get(g)
+            if postings is None:
+                self.grams[g] = [pos]
+            elif postings[-1] < pos:
+                postings.append(pos)  # обычный случай при построении — позиции растут
+            else:
+                i = bisect_left(postings, pos)
+                if i == len(postings) or postings[i] != pos:
+                    insort(postings, pos)
+
+
+_indexes: dict[str, _CategoryIndex] = {}
+
+
+def _trigrams(s: str) -> set[str]:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+def _items_of(data: Any) -> list:
+    if isinstance(data, list):
+        return data
+    if "results" in data:
+        return data["results"]
+    if "items" in data:
+        return data["items"]
+    return []
+
+
+def _item_key(item: dict) -> tuple | None:
+    """(media_type, tmdb_id) элемента категории — та же логика, что в api_search."""
+    tmdb_id = item.get("id")
+    if not tmdb_id:
+        return None
+    media_type = item.get("media_type") or ("tv" if item.get("name") else "movie")
+    try:
+        return media_type, int(tmdb_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _titles(src: dict) -> tuple[str, str]:
+    return (
+        src.get("title") or src.get("name") or "",
+        src.get("original_title") or src.get("original_name") or "",
+    )
+
+
+def _build(cat_id: str, data: Any, tmdb_titles: dict[tuple, tuple[str, str]]) -> _CategoryIndex:
+    idx = _CategoryIndex(cat_id, data)
+    for pos, item in enumerate(_items_of(data)):
+        key = _item_key(item)
+        idx.items.append(item)
+        idx.keys.append(key)
+        for text in _titles(item):
+            idx.add_text(pos, text)
+        if key is not None:
+            idx.by_key.setdefault(key, []).append(pos)
+            titles = tmdb_titles.get(key)
+            if titles and any(titles):
+                idx.tmdb_titles[pos] = titles
+                for text in titles:
+                    idx.add_text(pos, text)
+    return idx
+
+
+async def _rebuild(cat_id: str, data: Any) -> None:
+    tmdb_titles: dict[tuple, tuple[str, str]] = {}
+    if _titles_loader is not None:
+        keys = [k for k in map(_item_key, _items_of(data)) if k is not None]
+        try:
+            tmdb_titles = await _titles_loader(keys)
+        except Exception as e:
+            logger.warning(f"search_index: TMDB-названия для {cat_id} не загружены: {e}")
+    try:
+        idx = await asyncio.to_thread(_build, cat_id, data, tmdb_titles)
+    except Exception as e:
+        logger.error(f"search_index: ошибка построения индекса {cat_id}: {e}")
+        return
+    # За время построения категорию могли перечитать ещё раз — старый индекс не ставим
+    if category_store.peek(cat_id) is data:
+        _indexes[cat_id] = idx
+        logger.debug(f"search_index: {cat_id} — {len(idx.items)} элементов, {len(idx.grams)} триграмм")
+
+
+def _on_category_change(cat_id: str, data: Any) -> None:
+    if data is None:
+        _indexes.pop(cat_id, None)
+        return
+    asyncio.ensure_future(_rebuild(cat_id, data))
+
+
+def init(titles_loader: TitlesLoader) -> None:
+    """Подключает индекс к category_store. Вызывается из lifespan до category_store.start()."""
+    global _titles_loader
+    _titles_loader = titles_loader
+    category_store.add_listener(_on_category_change)
+    # Категории, загруженные раньше подписки
+    for cat_id in category_store.loaded():
+        _on_category_change(cat_id, category_store.peek(cat_id))
+
+
+def note_tmdb(media_type: str, tmdb_id: int, cleaned: dict) -> None:
+    """Дописывает в индекс названия из только что полученной TMDB-записи."""
+    key = (media_type, tmdb_id)
+    texts = _titles(cleaned)
+    if not any(texts):
+        return
+    for idx in _indexes.values():
+        for pos in idx.by_key.get(key, ()):
+            idx.tmdb_titles[pos] = texts
+            for text in texts:
+                idx.add_text(pos, text)
+
+
+def search(q: str, per_cat: int) -> list[tuple[str, list[tuple[dict, tuple | None]]]]:
+    """Поиск подстроки q (уже в нижнем регистре) по всем категориям.
+
+    Возвращает [(cat_id, [(item, key), ...]), ...] — не больше per_cat
+    совпадений на категорию, в порядке элементов файла; key —
+    (media_type, tmdb_id) элемента или None.
+    """
+    grams = _trigrams(q)
+    groups = []
+    for cat_id in sorted(_indexes):
+        idx = _indexes[cat_id]
+        if grams:
+            postings = []
+            for g in grams:
+                p = idx.grams.get(g)
+                if not p:
+                    break
+                postings.append(p)
+            else:
+                postings.sort(key=len)
+                cand = set(postings[0])
+                for p in postings[1:]:
+                    cand.intersection_update(p)
+                    if not cand:
+                        break
+                candidates = sorted(cand)
+            if len(postings) != len(grams):
+                continue
+        else:
+            candidates = range(len(idx.items))  # запрос короче триграммы — перебор в памяти
+
+        found = []
+        for pos in candidates:
+            item = idx.items[pos]
+            title, orig = idx.tmdb_titles.get(pos) or _titles(item)
+            if not title and not orig:
+                continue
+            if q in title.lower() or q in orig.lower():
+                found.append((item, idx.keys[pos]))
+                if len(found) >= per_cat:
+                    break
+        if found:
+            groups.append((cat_id, found))
+    return groups
+
+
+def info() -> dict:
+    return {
+        "categories": len(_indexes),
+        "items": sum(len(i.items) for i in _indexes.values()),
+        "trigrams": sum(len(i.grams) for i in _indexes.values()),
+    }
@@ -0,0 +1,197 @@
+"""
+In-memory кэш веб-сессий (per-process): session_key → срок сессии и снимок User.
+
+get_current_user вызывается на каждую страницу сайта и /api/* из браузера —
+раньше это запрос Session и db.get(User). Здесь запись живёт _TTL_SEC;
+на попадании пользователь собирается из снимка колонок и присоединяется
+к сессии БД запроса через merge(load=False) — без SELECT, но как обычный
+persistent-объект: изменения current_user в эндпоинтах коммитятся как раньше.
+
+Продление сессии (скользящее окно) пишется в БД фоном и не чаще раза
+в RENEW_WRITE_SEC на сессию; cookie и срок в кэше обновляются сразу.
+
+Снимок User сбрасывается сам: после commit любой ORM-сессии, в которой
+User был изменён или удалён (события after_flush / after_commit).
+Удаление строк sessions запросами (logout, отзыв сессий, смена пароля)
+обязано сбрасывать кэш явно — invalidate_key / invalidate_user.
+Поколение защищает от гонки «чтение из БД vs сброс», как в token_cache;
+сброс рассылается остальным воркерам через cache_bus.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import event, inspect, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session as OrmSession, make_transient_to_detached
+
+from app import cache_bus
+from app.db.models import Session, User
+
+logger = logging.getLogger(__name__)
+
+_MAX_ENTRIES = 10000
+_TTL_SEC = 60
+RENEW_WRITE_SEC = 600
+
+_USER_COLUMNS = [attr.key for attr in inspect(User).column_attrs]
+_INFO_KEY = "session_cache_users"
+
+
+class Entry:
+    __slots__ = ("user_id", "expires_at", "values", "loaded_at")
+
+    def __init__(self, user_id: int, expires_at: datetime, values: dict, loaded_at: float):
+        self.user_id = user_id
+        self.expires_at = expires_at
+        self.values = values
+        self.loaded_at = loaded_at
+
+
+# Отличает «нет в кэше» от закэшированного «сессии нет» (None)
+MISS = object()
+
+_entries: "OrderedDict[str, Entry | None]" = OrderedDict()
+_loaded_at: dict[str, float] = {}
+_by_user: dict[int, set[str]] = {}
+_renew_written: dict[str, float] = {}
+_generation = 0
+_hits = 0
+_misses = 0
+
+
+def generation() -> int:
+    """Текущее поколение — запомнить до чтения из БД и передать в put()."""
+    return _generation
+
+
+def get(key: str) -> "Entry | None | object":
+    """Entry, None (сессии нет) или MISS."""
+    global _hits, _misses
+    if key not in _entries or time.monotonic() - _loaded_at[key] > _TTL_SEC:
+        _misses += 1
+        return MISS
+    _hits += 1
+    return _entries[key]
+
+
+def put(key: str, user: User | None, expires_at: datetime | None, gen: int) -> None:
+    """Кэширует сессию (user=None — ключ не найден или истёк)."""
+    if gen != _generation:
+        return  # между чтением и записью был сброс — данные могли устареть
+    _drop(key)
+    now = time.monotonic()
+    entry = None
+    if user is not None:
+        entry = Entry(user.id, expires_at, {c: getattr(user, c) for c in _USER_COLUMNS}, now)
+        _by_user.setdefault(user.id, set()).add(key)
+    _entries[key] = entry
+    _loaded_at[key] = now
+    while len(_entries) > _MAX_ENTRIES:
+        _drop(next(iter(_entries)))
+
+
+async def attach(db: AsyncSession, entry: Entry) -> User:
+    """User из снимка, присоединённый к сессии БД запроса (без SELECT)."""
+    user = User(**entry.values)
+    make_transient_to_detached(user)
+    return await db.merge(user, load=False)
+
+
+def renew(key: str, expires_at: datetime) -> None:
+    """Продлевает сессию: срок в кэше — сразу, в БД — фоном, не чаще RENEW_WRITE_SEC."""
+    entry = _entries.get(key)
+    if entry is not None:
+        entry.expires_at = expires_at
+    now = time.monotonic()
+    if now - _renew_written.get(key, float("-inf")) < RENEW_WRITE_SEC:
+        return
+    _renew_written[key] = now
+    asyncio.create_task(_write_expiry(key, expires_at))
+
+
+async def _write_expiry(key: str, expires_at: datetime) -> None:
+    from app.db.database import async_session_maker
+    try:
+        async with async_session_maker() as db:
+            await db.execute(
+                update(Session).where(Session.key == key).values(expires_at=expires_at)
+            )
+            await db.commit()
+    except Exception as e:
+        _renew_written.pop(key, None)
+        logger.warning(f"session_cache: не удалось продлить сессию: {e}")
+
+
+def _drop(key: str) -> None:
+    entry = _entries.pop(key, None)
+    _loaded_at.pop(key, None)
+    _renew_written.pop(key, None)
+    if entry is not None:
+        keys = _by_user.get(entry.user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _by_user[entry.user_id]
+
+
+def _apply(op: str, arg) -> None:
+    """Сброс в этом процессе: op — "key" | "user" | "all"."""
+    global _generation
+    _generation += 1
+    if op == "key":
+        if arg:
+            _drop(arg)
+    elif op == "user":
+        for key in list(_by_user.get(arg, ())):
+            _drop(key)
+    else:
+        _entries.clear()
+        _loaded_at.clear()
+        _by_user.clear()
+        _renew_written.clear()
+
+
+def invalidate_key(key: str | None) -> None:
+    """Сбрасывает сессию (logout, отзыв одной сессии)."""
+    _apply("key", key)
+    cache_bus.notify("session", "key", key)
+
+
+def invalidate_user(user_id: int) -> None:
+    """Сбрасывает все сессии пользователя (отзыв всех, смена пароля, изменения User)."""
+    _apply("user", user_id)
+    cache_bus.notify("session", "user", user_id)
+
+
+def invalidate_all() -> None:
+    _apply("all", None)
+    cache_bus.notify("session", "all")
+
+
+cache_bus.register("session", _apply)
+
+
+@event.listens_for(OrmSession, "after_flush")
+def _collect_users(session, flush_context) -> None:
+    # dirty / deleted в after_flush ещё в состоянии до flush
+    ids = {obj.id for obj in (*session.dirty, *session.deleted) if isinstance(obj, User)}
+    if ids:
+        session.info.setdefault(_INFO_KEY, set()).update(ids)
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _invalidate_users(session) -> None:
+    for user_id in session.info.pop(_INFO_KEY, ()):
+        invalidate_user(user_id)
+
+
+@event.listens_for(OrmSession, "after_soft_rollback")
+def _forget_users(session, previous_transaction) -> None:
+    session.info.pop(_INFO_KEY, None)
+
+
+def info() -> dict:
+    return {"entries": len(_entries), "hits": _hits, "misses": _misses}
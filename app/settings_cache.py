@@ -128,7 +128,7 @@ LABELS: dict[str, str] = {
     "rate_2fa_max": "Rate: 2FA — попыток",
     "rate_2fa_window_sec": "Rate: 2FA — окно (сек)",
     "sync_cooldown_sec": "MyShows cooldown (сек)",
-    "popular_period_days": "Популярное — период (дней)",
+    "popular_period_days": "Популярное — период затухания (дней)",
     "yandex_metrika_enabled": "Яндекс.Метрика — включена",
     "yandex_metrika_id": "Яндекс.Метрика ID",
     "google_analytics_enabled": "Google Analytics — включена",
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+from collections import Counter, OrderedDict
 from datetime import date, datetime
 from pathlib import Path
 
@@ -8,8 +9,8 @@ from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from fastapi.responses import HTMLResponse, RedirectResponse
 from app.templates import get_templates
 from sqlalchemy import text
-from sqlalchemy.dialects.postgresql import insert as pg_insert
 
+from app.db.bulk import bulk_upsert
 from app.db.database import async_session_maker
 from app.db.models import MyShowsUser, ApiUser, CategoryRequest, User
 from app.api.dependencies import get_current_user
@@ -80,63 +81,133 @@ def init_stats():
 
 
 # -------------------------------------------------------------------
-# TRACKING FUNCTIONS (fire-and-forget background tasks)
+# TRACKING FUNCTIONS (in-memory buffer, periodic flush)
 # -------------------------------------------------------------------
+# track_* вызываются на каждый запрос каталога — они только увеличивают
+# счётчик в памяти. Раз в FLUSH_SEC накопленное пишется одним UPSERT
+# на таблицу (requests = requests + накопленное), при остановке — дописывается.
+# Геолокация IP запрашивается один раз на IP за время жизни процесса.
+
+FLUSH_SEC = 10
+_GEO_CACHE_MAX = 10000
+_GEO_CONCURRENCY = 8
+
+# (date, login) / (date, ip) / (date, category, ip) → запросов с последнего сброса
+_myshows: Counter = Counter()
+_api: Counter = Counter()
+_categories: Counter = Counter()
+_geo: "OrderedDict[str, dict]" = OrderedDict()
+_task: asyncio.Task | None = None
+_stats = {"tracked": 0, "flushed_rows": 0, "flush_errors": 0}
+
+
+async def _locations(ips: set[str]) -> dict[str, dict]:
+    """Геолокация IP: из кэша, недостающие — параллельно, не больше _GEO_CONCURRENCY запросов."""
+    found = {ip: _geo[ip] for ip in ips if ip in _geo}
+    sem = asyncio.Semaphore(_GEO_CONCURRENCY)
+
+    async def lookup(ip: str) -> None:
+        async with sem:
+            found[ip] = await _get_location(ip)
+        if found[ip]["country"] != "Unknown":  # неудачный запрос повторится при следующем сбросе
+            _geo[ip] = found[ip]
+
+    await asyncio.gather(*(lookup(ip) for ip in ips - found.keys()))
+    while len(_geo) > _GEO_CACHE_MAX:
+        _geo.popitem(last=False)
+    return found
+
+
+async def flush() -> None:
+    """Пишет накопленные счётчики в БД. При ошибке счётчики возвращаются в буфер."""
+    myshows, api, categories = _myshows.copy(), _api.copy(), _categories.copy()
+    _myshows.clear()
+    _api.clear()
+    _categories.clear()
+    if not (myshows or api or categories):
+        return
 
-async def _do_track_myshows_user(login: str):
-    today = date.today().isoformat()
-    async with async_session_maker() as db:
-        stmt = pg_insert(MyShowsUser).values(login=login, date=today, requests=1)
-        stmt = stmt.on_conflict_do_update(
-            index_elements=["login", "date"],
-            set_={"requests": MyShowsUser.requests + 1},
-        )
-        await db.execute(stmt)
-        await db.commit()
-
-
-async def _do_track_api_user(ip: str):
-    today = date.today().isoformat()
-    location = await _get_location(ip)
-    async with async_session_maker() as db:
-        stmt = pg_insert(ApiUser).values(
-            ip=ip, date=today, requests=1,
-            country=location["country"], city=location["city"],
-            region=location["region"], flag_emoji=location["flag_emoji"],
-        )
-        stmt = stmt.on_conflict_do_update(
-            index_elements=["ip", "date"],
-            set_={"requests": ApiUser.requests + 1},
-        )
-        await db.execute(stmt)
-        await db.commit()
+    try:
+        locations = await _locations({ip for _, ip in api})
+        async with async_session_maker() as db:
+            await bulk_upsert(
+                db, MyShowsUser,
+                [{"login": login, "date": d, "requests": n} for (d, login), n in myshows.items()],
+                ["login", "date"],
+                lambda excluded: {"requests": MyShowsUser.requests + excluded.requests},
+            )
+            await bulk_upsert(
+                db, ApiUser,
+                [{"ip": ip, "date": d, "requests": n, **locations[ip]} for (d, ip), n in api.items()],
+                ["ip", "date"],
+                lambda excluded: {"requests": ApiUser.requests + excluded.requests},
+            )
+            await bulk_upsert(
+                db, CategoryRequest,
+                [
+                    {"category": category, "ip": ip, "date": d, "requests": n}
+                    for (d, category, ip), n in categories.items()
+                ],
+                ["category", "ip", "date"],
+                lambda excluded: {"requests": CategoryRequest.requests + excluded.requests},
+            )
+            await db.commit()
+    except Exception:
+        _stats["flush_errors"] += 1
+        _myshows.update(myshows)
+        _api.update(api)
+        _categories.update(categories)
+        raise
+    _stats["flushed_rows"] += len(myshows) + len(api) + len(categories)
+
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(FLUSH_SEC)
+        try:
+            await flush()
+        except Exception as e:
+            logger.warning(f"stats: flush failed: {e}")
+
+
+def start() -> None:
+    global _task
+    _task = asyncio.create_task(_flush_loop())
+
+
+async def stop() -> None:
+    """Останавливает сброс и пишет накопленное."""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+    try:
+        await flush()
+    except Exception as e:
+        logger.error(f"stats: final flush failed: {e}")
 
 
-async def _do_track_category(ip: str, category: str):
-    today = date.today().isoformat()
-    async with async_session_maker() as db:
-        stmt = pg_insert(CategoryRequest).values(
-            category=category, ip=ip, date=today, requests=1,
-        )
-        stmt = stmt.on_conflict_do_update(
-            index_elements=["category", "ip", "date"],
-            set_={"requests": CategoryRequest.requests + 1},
-        )
-        await db.execute(stmt)
-        await db.commit()
+def info() -> dict:
+    return {
+        "pending": len(_myshows) + len(_api) + len(_categories),
+        "geo_cached": len(_geo),
+        **_stats,
+    }
 
 
 def track_myshows_user(login: str):
     if not login or login == "null":
         return
-    asyncio.create_task(_do_track_myshows_user(login))
+    _myshows[(date.today().isoformat(), login)] += 1
+    _stats["tracked"] += 1
 
 
 def track_api_user(request: Request):
     ip = get_real_ip(request)
     if ip in ("127.0.0.1", "localhost", "::1"):
         return
-    asyncio.create_task(_do_track_api_user(ip))
+    _api[(date.today().isoformat(), ip)] += 1
+    _stats["tracked"] += 1
 
 
 def track_category_request(request: Request, category: str):
@@ -145,7 +216,8 @@ def track_category_request(request: Request, category: str):
     if category.lower() in EXCLUDED_CATEGORIES:
         return
     ip = get_real_ip(request)
-    asyncio.create_task(_do_track_category(ip, category))
+    _categories[(date.today().isoformat(), category, ip)] += 1
+    _stats["tracked"] += 1
 
 
 # -------------------------------------------------------------------
@@ -10,6 +10,9 @@ run_premium_expiry_check — runs daily at configured hour (settings: daily_task
 run_notification_delivery — runs every 10 minutes:
   Sends pending Telegram notifications where notify_premium_after <= now.
   Respects notify_type ("warning" / "expired").
+
+run_popular_refresh — runs at startup and every popular.REFRESH_SEC:
+  Rebuilds the "Популярно в NP" ranking table (np_popular) from trending scores.
 """
 
 import asyncio
@@ -21,6 +24,7 @@ logger = logging.getLogger(__name__)
 
 _check_task: asyncio.Task | None = None
 _delivery_task: asyncio.Task | None = None
+_popular_task: asyncio.Task | None = None
 
 # ─── Episode refresh progress ──────────────────────────────────────────────────
 
@@ -51,22 +55,15 @@ def get_find_progress() -> dict:
     return dict(_find_progress)
 
 
-async def _fetch_tmdb_tv_info(tmdb_id: int, client) -> tuple[str | None, str | None]:
+async def _fetch_tmdb_tv_info(tmdb_id: int) -> tuple[str | None, str | None]:
     """
     Запрашивает imdb_id и английское название из TMDB одним запросом.
     Возвращает (imdb_id, name_en).
     """
-    from app.config import get_settings
-    cfg = get_settings()
+    from app import tmdb_client
     try:
-        resp = await client.get(
-            f"https://api.themoviedb.org/3/tv/{tmdb_id}",
-            params={"language": "en-US", "append_to_response": "external_ids"},
-            headers={"Authorization": cfg.TMDB_TOKEN},
-            timeout=10,
-        )
-        if resp.status_code == 200:
-            data = resp.json()
+        data = await tmdb_client.details("tv", tmdb_id, language="en-US", append_to_response="external_ids")
+        if data:
             imdb_id = (data.get("external_ids") or {}).get("imdb_id") or None
             name_en = data.get("name") or data.get("original_name") or None
             return imdb_id, name_en
@@ -115,7 +112,7 @@ async def run_find_myshows_ids() -> None:
                     # Шаг 1: подтягиваем imdb_id и английское название из TMDB
                     name_en = None
                     if mc.tmdb_id:
-                        imdb_id, name_en = await _fetch_tmdb_tv_info(mc.tmdb_id, client)
+                        imdb_id, name_en = await _fetch_tmdb_tv_info(mc.tmdb_id)
                         if imdb_id and not mc.imdb_id:
                             mc.imdb_id = imdb_id
                             logger.info(f"run_find_myshows_ids: {mc.card_id} imdb_id={imdb_id} from TMDB")
@@ -352,6 +349,8 @@ async def run_premium_expiry_check(_now: datetime | None = None) -> None:
             user.premium_until = None  # грейс истёк, база для продления больше не нужна
 
         await db.commit()
+        from app import timecode_cache
+        timecode_cache.invalidate_all()
 
         # ── 5. Cleanup data for blocked users after 30 days of full block ──────
         from app.db.models import Session, TelegramUser
@@ -391,6 +390,10 @@ async def run_premium_expiry_check(_now: datetime | None = None) -> None:
 
         await db.commit()
 
+    # Роли, премиум и устройства менялись пачкой — кэш авторизации по token сбрасываем целиком
+    from app import token_cache
+    token_cache.invalidate_all()
+
     logger.info("Premium expiry check complete.")
 
 
@@ -480,6 +483,45 @@ async def run_episodes_refresh(force: bool = False) -> None:
     logger.info("run_episodes_refresh: done")
 
 
+# ─── Card progress refresh (daily) ────────────────────────────────────────────
+
+
+async def run_card_progress_refresh() -> None:
+    """Пересчитывает card_progress онгоингов: вышедших серий становится больше без записей в БД."""
+    from app.db.database import async_session_maker
+    from app import card_progress
+
+    async with async_session_maker() as db:
+        n = await card_progress.refresh_ongoing(db)
+    logger.info(f"run_card_progress_refresh: {n} shows refreshed")
+
+
+# ─── Profile change log pruning (daily) ───────────────────────────────────────
+
+
+async def run_profile_changes_prune() -> None:
+    """Удаляет старые записи журнала изменений профилей (клиенты с since до них — на полную синхронизацию)."""
+    from app.db.database import async_session_maker
+    from app import profile_changes
+
+    async with async_session_maker() as db:
+        n = await profile_changes.prune(db)
+    logger.info(f"run_profile_changes_prune: {n} streams pruned")
+
+
+# ─── "Популярно в NP" ranking ─────────────────────────────────────────────────
+
+
+async def run_popular_refresh() -> None:
+    """Пересобирает рейтинг np_popular из трендового счёта карточек (card_trending)."""
+    from app.db.database import async_session_maker
+    from app import popular
+
+    async with async_session_maker() as db:
+        n = await popular.refresh(db)
+    logger.debug(f"run_popular_refresh: {n} cards ranked")
+
+
 # ─── Notification delivery (every 10 minutes) ─────────────────────────────────
 
 
@@ -703,6 +745,7 @@ async def _cleanup_devices(db, user_id: int, device_limit: int, username: str) -
 
 async def _cleanup_profiles(db, user_id: int, profile_limit: int, username: str) -> int:
     from app.db.models import Device, LampaProfile, Timecode
+    from app import card_progress, profile_changes
     from sqlalchemy import select, delete
 
     dev_ids = (
@@ -738,6 +781,9 @@ async def _cleanup_profiles(db, user_id: int, profile_limit: int, username: str)
                 Timecode.lampa_profile_id.in_(del_profile_ids),
             )
         )
+        for pid in del_profile_ids:
+            await card_progress.refresh(db, device_id, pid)
+            await profile_changes.reset(db, device_id, pid)
         await db.execute(delete(LampaProfile).where(LampaProfile.id.in_(del_lp_ids)))
         total_deleted += len(to_delete)
 
@@ -750,6 +796,7 @@ async def _cleanup_profiles(db, user_id: int, profile_limit: int, username: str)
 
 async def _cleanup_timecodes(db, user_id: int, limit: int, username: str) -> None:
     from app.db.models import Device, Timecode
+    from app import card_progress, profile_changes
     from sqlalchemy import select, func, delete
 
     dev_ids = (
@@ -808,7 +855,11 @@ async def _cleanup_timecodes(db, user_id: int, limit: int, username: str) -> Non
             )
 
             if oldest_ids:
-                await db.execute(delete(Timecode).where(Timecode.id.in_(oldest_ids)))
+                trimmed = (await db.execute(
+                    delete(Timecode).where(Timecode.id.in_(oldest_ids)).returning(Timecode.card_id, Timecode.item)
+                )).all()
+                await card_progress.refresh(db, device_id, profile_id, (c for c, _ in trimmed))
+                await profile_changes.record_timecodes(db, device_id, profile_id, trimmed)
                 total_deleted += len(oldest_ids)
 
     if total_deleted:
@@ -838,6 +889,14 @@ async def _check_loop() -> None:
             await run_episodes_refresh()
         except Exception as e:
             logger.error(f"Episodes refresh failed: {e}", exc_info=True)
+        try:
+            await run_card_progress_refresh()
+        except Exception as e:
+            logger.error(f"Card progress refresh failed: {e}", exc_info=True)
+        try:
+            await run_profile_changes_prune()
+        except Exception as e:
+            logger.error(f"Profile changes prune failed: {e}", exc_info=True)
 
 
 async def _delivery_loop() -> None:
@@ -849,16 +908,28 @@ async def _delivery_loop() -> None:
             logger.error(f"Notification delivery failed: {e}", exc_info=True)
 
 
+async def _popular_loop() -> None:
+    from app import popular
+
+    while True:
+        try:
+            await run_popular_refresh()
+        except Exception as e:
+            logger.error(f"Popular ranking refresh failed: {e}", exc_info=True)
+        await asyncio.sleep(popular.REFRESH_SEC)
+
+
 def start_tasks() -> None:
-    global _check_task, _delivery_task
+    global _check_task, _delivery_task, _popular_task
     _check_task = asyncio.create_task(_check_loop())
     _delivery_task = asyncio.create_task(_delivery_loop())
+    _popular_task = asyncio.create_task(_popular_loop())
     logger.info("Background tasks started")
 
 
 def stop_tasks() -> None:
-    global _check_task, _delivery_task
-    for t in (_check_task, _delivery_task):
+    global _check_task, _delivery_task, _popular_task
+    for t in (_check_task, _delivery_task, _popular_task):
         if t:
             t.cancel()
-    _check_task = _delivery_task = None
+    _check_task = _delivery_task = _popular_task = None
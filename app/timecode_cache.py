@@ -0,0 +1,158 @@
+"""
+In-memory кэш таймкодов профиля для фильтрации каталога (per-process).
+
+Снимок {card_id: {item: data_json}} (и {card_id: {item: percent}} — для
+фильтров, без разбора JSON) на (device_id, lampa_profile_id) читается
+из БД один раз и дальше отдаётся из памяти: Lampa при открытии главного экрана
+запрашивает ~14 категорий подряд, и все они фильтруются по одному снимку.
+Производные данные (просмотренные фильмы по порогу) кэшируются внутри снимка;
+эпизоды сериалов — общие для всех, в episode_registry.
+
+Все пути записи таймкодов обязаны либо патчить снимок (patch), либо
+сбрасывать его (invalidate). Снимок неизменяем: patch создаёт новый объект,
+так что запрос, уже получивший снимок, не увидит половину изменения.
+Версии ключей защищают от гонки «загрузка из БД vs запись»: снимок,
+прочитанный до записи, в кэш не попадёт.
+"""
+import logging
+import time
+from collections import OrderedDict
+from typing import Iterable
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import Timecode
+
+logger = logging.getLogger(__name__)
+
+_MAX_SNAPSHOTS = 2000
+# Страховка от записей мимо кэша (ручные правки БД и т.п.)
+_TTL_SEC = 600
+
+
+class Snapshot:
+    __slots__ = ("timecodes", "percents", "loaded_at", "_watched")
+
+    def __init__(
+        self,
+        timecodes: dict[str, dict[str, str]],
+        percents: dict[str, dict[str, float]],
+        loaded_at: float,
+    ):
+        self.timecodes = timecodes
+        self.percents = percents
+        self.loaded_at = loaded_at
+        self._watched: dict[int | None, set[str]] = {}
+
+    def watched_movies(self, threshold: int | None = None) -> set[str]:
+        """card_id фильмов, просмотренных на >= threshold (кэшируется по порогу)."""
+        watched = self._watched.get(threshold)
+        if watched is None:
+            from app.api.timecodes import get_watched_movie_ids
+            watched = get_watched_movie_ids(self.percents, threshold=threshold)
+            self._watched[threshold] = watched
+        return watched
+
+    def tv_tmdb_ids(self) -> list[int]:
+        """tmdb_id сериалов, по которым у профиля есть таймкоды."""
+        return [
+            int(k[:-3]) for k in self.timecodes
+            if k.endswith("_tv") and k[:-3].isdigit()
+        ]
+
+
+_snapshots: "OrderedDict[tuple[int, str], Snapshot]" = OrderedDict()
+_versions: dict[tuple[int, str], int] = {}
+_device_versions: dict[int, int] = {}
+_global_version = 0
+_hits = 0
+_misses = 0
+
+
+def _version(key: tuple[int, str]) -> tuple[int, int, int]:
+    return _global_version, _device_versions.get(key[0], 0), _versions.get(key, 0)
+
+
+def _bump(key: tuple[int, str]) -> None:
+    _versions[key] = _versions.get(key, 0) + 1
+
+
+async def get_snapshot(db: AsyncSession, device_id: int, lampa_profile_id: str = "") -> Snapshot:
+    """Снимок таймкодов профиля: из памяти, при промахе — одним запросом из БД."""
+    global _hits, _misses
+    key = (device_id, lampa_profile_id)
+    snap = _snapshots.get(key)
+    if snap is not None and time.monotonic() - snap.loaded_at < _TTL_SEC:
+        _snapshots.move_to_end(key)
+        _hits += 1
+        return snap
+
+    _misses += 1
+    version = _version(key)
+    from app.api.timecodes import _row_percent
+
+    rows = await db.execute(
+        select(Timecode.card_id, Timecode.item, Timecode.data, Timecode.percent).where(
+            Timecode.device_id == device_id,
+            Timecode.lampa_profile_id == lampa_profile_id,
+        )
+    )
+    timecodes: dict[str, dict[str, str]] = {}
+    percents: dict[str, dict[str, float]] = {}
+    for card_id, item, data, percent in rows.all():
+        timecodes.setdefault(card_id, {})[item] = data
+        percents.setdefault(card_id, {})[item] = _row_percent(percent, data)
+
+    snap = Snapshot(timecodes, percents, time.monotonic())
+    if _version(key) == version:  # за время запроса никто не писал
+        _snapshots[key] = snap
+        _snapshots.move_to_end(key)
+        while len(_snapshots) > _MAX_SNAPSHOTS:
+            _snapshots.popitem(last=False)
+    return snap
+
+
+def patch(device_id: int, lampa_profile_id: str, rows: Iterable[tuple[str, str, str]]) -> None:
+    """Записывает в снимок upsert'нутые таймкоды: rows = [(card_id, item, data), ...]."""
+    key = (device_id, lampa_profile_id)
+    _bump(key)
+    snap = _snapshots.get(key)
+    if snap is None:
+        return
+    from app.api.timecodes import _row_percent
+
+    timecodes = dict(snap.timecodes)
+    percents = dict(snap.percents)
+    touched: set[str] = set()
+    for card_id, item, data in rows:
+        if card_id not in touched:
+            timecodes[card_id] = dict(timecodes.get(card_id) or {})
+            percents[card_id] = dict(percents.get(card_id) or {})
+            touched.add(card_id)
+        timecodes[card_id][item] = data
+        percents[card_id][item] = _row_percent(None, data)
+    _snapshots[key] = Snapshot(timecodes, percents, snap.loaded_at)
+
+
+def invalidate(device_id: int, lampa_profile_id: str | None = None) -> None:
+    """Сбрасывает снимок профиля; без lampa_profile_id — все профили устройства."""
+    if lampa_profile_id is None:
+        _device_versions[device_id] = _device_versions.get(device_id, 0) + 1
+        for key in [k for k in _snapshots if k[0] == device_id]:
+            del _snapshots[key]
+        return
+    key = (device_id, lampa_profile_id)
+    _bump(key)
+    _snapshots.pop(key, None)
+
+
+def invalidate_all() -> None:
+    """Сбрасывает все снимки (массовые удаления фоновыми задачами)."""
+    global _global_version
+    _global_version += 1
+    _snapshots.clear()
+
+
+def info() -> dict:
+    return {"snapshots": len(_snapshots), "hits": _hits, "misses": _misses}
@@ -0,0 +1,146 @@
+"""
+Микро-пачки записи таймкодов, присланных через WebSocket /timecode/ws.
+
+Плагин шлёт прогресс кадрами в уже открытый сокет вместо POST /timecode:
+авторизация и роль определяются один раз на соединение, а сами записи
+копятся здесь BATCH_WINDOW_SEC и пишутся одной сессией БД — на каждую
+пару (устройство, профиль) один UPSERT пачки, один подсчёт лимита и один
+commit (timecodes.write_ws_batch), сколько бы кадров ни пришло за окно.
+
+submit() возвращает Future, который завершается после commit пачки номером
+записи в журнале изменений профиля (или с исключением, если пачку записать не удалось) — по нему сокет
+отправляет клиенту ack с номером кадра. При остановке пачка в записи
+не прерывается, накопленное дописывается.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.database import async_session_maker
+
+logger = logging.getLogger(__name__)
+
+BATCH_WINDOW_SEC = 0.2
+# Больше ожидающих записей — клиент получает отказ и пишет через HTTP
+MAX_PENDING = 5000
+
+
+@dataclass(slots=True)
+class Write:
+    device_id: int
+    role: str
+    lampa_profile_id: str
+    profile_name: str | None
+    card_id: str
+    item: str
+    data: str
+    seq: int | None = None  # номер в журнале изменений профиля (после записи)
+    done: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+
+class Overloaded(RuntimeError):
+    """Очередь записи переполнена."""
+
+
+# (db, записи одной пары устройство/профиль) → запись с commit
+Flush = Callable[[AsyncSession, list[Write]], Awaitable[None]]
+
+_flush: Flush | None = None
+_queue: list[Write] = []
+_wakeup: asyncio.Event | None = None
+_task: asyncio.Task | None = None
+_stopping = False
+_stats = {"writes": 0, "batches": 0, "failed": 0, "rejected": 0}
+
+
+def submit(write: Write) -> asyncio.Future:
+    """Ставит запись в очередь; Future завершится после commit её пачки (результат — seq)."""
+    if _wakeup is None or len(_queue) >= MAX_PENDING:
+        _stats["rejected"] += 1
+        raise Overloaded("очередь записи таймкодов переполнена")
+    _queue.append(write)
+    _wakeup.set()
+    return write.done
+
+
+async def _write_all(writes: list[Write]) -> None:
+    groups: dict[tuple[int, str], list[Write]] = {}
+    for w in writes:
+        groups.setdefault((w.device_id, w.lampa_profile_id), []).append(w)
+
+    async with async_session_maker() as db:
+        for group in groups.values():
+            try:
+                await _flush(db, group)
+            except Exception as e:
+                await db.rollback()
+                _stats["failed"] += len(group)
+                logger.warning(
+                    f"timecode_writes: пачка device={group[0].device_id} "
+                    f"profile={group[0].lampa_profile_id!r} не записана: {e}"
+                )
+                for w in group:
+                    if not w.done.done():
+                        w.done.set_exception(e)
+                continue
+            _stats["writes"] += len(group)
+            _stats["batches"] += 1
+            for w in group:
+                if not w.done.done():
+                    w.done.set_result(w.seq)
+
+
+async def _drain() -> None:
+    writes = _queue[:]
+    _queue.clear()
+    if not writes:
+        return
+    try:
+        await _write_all(writes)
+    except Exception as e:
+        # Сбой вне пачек (например, не открылась сессия) — отказ всем ожидающим
+        logger.error(f"timecode_writes: сбой записи: {e}")
+        for w in writes:
+            if not w.done.done():
+                w.done.set_exception(e)
+
+
+async def _loop() -> None:
+    while not _stopping:
+        await _wakeup.wait()
+        # Окно накопления: кадры всех устройств за это время — одна пачка
+        await asyncio.sleep(BATCH_WINDOW_SEC)
+        _wakeup.clear()
+        await _drain()
+
+
+def start(flush: Flush) -> None:
+    global _flush, _wakeup, _task, _stopping
+    _flush = flush
+    _stopping = False
+    _wakeup = asyncio.Event()
+    _task = asyncio.create_task(_loop())
+
+
+async def stop() -> None:
+    """Останавливает цикл и дописывает накопленное."""
+    global _task, _wakeup, _stopping
+    _stopping = True
+    if _task is not None:
+        # Не cancel: отменённая посреди записи пачка откатилась бы, а её
+        # Future так и не завершились — цикл сам выходит после текущей пачки
+        _wakeup.set()
+        try:
+            await _task
+        except Exception as e:
+            logger.error(f"timecode_writes: цикл завершился с ошибкой: {e}")
+        _task = None
+    _wakeup = None
+    await _drain()
+
+
+def info() -> dict:
+    return {"pending": len(_queue), **_stats}
@@ -0,0 +1,383 @@
+"""
+Ограниченный in-memory кэш TMDB-метаданных каталога (per-process).
+
+Раньше весь media_cards грузился при старте в dict словарей — память росла
+вместе с таблицей. Теперь кэш — LRU на _MAX_ENTRIES компактных записей
+(_Record со __slots__, сезоны — кортежи, а не словари); промахи добираются
+из media_cards одним запросом на пачку ключей (get_many), отсутствующие в БД
+ключи ненадолго запоминаются, чтобы не спрашивать БД на каждом запросе.
+
+Запись ведёт себя как read-only словарь в формате ответа TMDB
+(`rec.get("name")`, `rec.get("seasons")`) — код обогащения каталога
+работает с ней так же, как со старыми dict-записями.
+
+Прогрев не блокирует старт: start() запускает фоновую задачу, которая
+читает media_cards потоково (server-side cursor, только нужные колонки,
+пачками по _WARM_CHUNK, свежие карточки первыми) до заполнения кэша.
+Пока прогрев идёт, промахи обслуживаются get_many из БД; прогресс —
+warm_up_status() (/ready).
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Iterable
+
+from sqlalchemy import func, select
+
+from app.db.database import async_session_maker
+from app.db.models import MediaCard
+
+logger = logging.getLogger(__name__)
+
+_MAX_ENTRIES = 50000
+# Сколько помнить, что карточки нет в media_cards (её догрузит TMDB-запрос)
+_ABSENT_TTL_SEC = 300
+_MAX_ABSENT = 50000
+_DB_CHUNK = 5000
+_WARM_CHUNK = 2000
+
+# Порядок полей сезона в компактном кортеже
+_SEASON_FIELDS = (
+    "air_date", "episode_count", "id", "name", "overview",
+    "poster_path", "season_number", "vote_average",
+)
+
+# Имя поля TMDB → слот записи
+_COMMON = {
+    "poster_path": "poster_path",
+    "backdrop_path": "backdrop_path",
+    "overview": "overview",
+    "vote_average": "vote_average",
+}
+_MOVIE_FIELDS = {
+    **_COMMON,
+    "title": "title",
+    "original_title": "original_title",
+    "release_date": "date",
+}
+_TV_FIELDS = {
+    **_COMMON,
+    "name": "title",
+    "original_name": "original_title",
+    "first_air_date": "date",
+    "last_air_date": "last_air_date",
+    "number_of_seasons": "number_of_seasons",
+}
+
+Key = tuple[str, int]
+
+
+class _Record:
+    __slots__ = (
+        "media_type", "title", "original_title", "poster_path", "backdrop_path",
+        "overview", "vote_average", "date", "last_air_date", "number_of_seasons",
+        "seasons", "last_ep",
+    )
+
+    def __init__(self, media_type: str, **fields):
+        self.media_type = media_type
+        self.title = fields.get("title") or ""
+        self.original_title = fields.get("original_title") or ""
+        self.poster_path = fields.get("poster_path") or ""
+        self.backdrop_path = fields.get("backdrop_path") or ""
+        self.overview = fields.get("overview") or ""
+        self.vote_average = fields.get("vote_average") or 0
+        self.date = fields.get("date") or ""
+        self.last_air_date = fields.get("last_air_date") or ""
+        self.number_of_seasons = fields.get("number_of_seasons") or 0
+        self.seasons: tuple[tuple, ...] = fields.get("seasons") or ()
+        self.last_ep: tuple[int, int] | None = fields.get("last_ep")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        fields = _TV_FIELDS if self.media_type == "tv" else _MOVIE_FIELDS
+        slot = fields.get(key)
+        if slot is not None:
+            return getattr(self, slot)
+        if self.media_type == "tv":
+            if key == "seasons":
+                return [dict(zip(_SEASON_FIELDS, s)) for s in self.seasons]
+            if key == "last_episode_to_air":
+                if self.last_ep is None:
+                    return None
+                return {"season_number": self.last_ep[0], "episode_number": self.last_ep[1]}
+        return default
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def as_dict(self) -> dict:
+        keys = _TV_FIELDS if self.media_type == "tv" else _MOVIE_FIELDS
+        out = {k: self.get(k) for k in keys}
+        if self.media_type == "tv":
+            out["seasons"] = self.get("seasons")
+            out["last_episode_to_air"] = self.get("last_episode_to_air")
+        return out
+
+
+_MISSING = object()
+
+
+def _compact_seasons(seasons: list | None) -> tuple[tuple, ...]:
+    if not seasons:
+        return ()
+    return tuple(
+        tuple(s.get(f) for f in _SEASON_FIELDS)
+        for s in seasons if isinstance(s, dict)
+    )
+
+
+def _last_ep(season: int | None, episode: int | None) -> tuple[int, int] | None:
+    return (season, episode) if season and episode else None
+
+
+def from_tmdb(media_type: str, data: dict) -> _Record:
+    """Запись из полного ответа TMDB API /{media_type}/{id}."""
+    if media_type == "movie":
+        return _Record(
+            "movie",
+            title=data.get("title"),
+            original_title=data.get("original_title"),
+            poster_path=data.get("poster_path"),
+            backdrop_path=data.get("backdrop_path"),
+            overview=data.get("overview"),
+            vote_average=data.get("vote_average"),
+            date=data.get("release_date"),
+        )
+    last_ep = data.get("last_episode_to_air") or {}
+    return _Record(
+        "tv",
+        title=data.get("name"),
+        original_title=data.get("original_name"),
+        poster_path=data.get("poster_path"),
+        backdrop_path=data.get("backdrop_path"),
+        overview=data.get("overview"),
+        vote_average=data.get("vote_average"),
+        date=data.get("first_air_date"),
+        last_air_date=data.get("last_air_date"),
+        number_of_seasons=data.get("number_of_seasons"),
+        seasons=_compact_seasons(data.get("seasons")),
+        last_ep=_last_ep(last_ep.get("season_number"), last_ep.get("episode_number")),
+    )
+
+
+def _from_row(row) -> _Record:
+    seasons = ()
+    if row.media_type == "tv" and row.seasons_json:
+        try:
+            seasons = _compact_seasons(json.loads(row.seasons_json))
+        except Exception:
+            pass
+    return _Record(
+        row.media_type,
+        title=row.title,
+        original_title=row.original_title,
+        poster_path=row.poster_path,
+        backdrop_path=row.backdrop_path,
+        overview=row.overview,
+        vote_average=row.vote_average,
+        date=row.release_date,
+        last_air_date=row.last_air_date,
+        number_of_seasons=row.number_of_seasons,
+        seasons=seasons,
+        last_ep=_last_ep(row.last_ep_season, row.last_ep_number),
+    )
+
+
+_ROW_COLUMNS = (
+    MediaCard.media_type, MediaCard.tmdb_id, MediaCard.title, MediaCard.original_title,
+    MediaCard.poster_path, MediaCard.backdrop_path, MediaCard.overview,
+    MediaCard.vote_average, MediaCard.release_date, MediaCard.last_air_date,
+    MediaCard.number_of_seasons, MediaCard.seasons_json,
+    MediaCard.last_ep_season, MediaCard.last_ep_number,
+)
+
+_entries: "OrderedDict[Key, _Record]" = OrderedDict()
+_absent: dict[Key, float] = {}
+_stats = {"hits": 0, "misses": 0, "evictions": 0, "db_loads": 0}
+_warm: dict[str, Any] = {"state": "pending", "loaded": 0, "total": None, "seconds": None}
+_warm_task: asyncio.Task | None = None
+
+
+def _card_id(key: Key) -> str:
+    return f"{key[1]}_{key[0]}"
+
+
+def put(key: Key, record: _Record) -> None:
+    _entries[key] = record
+    _entries.move_to_end(key)
+    _absent.pop(key, None)
+    while len(_entries) > _MAX_ENTRIES:
+        _entries.popitem(last=False)
+        _stats["evictions"] += 1
+
+
+def peek(key: Key) -> _Record | None:
+    """Запись из памяти без обновления LRU и счётчиков."""
+    return _entries.get(key)
+
+
+def get(key: Key) -> _Record | None:
+    """Запись из памяти (без обращения к БД)."""
+    rec = _entries.get(key)
+    if rec is None:
+        _stats["misses"] += 1
+        return None
+    _entries.move_to_end(key)
+    _stats["hits"] += 1
+    return rec
+
+
+async def get_many(keys: Iterable[Key]) -> dict[Key, _Record]:
+    """Записи для ключей: из памяти, промахи — пачкой из media_cards.
+
+    Ключи, которых нет и в БД, в результат не попадают.
+    """
+    found: dict[Key, _Record] = {}
+    missing: list[Key] = []
+    now = time.monotonic()
+    for key in dict.fromkeys(keys):
+        rec = _entries.get(key)
+        if rec is not None:
+            _entries.move_to_end(key)
+            found[key] = rec
+            continue
+        absent_at = _absent.get(key)
+        if absent_at is not None and now - absent_at < _ABSENT_TTL_SEC:
+            continue
+        missing.append(key)
+
+    _stats["hits"] += len(found)
+    _stats["misses"] += len(missing)
+    if not missing:
+        return found
+
+    try:
+        async with async_session_maker() as db:
+            for i in range(0, len(missing), _DB_CHUNK):
+                chunk = [_card_id(k) for k in missing[i:i + _DB_CHUNK]]
+                rows = await db.execute(select(*_ROW_COLUMNS).where(MediaCard.card_id.in_(chunk)))
+                for row in rows.all():
+                    key = (row.media_type, row.tmdb_id)
+                    rec = _from_row(row)
+                    put(key, rec)
+                    found[key] = rec
+        _stats["db_loads"] += 1
+    except Exception as e:
+        logger.error(f"tmdb_cache: ошибка загрузки из media_cards: {e}")
+        return found
+
+    if len(_absent) > _MAX_ABSENT:
+        _absent.clear()
+    for key in missing:
+        if key not in found:
+            _absent[key] = now
+    return found
+
+
+async def titles(keys: Iterable[Key]) -> dict[Key, tuple[str, str]]:
+    """(title, original_title) для ключей — из памяти или media_cards, без заполнения LRU."""
+    out: dict[Key, tuple[str, str]] = {}
+    missing: list[Key] = []
+    for key in dict.fromkeys(keys):
+        rec = _entries.get(key)
+        if rec is not None:
+            out[key] = (rec.title, rec.original_title)
+        else:
+            missing.append(key)
+    if not missing:
+        return out
+    async with async_session_maker() as db:
+        for i in range(0, len(missing), _DB_CHUNK):
+            chunk = [_card_id(k) for k in missing[i:i + _DB_CHUNK]]
+            rows = await db.execute(
+                select(
+                    MediaCard.media_type, MediaCard.tmdb_id,
+                    MediaCard.title, MediaCard.original_title,
+                ).where(MediaCard.card_id.in_(chunk))
+            )
+            for mt, tid, title, orig in rows.all():
+                out[(mt, tid)] = (title or "", orig or "")
+    return out
+
+
+async def _warm_up() -> None:
+    started = time.monotonic()
+    _warm.update(state="running", loaded=0, total=None, seconds=None)
+    try:
+        async with async_session_maker() as db:
+            _warm["total"] = min(
+                (await db.execute(select(func.count()).select_from(MediaCard))).scalar() or 0,
+                _MAX_ENTRIES,
+            )
+            stmt = (
+                select(*_ROW_COLUMNS)
+                .order_by(MediaCard.updated_at.desc().nulls_last())
+                .execution_options(yield_per=_WARM_CHUNK)
+            )
+            result = await db.stream(stmt)
+            async for rows in result.partitions():
+                for row in rows:
+                    key = (row.media_type, row.tmdb_id)
+                    if key in _entries:
+                        continue  # уже загружено запросом — не хуже прогрева
+                    # Прогрев идёт от свежих к старым: каждая следующая запись —
+                    # «старше» в LRU, живые обращения остаются в голове очереди
+                    _entries[key] = _from_row(row)
+                    _entries.move_to_end(key, last=False)
+                    _absent.pop(key, None)
+                _warm["loaded"] += len(rows)
+                if len(_entries) >= _MAX_ENTRIES:
+                    break
+                await asyncio.sleep(0)  # отдаём event loop запросам
+            await result.close()
+        _warm["state"] = "done"
+        logger.info(f"TMDB кэш прогрет: {len(_entries)} записей")
+    except asyncio.CancelledError:
+        _warm["state"] = "cancelled"
+        raise
+    except Exception as e:
+        # Кэш продолжает работать на промахах из БД
+        _warm["state"] = "failed"
+        logger.error(f"Ошибка прогрева TMDB кэша: {e}")
+    finally:
+        _warm["seconds"] = round(time.monotonic() - started, 2)
+
+
+def start() -> None:
+    """Запускает фоновый прогрев. Вызывается из lifespan."""
+    global _warm_task
+    if _warm_task is None or _warm_task.done():
+        _warm_task = asyncio.create_task(_warm_up())
+
+
+def stop() -> None:
+    if _warm_task is not None and not _warm_task.done():
+        _warm_task.cancel()
+
+
+def warm_up_status() -> dict:
+    return dict(_warm)
+
+
+def clear() -> None:
+    _entries.clear()
+    _absent.clear()
+
+
+def size() -> int:
+    return len(_entries)
+
+
+def info() -> dict:
+    return {
+        "size": len(_entries),
+        "max_size": _MAX_ENTRIES,
+        "absent": len(_absent),
+        "warm_up": _warm["state"],
+        **_stats,
+    }
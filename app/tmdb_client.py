@@ -0,0 +1,196 @@
+"""
+Общий асинхронный клиент TMDB API.
+
+Один долгоживущий httpx.AsyncClient на процесс (пул соединений, HTTP/2 —
+если установлен пакет h2) вместо отдельного клиента на каждый вызов.
+Все запросы к TMDB проходят через общие ограничители:
+
+  * семафор — не больше TMDB_MAX_CONCURRENCY запросов одновременно;
+  * token bucket — не больше TMDB_MAX_RPS запросов в секунду (лимит TMDB ~50 rps);
+  * повтор с экспоненциальной задержкой и jitter на 429/5xx и сетевые ошибки
+    (Retry-After от TMDB уважается).
+
+Одинаковые GET-запросы (путь + параметры, т.е. media_type / tmdb_id / language)
+объединяются: пока запрос в полёте, конкурентные вызовы ждут тот же результат.
+
+Базовый URL задаётся TMDB_API_URL — для тестов клиент можно направить на
+локальный stub-сервер.
+"""
+import asyncio
+import logging
+import random
+import time
+from typing import Any, NamedTuple
+
+import httpx
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+_MAX_RETRIES = 3
+_BACKOFF_BASE_SEC = 0.5
+_BACKOFF_MAX_SEC = 8.0
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TMDBError(Exception):
+    """TMDB недоступен: сетевая ошибка после всех повторов."""
+
+
+class TMDBResponse(NamedTuple):
+    status_code: int
+    data: Any  # распарсенный JSON при 200, иначе None
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        # Токен резервируется сразу (баланс может уйти в минус), ожидание — без
+        # блокировки: следующие вызовы встают в очередь за уже зарезервированными
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+_client: httpx.AsyncClient | None = None
+_loop: asyncio.AbstractEventLoop | None = None
+_semaphore: asyncio.Semaphore | None = None
+_bucket: _TokenBucket | None = None
+_inflight: dict[tuple, asyncio.Future] = {}
+_stats = {"requests": 0, "retries": 0, "coalesced": 0, "errors": 0}
+
+
+def _ensure_client() -> httpx.AsyncClient:
+    """Создаёт клиент и ограничители в текущем event loop (лениво, при первом запросе)."""
+    global _client, _loop, _semaphore, _bucket
+    loop = asyncio.get_running_loop()
+    if _client is not None and _loop is loop and not _client.is_closed:
+        return _client
+
+    settings = get_settings()
+    concurrency = max(1, settings.TMDB_MAX_CONCURRENCY)
+    _client = httpx.AsyncClient(
+        base_url=settings.TMDB_API_URL.rstrip("/"),
+        http2=_HTTP2,
+        timeout=_TIMEOUT,
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        headers={"Authorization": settings.TMDB_TOKEN, "Accept": "application/json"},
+    )
+    _loop = loop
+    _semaphore = asyncio.Semaphore(concurrency)
+    rps = max(1.0, float(settings.TMDB_MAX_RPS))
+    _bucket = _TokenBucket(rate=rps, capacity=rps)
+    _inflight.clear()
+    return _client
+
+
+def _retry_delay(attempt: int, resp: httpx.Response | None) -> float:
+    if resp is not None:
+        retry_after = resp.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(_BACKOFF_MAX_SEC, float(retry_after)) + random.uniform(0, _BACKOFF_BASE_SEC)
+            except ValueError:
+                pass
+    # full jitter: случайная пауза в [0, base * 2^attempt]
+    return random.uniform(0, min(_BACKOFF_MAX_SEC, _BACKOFF_BASE_SEC * 2 ** attempt))
+
+
+async def _request(path: str, params: dict) -> TMDBResponse:
+    client = _ensure_client()
+    for attempt in range(_MAX_RETRIES + 1):
+        resp = None
+        try:
+            # Токен — до семафора: ожидание лимита rps не занимает слот соединения
+            await _bucket.acquire()
+            async with _semaphore:
+                _stats["requests"] += 1
+                resp = await client.get(path, params=params)
+            if resp.status_code not in _RETRY_STATUSES:
+                data = resp.json() if resp.status_code == 200 else None
+                return TMDBResponse(resp.status_code, data)
+            if attempt == _MAX_RETRIES:
+                return TMDBResponse(resp.status_code, None)
+            logger.debug(f"TMDB {path}: {resp.status_code}, повтор #{attempt + 1}")
+        except httpx.TransportError as e:
+            if attempt == _MAX_RETRIES:
+                _stats["errors"] += 1
+                raise TMDBError(f"{path}: {e!r}") from e
+            logger.debug(f"TMDB {path}: {e!r}, повтор #{attempt + 1}")
+        _stats["retries"] += 1
+        await asyncio.sleep(_retry_delay(attempt, resp))
+    raise AssertionError("unreachable")
+
+
+def _consume_exception(fut: asyncio.Future) -> None:
+    # Если все ожидающие отменились — исключение не должно остаться «не полученным»
+    if not fut.cancelled():
+        fut.exception()
+
+
+async def get(path: str, params: dict | None = None) -> TMDBResponse:
+    """GET {TMDB_API_URL}{path}. Сетевые ошибки после повторов — TMDBError.
+
+    Конкурентные вызовы с тем же path/params делят один запрос.
+    """
+    params = {k: v for k, v in (params or {}).items() if v is not None}
+    key = (path, tuple(sorted((k, str(v)) for k, v in params.items())))
+    fut = _inflight.get(key)
+    if fut is None or fut.get_loop() is not asyncio.get_running_loop():
+        fut = asyncio.ensure_future(_request(path, params))
+        _inflight[key] = fut
+        fut.add_done_callback(lambda f: _inflight.pop(key, None) if _inflight.get(key) is f else None)
+        fut.add_done_callback(_consume_exception)
+    else:
+        _stats["coalesced"] += 1
+    # shield: отмена одного ожидающего не отменяет запрос для остальных
+    return await asyncio.shield(fut)
+
+
+async def get_json(path: str, params: dict | None = None) -> Any | None:
+    """JSON ответа при 200, иначе None. Сетевые ошибки — TMDBError."""
+    return (await get(path, params)).data
+
+
+async def details(
+    media_type: str,
+    tmdb_id: int,
+    language: str = "ru-RU",
+    append_to_response: str | None = None,
+) -> dict | None:
+    """Карточка /{media_type}/{tmdb_id}; None — не 200. Сетевые ошибки — TMDBError."""
+    return await get_json(
+        f"/{media_type}/{tmdb_id}",
+        {"language": language, "append_to_response": append_to_response},
+    )
+
+
+async def close() -> None:
+    """Закрывает пул соединений. Вызывается из lifespan при остановке."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    _inflight.clear()
+
+
+def info() -> dict:
+    return {"http2": _HTTP2, "inflight": len(_inflight), **_stats}
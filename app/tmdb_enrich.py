@@ -0,0 +1,104 @@
+"""
+Фоновая очередь догрузки TMDB-данных для каталога.
+
+В режиме nowait страница NUMParser-категории отдаётся сразу с полями из
+самого файла, а недостающие карточки ставятся сюда. Сюда же ставится
+следующая страница после отдачи текущей (prefetch) — к моменту прокрутки
+она уже в кэше.
+
+Воркер берёт ключи пачками, отсеивает уже известные (tmdb_cache / media_cards)
+и запрашивает остальное через fetch — main.fetch_tmdb_batch, который пишет
+в tmdb_cache, поисковый индекс и media_cards. Повторная постановка ключа,
+который уже ждёт в очереди, игнорируется; переполненная очередь
+отбрасывает новые ключи (их поставит следующий запрос страницы).
+Ключи, которые TMDB не отдал, не перезапрашиваются _RETRY_AFTER_SEC.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Iterable
+
+from app import tmdb_cache
+
+logger = logging.getLogger(__name__)
+
+_MAX_QUEUE = 5000
+_BATCH = 20
+_RETRY_AFTER_SEC = 3600
+
+Key = tuple[str, int]
+
+_fetch: Callable[[list[Key]], Awaitable[dict]] | None = None
+_queue: asyncio.Queue | None = None
+_queued: set[Key] = set()
+_failed: dict[Key, float] = {}
+_worker: asyncio.Task | None = None
+_stats = {"enqueued": 0, "dropped": 0, "fetched": 0}
+
+
+def enqueue(keys: Iterable[Key]) -> int:
+    """Ставит в очередь ключи, которых нет в памяти. Возвращает число поставленных."""
+    if _queue is None:
+        return 0
+    added = 0
+    now = time.monotonic()
+    for key in keys:
+        if key in _queued or tmdb_cache.peek(key) is not None:
+            continue
+        failed_at = _failed.get(key)
+        if failed_at is not None and now - failed_at < _RETRY_AFTER_SEC:
+            continue
+        try:
+            _queue.put_nowait(key)
+        except asyncio.QueueFull:
+            _stats["dropped"] += 1
+            break
+        _queued.add(key)
+        added += 1
+    _stats["enqueued"] += added
+    return added
+
+
+async def _run() -> None:
+    while True:
+        keys = [await _queue.get()]
+        while len(keys) < _BATCH and not _queue.empty():
+            keys.append(_queue.get_nowait())
+        try:
+            # Часть карточек уже может быть в media_cards — TMDB для них не нужен
+            known = await tmdb_cache.get_many(keys)
+            missing = [k for k in keys if k not in known]
+            if missing:
+                fetched = await _fetch(missing)
+                _stats["fetched"] += len(fetched)
+                if len(_failed) > _MAX_QUEUE:
+                    _failed.clear()
+                now = time.monotonic()
+                for key in missing:
+                    if key not in fetched:
+                        _failed[key] = now
+        except Exception as e:
+            logger.error(f"tmdb_enrich: ошибка догрузки {len(keys)} карточек: {e}")
+        finally:
+            _queued.difference_update(keys)
+
+
+def start(fetch: Callable[[list[Key]], Awaitable[dict]]) -> None:
+    """Запускает воркер. Вызывается из lifespan."""
+    global _fetch, _queue, _worker
+    _fetch = fetch
+    if _worker is None or _worker.done():
+        _queue = asyncio.Queue(maxsize=_MAX_QUEUE)
+        _queued.clear()
+        _worker = asyncio.create_task(_run())
+
+
+def stop() -> None:
+    global _worker
+    if _worker is not None:
+        _worker.cancel()
+        _worker = None
+
+
+def info() -> dict:
+    return {"queued": len(_queued), "failed": len(_failed), **_stats}
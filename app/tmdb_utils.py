@@ -6,31 +6,24 @@ import asyncio
 import json
 import logging
 
-import httpx
 from sqlalchemy import select
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 
-from app.config import get_settings
+from app import tmdb_client
 from app.db.database import async_session_maker
 from app.db.models import MediaCard
 
 logger = logging.getLogger(__name__)
-TMDB_TOKEN = get_settings().TMDB_TOKEN
 
 
 async def fetch_and_save_tv(tmdb_id: int) -> None:
     """Загружает данные сериала из TMDB и сохраняет в media_cards."""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(
-                f"https://api.themoviedb.org/3/tv/{tmdb_id}",
-                headers={"Authorization": TMDB_TOKEN},
-                params={"language": "ru"},
-            )
-            if resp.status_code != 200:
-                logger.warning(f"TMDB tv/{tmdb_id} вернул {resp.status_code}")
-                return
-            data = resp.json()
+        resp = await tmdb_client.get(f"/tv/{tmdb_id}", {"language": "ru-RU"})
+        if resp.status_code != 200:
+            logger.warning(f"TMDB tv/{tmdb_id} вернул {resp.status_code}")
+            return
+        data = resp.data
 
         date_val = data.get("first_air_date") or ""
         seasons = data.get("seasons")
@@ -71,16 +64,11 @@ async def fetch_and_save_tv(tmdb_id: int) -> None:
 async def fetch_and_save_movie(tmdb_id: int) -> None:
     """Загружает данные фильма из TMDB и сохраняет в media_cards."""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.get(
-                f"https://api.themoviedb.org/3/movie/{tmdb_id}",
-                headers={"Authorization": TMDB_TOKEN},
-                params={"language": "ru"},
-            )
-            if resp.status_code != 200:
-                logger.warning(f"TMDB movie/{tmdb_id} вернул {resp.status_code}")
-                return
-            data = resp.json()
+        resp = await tmdb_client.get(f"/movie/{tmdb_id}", {"language": "ru-RU"})
+        if resp.status_code != 200:
+            logger.warning(f"TMDB movie/{tmdb_id} вернул {resp.status_code}")
+            return
+        data = resp.data
 
         date_val = data.get("release_date") or ""
         card_id = f"{tmdb_id}_movie"
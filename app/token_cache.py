@@ -0,0 +1,150 @@
+"""
+In-memory кэш авторизации Lampa-запросов по token (per-process).
+
+get_device_by_token вызывается на каждый /timecode*, /{category},
+/api/plugin-settings и WebSocket — раньше это два запроса (Device по token,
+затем User). Здесь token → DeviceAuth (устройство, роль и состояние
+блокировки пользователя) живёт _TTL_SEC. Полная блокировка считается на
+каждый запрос из blocked_at / premium_until, так что истечение премиума
+сброса не требует. Неизвестные token тоже кэшируются: клиенты со старым
+token после его смены продолжают опрашивать сервер.
+
+Все изменения, влияющие на авторизацию, обязаны сбрасывать кэш:
+смена или удаление token устройства — invalidate_token, роль, блокировка,
+премиум, удаление пользователя или его устройств — invalidate_user
+(после commit). Массовые изменения фоновых задач — invalidate_all.
+Поколение защищает от гонки «чтение из БД vs сброс»: запись, прочитанная
+до сброса, в кэш не попадёт. Сброс рассылается остальным воркерам через
+cache_bus (с REDIS_URL — на все процессы и инстансы).
+"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+
+from app import cache_bus
+from app.db.models import Device, User
+
+_MAX_ENTRIES = 20000
+# Страховка от изменений мимо кэша (ручные правки БД и т.п.)
+_TTL_SEC = 300
+
+
+@dataclass(frozen=True, slots=True)
+class DeviceAuth:
+    device_id: int
+    user_id: int
+    role: str
+    blocked_at: datetime | None
+    premium_until: datetime | None
+
+    @classmethod
+    def from_rows(cls, device: Device, user: User | None) -> "DeviceAuth":
+        return cls(
+            device_id=device.id,
+            user_id=device.user_id,
+            role=user.role if user else "simple",
+            blocked_at=user.blocked_at if user else None,
+            premium_until=user.premium_until if user else None,
+        )
+
+    def device(self, token: str) -> Device:
+        """Отсоединённый Device для зависимостей — только для чтения (id, user_id, token)."""
+        return Device(id=self.device_id, user_id=self.user_id, token=token)
+
+
+# Отличает «нет в кэше» от закэшированного «token не найден» (None)
+MISS = object()
+
+_entries: "OrderedDict[str, tuple[DeviceAuth | None, float]]" = OrderedDict()
+_by_user: dict[int, set[str]] = {}
+_generation = 0
+_hits = 0
+_misses = 0
+
+
+def generation() -> int:
+    """Текущее поколение — запомнить до чтения из БД и передать в put()."""
+    return _generation
+
+
+def get(token: str) -> "DeviceAuth | None | object":
+    """DeviceAuth, None (token не существует) или MISS."""
+    global _hits, _misses
+    entry = _entries.get(token)
+    if entry is None or time.monotonic() - entry[1] > _TTL_SEC:
+        _misses += 1
+        return MISS
+    _hits += 1
+    return entry[0]
+
+
+def put(token: str, auth: DeviceAuth | None, gen: int) -> None:
+    if gen != _generation:
+        return  # между чтением и записью был сброс — данные могли устареть
+    _drop(token)
+    _entries[token] = (auth, time.monotonic())
+    if auth is not None:
+        _by_user.setdefault(auth.user_id, set()).add(token)
+    while len(_entries) > _MAX_ENTRIES:
+        _drop(next(iter(_entries)))
+
+
+def role(user_id: int) -> str | None:
+    """Роль пользователя из кэша (None — нет записей его устройств)."""
+    now = time.monotonic()
+    for token in _by_user.get(user_id, ()):
+        auth, loaded_at = _entries[token]
+        if now - loaded_at <= _TTL_SEC:
+            return auth.role
+    return None
+
+
+def _drop(token: str) -> None:
+    entry = _entries.pop(token, None)
+    if entry is not None and entry[0] is not None:
+        tokens = _by_user.get(entry[0].user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del _by_user[entry[0].user_id]
+
+
+def _apply(op: str, arg) -> None:
+    """Сброс в этом процессе: op — "token" | "user" | "all"."""
+    global _generation
+    _generation += 1
+    if op == "token":
+        if arg:
+            _drop(arg)
+    elif op == "user":
+        for token in list(_by_user.get(arg, ())):
+            _drop(token)
+    else:
+        _entries.clear()
+        _by_user.clear()
+
+
+def invalidate_token(token: str | None) -> None:
+    """Сбрасывает token (смена token, удаление устройства)."""
+    _apply("token", token)
+    cache_bus.notify("token", "token", token)
+
+
+def invalidate_user(user_id: int) -> None:
+    """Сбрасывает все token пользователя (роль, блокировка, премиум, удаление)."""
+    _apply("user", user_id)
+    cache_bus.notify("token", "user", user_id)
+
+
+def invalidate_all() -> None:
+    """Сбрасывает весь кэш (массовые изменения фоновыми задачами)."""
+    _apply("all", None)
+    cache_bus.notify("token", "all")
+
+
+cache_bus.register("token", _apply)
+
+
+def info() -> dict:
+    return {"entries": len(_entries), "hits": _hits, "misses": _misses}
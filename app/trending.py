@@ -0,0 +1,141 @@
+"""
+Трендовый счёт карточек — таблица card_trending.
+
+Счёт карточки — сумма засчитанных просмотров (тех же, что увеличивают
+timecodes.view_count: _upsert_timecodes, отметка «просмотрено»), где каждый
+просмотр затухает экспоненциально: вес exp(-возраст / τ), τ = popular_period_days.
+Суммарный вес одного просмотра равен весу в плоском окне той же длины, но без
+резкой границы: свежие просмотры весят больше, старые уходят плавно.
+
+Хранится пара (score, scored_at): счёт на момент scored_at. Новые просмотры
+копятся в памяти — record() за O(1) на событие — и раз в FLUSH_SEC пишутся
+пачкой одним UPSERT: score = score · exp(-Δt / τ) + новые. Затухание внутри
+интервала сброса (секунды против τ в днях) не учитывается. Текущий счёт
+для ранжирования — decayed(); рейтинг np_popular строится по нему
+(app/popular.py), без агрегатов по timecodes.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Iterable
+
+from sqlalchemy import delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import settings_cache
+from app.db.bulk import bulk_upsert
+from app.db.database import async_session_maker
+from app.db.models import CardTrending
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SEC = 30
+# Карточки со счётом ниже — забытые, строка удаляется
+MIN_SCORE = 0.01
+# exp(-700) ≈ 1e-304: дальше PostgreSQL падает с underflow
+_MAX_EXP = 700
+
+_pending: defaultdict[str, float] = defaultdict(float)
+_task: asyncio.Task | None = None
+_stats = {"recorded": 0, "flushed": 0, "flush_errors": 0}
+
+
+def tau_days() -> float:
+    """Характерное время затухания (дней)."""
+    return float(settings_cache.get_int("popular_period_days") or 30)
+
+
+def _decay(since):
+    """exp(-(now() - since) / τ) в SQL."""
+    age_days = func.extract("epoch", func.now() - since) / 86400.0
+    return func.exp(-func.least(age_days / tau_days(), _MAX_EXP))
+
+
+def decayed():
+    """SQL-выражение текущего счёта строки card_trending."""
+    return CardTrending.score * _decay(CardTrending.scored_at)
+
+
+def record(card_ids: Iterable[str], views: float = 1.0) -> None:
+    """Засчитанные просмотры карточек — копятся до следующего flush()."""
+    for card_id in card_ids:
+        _pending[card_id] += views
+        _stats["recorded"] += 1
+
+
+async def flush() -> int:
+    """Пишет накопленные просмотры в card_trending. Возвращает число карточек."""
+    global _pending
+    if not _pending:
+        return 0
+    batch, _pending = _pending, defaultdict(float)
+
+    now = datetime.now(timezone.utc)
+    rows = [
+        {"card_id": card_id, "score": views, "scored_at": now}
+        for card_id, views in batch.items()
+    ]
+    try:
+        async with async_session_maker() as db:
+            await bulk_upsert(
+                db, CardTrending, rows, ["card_id"],
+                lambda excluded: {
+                    "score": (
+                        CardTrending.score
+                        * func.exp(-func.least(
+                            func.extract("epoch", excluded.scored_at - CardTrending.scored_at)
+                            / 86400.0 / tau_days(),
+                            _MAX_EXP,
+                        ))
+                        + excluded.score
+                    ),
+                    "scored_at": excluded.scored_at,
+                },
+            )
+            await db.commit()
+    except Exception:
+        # Не теряем просмотры — вернутся в следующую пачку
+        for card_id, views in batch.items():
+            _pending[card_id] += views
+        _stats["flush_errors"] += 1
+        raise
+    _stats["flushed"] += len(rows)
+    return len(rows)
+
+
+async def prune(db: AsyncSession) -> None:
+    """Удаляет затухшие карточки (без commit)."""
+    await db.execute(delete(CardTrending).where(decayed() < MIN_SCORE))
+
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(FLUSH_SEC)
+        try:
+            await flush()
+        except Exception as e:
+            logger.error(f"trending: flush failed: {e}")
+
+
+def start() -> None:
+    """Запускает периодический сброс. Вызывается из lifespan."""
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_flush_loop())
+
+
+async def stop() -> None:
+    """Останавливает сброс и пишет накопленное."""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+    try:
+        await flush()
+    except Exception as e:
+        logger.error(f"trending: final flush failed: {e}")
+
+
+def info() -> dict:
+    return {"pending": len(_pending), "tau_days": tau_days(), **_stats}
@@ -0,0 +1,152 @@
+"""
+Бэкенд рассылки WebSocket-сообщений между воркерами.
+
+Сокеты живут в памяти процесса (ws_manager.ConnectionManager) — каждый
+воркер доставляет сообщения только своим соединениям. Рассылка идёт через
+бэкенд: publish(channel, user_id, sender, message) → на каждом воркере
+вызывается доставщик канала, зарегистрированный register().
+
+  LocalBackend — по умолчанию, один процесс: доставка сразу, без сети.
+  RedisBackend — REDIS_URL задан: Redis pub/sub, одно сообщение видят все
+                 воркеры и инстансы за nginx.
+
+Каналы: "timecode" (/timecode/ws), "plugin_settings" (/api/plugin-settings/ws),
+"cache" — сброс кэшей авторизации на всех воркерах (app/cache_bus.py).
+Если Redis недоступен при публикации — сообщение доставляется хотя бы
+локальным соединениям.
+"""
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+_PREFIX = "movies-api:ws:"
+_RECONNECT_SEC = 1.0
+
+# (user_id, sender_conn_id, message) → доставка локальным соединениям
+Deliver = Callable[[int, str | None, dict], Awaitable[None]]
+
+_handlers: dict[str, Deliver] = {}
+_stats = {"published": 0, "received": 0, "errors": 0}
+
+
+def register(channel: str, deliver: Deliver) -> None:
+    """Доставщик канала на этом воркере (вызывается при создании менеджера соединений)."""
+    _handlers[channel] = deliver
+
+
+async def _deliver(channel: str, user_id: int, sender: str | None, message: dict) -> None:
+    handler = _handlers.get(channel)
+    if handler is None:
+        return
+    try:
+        await handler(user_id, sender, message)
+    except Exception as e:
+        _stats["errors"] += 1
+        logger.warning(f"ws_broadcast: доставка в {channel} не удалась: {e}")
+
+
+class LocalBackend:
+    name = "local"
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, channel: str, user_id: int, sender: str | None, message: dict) -> None:
+        await _deliver(channel, user_id, sender, message)
+
+
+class RedisBackend:
+    name = "redis"
+
+    def __init__(self, url: str):
+        self._url = url
+        self._redis = None
+        self._pubsub = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        import redis.asyncio as aioredis
+
+        self._redis = aioredis.from_url(self._url)
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.psubscribe(f"{_PREFIX}*")
+        self._task = asyncio.create_task(self._listen())
+        logger.info("ws_broadcast: Redis pub/sub подключён")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        if self._redis is not None:
+            await self._redis.aclose()
+
+    async def publish(self, channel: str, user_id: int, sender: str | None, message: dict) -> None:
+        payload = json.dumps({"u": user_id, "s": sender, "m": message}, ensure_ascii=False)
+        try:
+            await self._redis.publish(_PREFIX + channel, payload)
+        except Exception as e:
+            _stats["errors"] += 1
+            logger.warning(f"ws_broadcast: Redis недоступен, доставка только локально: {e}")
+            await _deliver(channel, user_id, sender, message)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async for msg in self._pubsub.listen():
+                    if msg["type"] != "pmessage":
+                        continue
+                    channel = msg["channel"].decode()[len(_PREFIX):]
+                    data = json.loads(msg["data"])
+                    _stats["received"] += 1
+                    # Медленные сокеты не должны задерживать чтение подписки
+                    asyncio.create_task(_deliver(channel, data["u"], data["s"], data["m"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # pubsub переподписывается на каналы при переподключении
+                _stats["errors"] += 1
+                logger.warning(f"ws_broadcast: подписка Redis прервалась: {e}")
+                await asyncio.sleep(_RECONNECT_SEC)
+
+
+_backend: LocalBackend | RedisBackend = LocalBackend()
+
+
+async def start() -> None:
+    """Выбирает бэкенд по REDIS_URL. Вызывается из lifespan."""
+    global _backend
+    url = get_settings().REDIS_URL
+    if url:
+        backend = RedisBackend(url)
+        try:
+            await backend.start()
+            _backend = backend
+        except Exception as e:
+            logger.error(f"ws_broadcast: Redis недоступен ({e}) — рассылка только внутри процесса")
+            await backend.stop()
+
+
+async def stop() -> None:
+    global _backend
+    await _backend.stop()
+    _backend = LocalBackend()
+
+
+async def publish(channel: str, user_id: int, sender: str | None, message: dict) -> None:
+    """Рассылает сообщение соединениям пользователя на всех воркерах (кроме sender)."""
+    _stats["published"] += 1
+    await _backend.publish(channel, user_id, sender, message)
+
+
+def info() -> dict:
+    return {"backend": _backend.name, **_stats}
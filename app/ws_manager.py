@@ -1,52 +1,184 @@
 """
-WebSocket Connection Manager — рассылка обновлений таймкодов между устройствами одного пользователя.
+WebSocket Connection Manager — рассылка обновлений между устройствами одного пользователя.
+
+Соединения хранятся в памяти воркера; broadcast публикует сообщение через
+ws_broadcast (in-process или Redis pub/sub), и каждый воркер доставляет его
+своим соединениям пользователя — deliver_local.
+
+У каждого соединения своя ограниченная очередь и задача-писатель: deliver_local
+только кладёт сообщение в очереди и не ждёт сокетов, так что медленный
+или полумёртвый клиент не задерживает остальные устройства пользователя.
+Таймкод, ещё не отправленный клиенту, заменяется более свежим для того же
+(profile_id, card_id, item). Переполненная очередь или отправка дольше
+SEND_TIMEOUT_SEC — соединение закрывается, клиент переподключится.
+Мёртвые соединения без трафика находит ping/pong протокола (uvicorn
+--ws-ping-interval / --ws-ping-timeout): receive в эндпоинте падает → disconnect.
 """
+import asyncio
+import itertools
 import logging
 import uuid
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 from fastapi import WebSocket
 
+from app import ws_broadcast
+
 logger = logging.getLogger(__name__)
 
+QUEUE_MAX = 100
+SEND_TIMEOUT_SEC = 10
+
+# 1013 Try Again Later — клиент не успевает читать; 1011 — ошибка отправки
+_CLOSE_SLOW = 1013
+_CLOSE_ERROR = 1011
+
+_seq = itertools.count()
+
+
+def _coalesce_key(message: dict) -> tuple | None:
+    """Ключ, по которому более свежее сообщение вытесняет неотправленное."""
+    if message.get("type") == "timecode":
+        return ("timecode", message.get("profile_id"), message.get("card_id"), message.get("item"))
+    return None
+
+
+class _Connection:
+    __slots__ = ("ws", "pending", "wakeup", "writer")
+
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        # ключ (coalesce-ключ или порядковый номер) -> сообщение, в порядке отправки
+        self.pending: "OrderedDict[object, dict]" = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.writer: asyncio.Task | None = None
+
 
 class ConnectionManager:
-    def __init__(self):
-        # user_id -> {conn_id: WebSocket}
+    def __init__(self, channel: str):
+        self.channel = channel
+        # user_id -> {conn_id: _Connection}
         # conn_id — UUID на каждое соединение, чтобы несколько устройств с одним токеном сосуществовали
-        self._connections: dict[int, dict[str, WebSocket]] = defaultdict(dict)
+        self._connections: dict[int, dict[str, _Connection]] = defaultdict(dict)
+        self._stats = {"sent": 0, "coalesced": 0, "closed_slow": 0, "send_errors": 0}
+        ws_broadcast.register(channel, self.deliver_local)
 
     async def connect(self, user_id: int, ws: WebSocket) -> str:
         """Принимает соединение, возвращает уникальный conn_id."""
         await ws.accept()
         conn_id = str(uuid.uuid4())
-        self._connections[user_id][conn_id] = ws
-        logger.debug(f"WS connected: user={user_id} conn={conn_id}")
+        conn = _Connection(ws)
+        conn.writer = asyncio.create_task(self._write_loop(user_id, conn_id, conn))
+        self._connections[user_id][conn_id] = conn
+        logger.debug(f"WS connected: channel={self.channel} user={user_id} conn={conn_id}")
         return conn_id
 
     def disconnect(self, user_id: int, conn_id: str) -> None:
-        user_conns = self._connections.get(user_id, {})
-        user_conns.pop(conn_id, None)
+        conn = self._remove(user_id, conn_id)
+        if conn is not None and conn.writer is not None and conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+        logger.debug(f"WS disconnected: channel={self.channel} user={user_id} conn={conn_id}")
+
+    def _remove(self, user_id: int, conn_id: str) -> _Connection | None:
+        user_conns = self._connections.get(user_id)
+        if not user_conns:
+            return None
+        conn = user_conns.pop(conn_id, None)
         if not user_conns:
             self._connections.pop(user_id, None)
-        logger.debug(f"WS disconnected: user={user_id} conn={conn_id}")
+        return conn
 
     async def broadcast(self, user_id: int, sender_conn_id: str | None, message: dict) -> None:
-        """Отправляет сообщение всем соединениям пользователя кроме отправителя."""
-        user_conns = self._connections.get(user_id, {})
-        logger.info(f"WS broadcast: user={user_id} conns={len(user_conns)} msg_type={message.get('type')}")
-        dead: list[str] = []
-        for conn_id, ws in list(user_conns.items()):
+        """Отправляет сообщение всем соединениям пользователя (на всех воркерах) кроме отправителя."""
+        await ws_broadcast.publish(self.channel, user_id, sender_conn_id, message)
+
+    async def deliver_local(self, user_id: int, sender_conn_id: str | None, message: dict) -> None:
+        """Ставит сообщение в очереди соединений пользователя на этом воркере (без ожидания сокетов)."""
+        user_conns = self._connections.get(user_id)
+        if not user_conns:
+            return
+        logger.debug(f"WS broadcast: user={user_id} conns={len(user_conns)} msg_type={message.get('type')}")
+        key = _coalesce_key(message)
+        for conn_id, conn in list(user_conns.items()):
             if conn_id == sender_conn_id:
                 continue
+            self._enqueue(user_id, conn_id, conn, message, key)
+
+    def send(self, user_id: int, conn_id: str, message: dict) -> None:
+        """Ставит сообщение в очередь одного соединения этого воркера (ответ клиенту)."""
+        conn = self._connections.get(user_id, {}).get(conn_id)
+        if conn is not None:
+            self._enqueue(user_id, conn_id, conn, message, None)
+
+    def _enqueue(self, user_id: int, conn_id: str, conn: _Connection, message: dict, key: tuple | None) -> None:
+        if key is not None and key in conn.pending:
+            # Неотправленный таймкод устарел — заменяется свежим, в конце очереди
+            # (seq журнала изменений приходит клиенту по возрастанию)
+            conn.pending[key] = message
+            conn.pending.move_to_end(key)
+            self._stats["coalesced"] += 1
+            return
+        if len(conn.pending) >= QUEUE_MAX:
+            logger.warning(f"WS slow consumer: channel={self.channel} user={user_id} conn={conn_id}, closing")
+            self._stats["closed_slow"] += 1
+            self._close(user_id, conn_id, conn, _CLOSE_SLOW)
+            return
+        conn.pending[key if key is not None else next(_seq)] = message
+        conn.wakeup.set()
+
+    async def close(self, user_id: int, conn_id: str, code: int, message: dict | None = None) -> None:
+        """Закрывает соединение этого воркера; message — последний кадр перед закрытием."""
+        conn = self._remove(user_id, conn_id)
+        if conn is None:
+            return
+        if conn.writer is not None and conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+        conn.pending.clear()
+        if message is not None:
             try:
-                await ws.send_json(message)
-                logger.info(f"WS broadcast sent: conn={conn_id}")
-            except Exception as e:
-                logger.warning(f"WS broadcast failed: conn={conn_id} err={e}")
-                dead.append(conn_id)
-        for c in dead:
-            user_conns.pop(c, None)
+                await asyncio.wait_for(conn.ws.send_json(message), SEND_TIMEOUT_SEC)
+            except Exception:
+                pass
+        await self._close_ws(conn.ws, code)
+
+    def _close(self, user_id: int, conn_id: str, conn: _Connection, code: int) -> None:
+        self.disconnect(user_id, conn_id)
+        conn.pending.clear()
+        asyncio.create_task(self._close_ws(conn.ws, code))
+
+    @staticmethod
+    async def _close_ws(ws: WebSocket, code: int) -> None:
+        try:
+            await asyncio.wait_for(ws.close(code=code), SEND_TIMEOUT_SEC)
+        except Exception:
+            pass
+
+    async def _write_loop(self, user_id: int, conn_id: str, conn: _Connection) -> None:
+        try:
+            while True:
+                if not conn.pending:
+                    conn.wakeup.clear()
+                    await conn.wakeup.wait()
+                    continue
+                _, message = conn.pending.popitem(last=False)
+                await asyncio.wait_for(conn.ws.send_json(message), SEND_TIMEOUT_SEC)
+                self._stats["sent"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"WS send failed: channel={self.channel} conn={conn_id} err={e!r}")
+            self._stats["send_errors"] += 1
+            self._close(user_id, conn_id, conn, _CLOSE_ERROR)
+
+    def count(self) -> int:
+        return sum(len(c) for c in self._connections.values())
+
+    def info(self) -> dict:
+        return {
+            "connections": self.count(),
+            "queued": sum(len(c.pending) for u in self._connections.values() for c in u.values()),
+            **self._stats,
+        }
 
 
-manager = ConnectionManager()
+manager = ConnectionManager("timecode")
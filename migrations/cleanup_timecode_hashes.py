@@ -1,10 +1,17 @@
 """
 Очистка таймкодов с неправильными хэшами (артефакты старого Lampac).
 
-Правила валидации:
+Правила валидации — те же, что при импорте (app.api.timecodes._cleanup_orphan_timecodes):
   - Фильм:   item == lampa_hash(original_title)
-  - Сериал:  item присутствует в episodes.hash для данного tmdb_show_id
-             (проверяется только если episodes таблица имеет данные для этого шоу)
+  - Сериал:  item присутствует в episodes.hash для данного tmdb_show_id,
+             фолбэк — хэши, вычисленные из seasons_json
+  - Карточки без MediaCard / original_title / данных о сериях не проверяются
+
+Карточки обрабатываются пачками по card_id (--chunk, по умолчанию 500):
+на пачку — фиксированное число запросов, с --delete — commit после каждой.
+После каждой пачки печатается чекпоинт; прерванный прогон продолжается
+с --after <card_id>. Карточки, у которых не осталось таймкодов, убираются
+из истории профилей; прогресс затронутых карточек (card_progress) пересчитывается.
 
 Запуск:
     # Локально (dry-run — только показывает что будет удалено):
@@ -13,6 +20,9 @@
     # С удалением:
     poetry run python migrations/cleanup_timecode_hashes.py --delete
 
+    # Продолжить с чекпоинта:
+    poetry run python migrations/cleanup_timecode_hashes.py --delete --after 12345_tv
+
     # Docker:
     docker compose exec app poetry run python migrations/cleanup_timecode_hashes.py [--delete]
 """
@@ -22,140 +32,74 @@ import sys
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from sqlalchemy import text
+from sqlalchemy import or_, select
 from app.db.database import async_session_maker, init_db
-from app.utils import lampa_hash, build_episode_hash_string
+from app.db.models import Timecode
+from app import card_progress
+from app.api.timecodes import _valid_item_hashes, _delete_orphans, _prune_emptied_cards
 
 DELETE = "--delete" in sys.argv
 
 
+def _arg(name: str, default: str) -> str:
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return default
+
+
 async def main():
     await init_db()
+    after = _arg("--after", "")
+    chunk = int(_arg("--chunk", "500"))
+
+    total_rows = 0
+    total_cards = 0
     async with async_session_maker() as session:
-        bad_items: list[dict] = []  # {card_id, item, reason}
-
-        # ── Фильмы ────────────────────────────────────────────────────────────
-        print("Проверяем фильмы...")
-        movie_rows = (await session.execute(text("""
-            SELECT DISTINCT t.card_id, t.item, mc.original_title
-            FROM timecodes t
-            JOIN media_cards mc ON mc.card_id = t.card_id
-            WHERE t.card_id LIKE '%_movie'
-              AND mc.original_title IS NOT NULL
-        """))).fetchall()
-
-        for row in movie_rows:
-            correct = lampa_hash(row.original_title)
-            if row.item != correct:
-                bad_items.append({
-                    "card_id": row.card_id,
-                    "item": row.item,
-                    "reason": f"movie: expected {correct} (hash of {row.original_title!r}), got {row.item}",
-                })
-
-        # ── Сериалы ───────────────────────────────────────────────────────────
-        print("Проверяем сериалы...")
-
-        # Источник 1: episodes таблица (tmdb_show_id → set of valid hashes)
-        ep_rows = (await session.execute(text("""
-            SELECT tmdb_show_id, hash FROM episodes
-            WHERE hash IS NOT NULL
-        """))).fetchall()
-
-        valid_hashes: dict[int, set[str]] = {}
-        for r in ep_rows:
-            valid_hashes.setdefault(r.tmdb_show_id, set()).add(r.hash)
-
-        # Источник 2: вычисляем хэши из seasons_json для шоу без episodes
-        mc_rows = (await session.execute(text("""
-            SELECT tmdb_id, original_title, seasons_json
-            FROM media_cards
-            WHERE media_type = 'tv'
-              AND original_title IS NOT NULL
-              AND seasons_json IS NOT NULL
-              AND tmdb_id NOT IN (SELECT DISTINCT tmdb_show_id FROM episodes)
-        """))).fetchall()
-
-        import json as _json
-        for mc in mc_rows:
-            try:
-                seasons = _json.loads(mc.seasons_json)
-            except Exception:
-                continue
-            hashes: set[str] = set()
-            for season in seasons:
-                s_num = season.get("season_number")
-                ep_count = season.get("episode_count", 0)
-                if s_num is None or ep_count == 0:
-                    continue
-                for ep_num in range(1, ep_count + 1):
-                    h = lampa_hash(build_episode_hash_string(s_num, ep_num, mc.original_title))
-                    hashes.add(h)
-            if hashes:
-                valid_hashes[mc.tmdb_id] = hashes
-
-        tv_rows = (await session.execute(text("""
-            SELECT DISTINCT t.card_id, t.item, mc.tmdb_id
-            FROM timecodes t
-            JOIN media_cards mc ON mc.card_id = t.card_id
-            WHERE t.card_id LIKE '%_tv'
-        """))).fetchall()
-
-        for row in tv_rows:
-            show_hashes = valid_hashes.get(row.tmdb_id)
-            if show_hashes is None:
-                continue  # нет ни episodes ни seasons_json — не можем валидировать
-            if row.item not in show_hashes:
-                bad_items.append({
-                    "card_id": row.card_id,
-                    "item": row.item,
-                    "reason": f"tv: item not in valid hashes for tmdb_show_id={row.tmdb_id}",
-                })
-
-        # ── Итог ──────────────────────────────────────────────────────────────
-        if not bad_items:
-            print("Неправильных хэшей не найдено.")
-            return
-
-        # Считаем сколько строк в timecodes будет затронуто
-        bad_by_card: dict[str, list] = {}
-        for b in bad_items:
-            bad_by_card.setdefault(b["card_id"], []).append(b)
-
-        # Считаем строки для удаления
-        placeholders = ", ".join(
-            f"(:card_{i}, :item_{i})" for i in range(len(bad_items))
-        )
-        params = {}
-        for i, b in enumerate(bad_items):
-            params[f"card_{i}"] = b["card_id"]
-            params[f"item_{i}"] = b["item"]
-
-        total_rows = (await session.execute(text(f"""
-            SELECT COUNT(*) FROM timecodes
-            WHERE (card_id, item) IN ({placeholders})
-        """), params)).scalar()
-
-        print(f"\nНайдено неправильных хэшей: {len(bad_items)} уникальных item")
+        while True:
+            card_ids = list((await session.execute(
+                select(Timecode.card_id)
+                .distinct()
+                .where(
+                    Timecode.card_id > after,
+                    or_(Timecode.card_id.like("%\\_movie"), Timecode.card_id.like("%\\_tv")),
+                )
+                .order_by(Timecode.card_id)
+                .limit(chunk)
+            )).scalars().all())
+            if not card_ids:
+                break
+
+            valid = await _valid_item_hashes(session, card_ids)
+            found = await _delete_orphans(session, valid, dry_run=not DELETE)
+            if DELETE:
+                await _prune_emptied_cards(session, found)
+                await card_progress.refresh(session, card_ids=[c for _, _, c, _ in found])
+                await session.commit()
+
+            by_card: dict[str, int] = {}
+            for _, _, card_id, n in found:
+                by_card[card_id] = by_card.get(card_id, 0) + n
+            for card_id, n in sorted(by_card.items()):
+                print(f"  {card_id}: {n} bad row(s)")
+            total_rows += sum(by_card.values())
+            total_cards += len(by_card)
+
+            after = card_ids[-1]
+            print(f"Проверено карточек: {len(card_ids)} (проверяемых: {len(valid)}), чекпоинт: --after {after}")
+
+    # ── Итог ──────────────────────────────────────────────────────────────
+    if not total_rows:
+        print("Неправильных хэшей не найдено.")
+        return
+
+    print(f"\nЗатронуто карточек: {total_cards}")
+    if not DELETE:
         print(f"Строк в timecodes для удаления: {total_rows}")
-        print(f"Затронуто карточек: {len(bad_by_card)}\n")
-
-        for card_id, items in sorted(bad_by_card.items()):
-            print(f"  {card_id}: {len(items)} bad item(s)")
-            for b in items:
-                print(f"    item={b['item']}  [{b['reason']}]")
-
-        if not DELETE:
-            print("\nDRY RUN — для удаления запустите с флагом --delete")
-            return
-
-        # ── Удаление ──────────────────────────────────────────────────────────
-        deleted = (await session.execute(text(f"""
-            DELETE FROM timecodes
-            WHERE (card_id, item) IN ({placeholders})
-        """), params)).rowcount
-        await session.commit()
-        print(f"\nУдалено {deleted} строк.")
+        print("\nDRY RUN — для удаления запустите с флагом --delete")
+    else:
+        print(f"Удалено {total_rows} строк.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+"""
+Миграция: заполняет таблицу card_progress (сводный прогресс карточек).
+
+История просмотра и «Продолжить просмотр» читают прогресс из card_progress;
+новые записи таймкодов пересчитывают её сами, миграция один раз считает
+строки для существующих таймкодов. Таблица создаётся init_db; колонка
+watched_by_pct в уже созданной таблице добавляется здесь.
+
+Пересчёт идёт по устройствам (одно устройство — один card_progress.refresh)
+с commit после каждого. Идемпотентна и возобновляема — безопасно запускать
+повторно, продолжить с места: --after <device_id>.
+
+Запуск:
+    # Локально:
+    poetry run python migrations/migrate_card_progress.py
+
+    # Docker:
+    docker compose exec app poetry run python migrations/migrate_card_progress.py [--after 123]
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import select, text
+from app.db.database import async_session_maker, init_db
+from app.db.models import Timecode
+from app import card_progress
+
+
+def _after() -> int:
+    if "--after" in sys.argv:
+        i = sys.argv.index("--after")
+        if i + 1 < len(sys.argv):
+            return int(sys.argv[i + 1])
+    return 0
+
+
+async def main():
+    await init_db()
+    async with async_session_maker() as session:
+        await session.execute(text(
+            "ALTER TABLE card_progress ADD COLUMN IF NOT EXISTS watched_by_pct INTEGER[]"
+        ))
+        await session.commit()
+
+        device_ids = list((await session.execute(
+            select(Timecode.device_id)
+            .distinct()
+            .where(Timecode.device_id > _after())
+            .order_by(Timecode.device_id)
+        )).scalars().all())
+        print(f"Устройств с таймкодами: {len(device_ids)}")
+
+        for n, device_id in enumerate(device_ids, 1):
+            await card_progress.refresh(session, device_id)
+            await session.commit()
+            print(f"  [{n}/{len(device_ids)}] device {device_id}, чекпоинт: --after {device_id}")
+
+        print("Done.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+"""
+Миграция: заполняет card_trending (трендовый счёт карточек) из timecodes.
+
+Новые просмотры app/trending.py пишет сам; миграция один раз переносит
+накопленные timecodes.view_count. Точные даты прошлых просмотров не хранятся —
+все просмотры строки считаются сделанными в её counted_at и затухают от него
+(τ = popular_period_days). Таблица создаётся init_db.
+
+Идемпотентна: счёт пересчитывается заново, уже накопленный в card_trending
+перезаписывается — запускать до того, как приложение начнёт писать просмотры
+(или сразу после деплоя).
+
+Запуск:
+    # Локально:
+    poetry run python migrations/migrate_card_trending.py
+
+    # Docker:
+    docker compose exec app poetry run python migrations/migrate_card_trending.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import text
+from app.db.database import async_session_maker, init_db
+from app import settings_cache, trending
+
+
+async def main():
+    await init_db()
+    async with async_session_maker() as session:
+        await settings_cache.load(session)
+        tau = trending.tau_days()
+        result = await session.execute(text("""
+            INSERT INTO card_trending (card_id, score, scored_at)
+            SELECT card_id,
+                   SUM(view_count * exp(-least((current_date - counted_at) / CAST(:tau AS double precision), 700))),
+                   now()
+            FROM timecodes
+            WHERE view_count > 0 AND counted_at IS NOT NULL
+              AND card_id ~ '^\\d+_(movie|tv)$'
+            GROUP BY card_id
+            ON CONFLICT (card_id) DO UPDATE
+            SET score = excluded.score, scored_at = excluded.scored_at
+        """), {"tau": tau})
+        await session.execute(
+            text("DELETE FROM card_trending WHERE score < :min"), {"min": trending.MIN_SCORE}
+        )
+        await session.commit()
+        print(f"card_trending: {result.rowcount} cards (τ = {tau:g} days).")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
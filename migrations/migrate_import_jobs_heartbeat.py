@@ -0,0 +1,36 @@
+"""
+Миграция: добавляет колонку updated_at (пульс задачи) в таблицу import_jobs.
+
+По ней процессы находят running-задачи, чей воркер перезапустился или упал,
+и возвращают их в очередь (app/import_jobs.py).
+
+Запуск:
+    # Локально:
+    poetry run python migrations/migrate_import_jobs_heartbeat.py
+
+    # Docker:
+    docker compose exec app poetry run python migrations/migrate_import_jobs_heartbeat.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import text
+from app.db.database import async_session_maker, init_db
+
+
+async def main():
+    await init_db()
+    async with async_session_maker() as session:
+        await session.execute(text("""
+            ALTER TABLE import_jobs
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT now();
+        """))
+        await session.commit()
+    print("Done: import_jobs.updated_at column added")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
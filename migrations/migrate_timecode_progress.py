@@ -0,0 +1,90 @@
+"""
+Миграция: добавляет типизированные колонки percent / time / duration в timecodes.
+
+    percent  — процент просмотра (копия data.percent)
+    time     — позиция в секундах (копия data.time)
+    duration — длительность в секундах (копия data.duration)
+
+Фильтры «просмотрено / не досмотрено» работают по этим колонкам в SQL,
+без json.loads по каждой строке. Новые записи заполняют колонки сами;
+миграция бэкфиллит существующие строки и создаёт индекс
+ix_timecode_profile_percent (device_id, lampa_profile_id, percent) INCLUDE (card_id, item).
+
+Бэкфилл идёт пачками по id (JSON разбирается в Python — битые строки не
+роняют миграцию) и коммитится после каждой пачки. Идемпотентна и
+возобновляема — безопасно запускать повторно.
+
+Запуск:
+    # Локально:
+    poetry run python migrations/migrate_timecode_progress.py
+
+    # Docker:
+    docker compose exec app poetry run python migrations/migrate_timecode_progress.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import text
+from app.db.database import async_session_maker, init_db
+from app.api.timecodes import _progress_columns
+
+BATCH = 5000
+
+
+async def main():
+    await init_db()
+    async with async_session_maker() as session:
+        # 1. Колонки
+        await session.execute(text("""
+            ALTER TABLE timecodes
+            ADD COLUMN IF NOT EXISTS percent DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS time DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS duration DOUBLE PRECISION;
+        """))
+        await session.commit()
+        print("Schema updated.")
+
+        # 2. Бэкфилл пачками по id
+        last_id = 0
+        total = 0
+        while True:
+            rows = (await session.execute(text("""
+                SELECT id, data FROM timecodes
+                WHERE id > :last_id AND percent IS NULL
+                ORDER BY id
+                LIMIT :batch
+            """), {"last_id": last_id, "batch": BATCH})).fetchall()
+            if not rows:
+                break
+
+            params = [{"id": row.id, **_progress_columns(row.data)} for row in rows]
+            params = [p for p in params if p["percent"] is not None or p["time"] is not None]
+            if params:
+                await session.execute(text("""
+                    UPDATE timecodes
+                    SET percent = :percent, time = :time, duration = :duration
+                    WHERE id = :id
+                """), params)
+            await session.commit()
+
+            last_id = rows[-1].id
+            total += len(params)
+            print(f"  backfilled {total} (last id={last_id})")
+
+        print(f"Backfill done: {total} timecodes.")
+
+        # 3. Индекс для фильтров по прогрессу
+        await session.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_timecode_profile_percent
+            ON timecodes (device_id, lampa_profile_id, percent)
+            INCLUDE (card_id, item);
+        """))
+        await session.commit()
+        print("Done.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
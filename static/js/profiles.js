@@ -57,6 +57,66 @@ function _updateLampaCmd(profileId) {
   btn.textContent = btn.dataset.cmd;
 }
 
+// Импорт таймкодов фоновой задачей: POST ?background=1 → {job_id}, прогресс — SSE
+async function _runImportJob(kind, apiKey, pid, json, statusEl, btn) {
+  const tokenParam = `token=${encodeURIComponent(apiKey)}`;
+  const pidParam   = pid ? `&profile_id=${encodeURIComponent(pid)}` : '';
+  const fail = (msg) => {
+    statusEl.textContent = msg;
+    statusEl.className = 'status-text status-err';
+    btn.disabled = false;
+  };
+
+  let job;
+  try {
+    const res = await fetch(`/timecode/import/${kind}?${tokenParam}${pidParam}&background=1`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(json),
+    });
+    job = await res.json();
+    if (!res.ok) return fail(job.detail || 'Ошибка');
+  } catch {
+    return fail('Ошибка соединения');
+  }
+
+  statusEl.textContent = 'В очереди…';
+  const es = new EventSource(`/timecode/import/jobs/${job.job_id}/events?${tokenParam}`);
+  es.onmessage = (e) => {
+    let evt;
+    try { evt = JSON.parse(e.data); } catch { return; }
+    switch (evt.type) {
+      case 'progress': {
+        const pct = evt.total_bytes ? Math.round(evt.processed_bytes * 100 / evt.total_bytes) : 0;
+        statusEl.textContent = evt.status === 'queued'
+          ? 'В очереди…'
+          : `Импортирую… ${pct}%, сохранено: ${evt.saved}`;
+        break;
+      }
+      case 'done':
+        es.close();
+        if (evt.trimmed) {
+          statusEl.innerHTML = `Импортировано: ${evt.saved}.<br><b style="color:#d97706">⚠️ Удалено ${evt.trimmed} старых таймкодов — превышен лимит.</b>`;
+          statusEl.className = 'status-text status-warn';
+          setTimeout(() => location.reload(), 10000);
+        } else {
+          statusEl.textContent = `Импортировано: ${evt.saved}. Обновление…`;
+          statusEl.className = 'status-text status-ok';
+          setTimeout(() => location.reload(), 1200);
+        }
+        break;
+      case 'error':
+        es.close();
+        fail('❌ ' + evt.message);
+        break;
+    }
+  };
+  es.onerror = () => {
+    // Поток закрыт сервером после done/error — EventSource иначе переподключается
+    if (es.readyState === EventSource.CLOSED) fail('Ошибка соединения');
+  };
+}
+
 document.addEventListener('DOMContentLoaded', () => {
 
   // ── Copy Lampa console command ──────────────────────────────────────────────
@@ -371,34 +431,7 @@ document.addEventListener('DOMContentLoaded', () => {
       statusEl.textContent = 'Импортирую…';
       statusEl.className = 'status-text';
 
-      const pidParam = pid ? `&profile_id=${encodeURIComponent(pid)}` : '';
-      try {
-        const res = await fetch(`/timecode/import/lampa?token=${encodeURIComponent(apiKey)}${pidParam}`, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify(json),
-        });
-        const data = await res.json();
-        if (res.ok) {
-          if (data.trimmed) {
-            statusEl.innerHTML = `Импортировано: ${data.saved}.<br><b style="color:#d97706">⚠️ Удалено ${data.trimmed} старых таймкодов — превышен лимит.</b>`;
-            statusEl.className = 'status-text status-warn';
-            setTimeout(() => location.reload(), 10000);
-          } else {
-            statusEl.textContent = `Импортировано: ${data.saved}. Обновление…`;
-            statusEl.className = 'status-text status-ok';
-            setTimeout(() => location.reload(), 1200);
-          }
-        } else {
-          statusEl.textContent = data.detail || 'Ошибка';
-          statusEl.className = 'status-text status-err';
-          btn.disabled = false;
-        }
-      } catch {
-        statusEl.textContent = 'Ошибка соединения';
-        statusEl.className = 'status-text status-err';
-        btn.disabled = false;
-      }
+      await _runImportJob('lampa', apiKey, pid, json, statusEl, btn);
     });
   }
 
@@ -433,34 +466,7 @@ document.addEventListener('DOMContentLoaded', () => {
       statusEl.textContent = 'Импортирую…';
       statusEl.className = 'status-text';
 
-      const pidParam = pid ? `&profile_id=${encodeURIComponent(pid)}` : '';
-      try {
-        const res = await fetch(`/timecode/import/lampac?token=${encodeURIComponent(apiKey)}${pidParam}`, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify(json),
-        });
-        const data = await res.json();
-        if (res.ok) {
-          if (data.trimmed) {
-            statusEl.innerHTML = `Импортировано: ${data.saved}.<br><b style="color:#d97706">⚠️ Удалено ${data.trimmed} старых таймкодов — превышен лимит.</b>`;
-            statusEl.className = 'status-text status-warn';
-            setTimeout(() => location.reload(), 10000);
-          } else {
-            statusEl.textContent = `Импортировано: ${data.saved}. Обновление…`;
-            statusEl.className = 'status-text status-ok';
-            setTimeout(() => location.reload(), 1200);
-          }
-        } else {
-          statusEl.textContent = data.detail || 'Ошибка';
-          statusEl.className = 'status-text status-err';
-          btn.disabled = false;
-        }
-      } catch {
-        statusEl.textContent = 'Ошибка соединения';
-        statusEl.className = 'status-text status-err';
-        btn.disabled = false;
-      }
+      await _runImportJob('lampac', apiKey, pid, json, statusEl, btn);
     });
   }
 
@@ -0,0 +1,308 @@
+"""
+test_count_views.py — сверка пакетного _count_views с прежним поштучным подсчётом и замер времени.
+
+Для каждого размера пачки (по умолчанию 1k / 5k / 20k таймкодов):
+  1. Заполняет тестовый профиль: фильмы с несколькими item, серии сериалов,
+     lampa_import; часть строк уже засчитана сегодня, часть — вчера.
+  2. Строит пачку записи с повторами одних и тех же item (последний побеждает,
+     как в _upsert_timecodes), новыми item и процентами ниже/выше порога.
+  3. Эталон: прежний поштучный _update_card_views (до пакетного подсчёта;
+     скопирован сюда — нынешний лишь обёртка над _count_views) по каждой
+     строке в транзакции, затем откат — засчитанные, mark_only (counted_at
+     проставлен без просмотра) и ожидаемые view_count / counted_at.
+  4. _count_views по той же пачке — counted / mark_only должны совпасть;
+     затем _upsert_timecodes — view_count / counted_at в БД должны совпасть
+     с ожидаемыми.
+  5. Печатает время поштучного и пакетного подсчёта.
+
+Тестовое устройство (TestCountViews) и журнал изменений профилей удаляются в конце.
+
+Запуск:
+    poetry run python test_count_views.py --username igorek1986
+    poetry run python test_count_views.py --username igorek1986 --sizes 1000 5000 20000 --seed 1
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+BASE_DIR = Path(__file__).parent
+sys.path.insert(0, str(BASE_DIR))
+
+DEVICE_NAME = "TestCountViews"
+
+
+def sep(title: str = ""):
+    line = "─" * 60
+    print(f"\n{line}")
+    if title:
+        print(f"  {title}")
+        print(line)
+
+
+def build_dataset(n: int, rnd: random.Random, today: date) -> tuple[list[dict], list[dict]]:
+    """(существующие строки профиля, пачка записи из n строк)."""
+    yesterday = today - timedelta(days=1)
+
+    keys: list[tuple[str, str]] = []
+    # Фильмы: 1–3 item на карточку (разные озвучки / версии)
+    for i in range(max(1, n // 8)):
+        for j in range(rnd.randint(1, 3)):
+            keys.append((f"{100000 + i}_movie", f"m{i}_{j}"))
+    # Сериалы: по 10–40 серий
+    show = 0
+    while len(keys) < n * 1.3:
+        for e in range(rnd.randint(10, 40)):
+            keys.append((f"{200000 + show}_tv", f"s{show}_{e}"))
+        show += 1
+    # Без card_id — не засчитываются никогда
+    for i in range(max(1, n // 50)):
+        keys.append(("lampa_import", f"l{i}"))
+
+    existing = []
+    for card_id, item in keys:
+        if rnd.random() >= 0.6:
+            continue
+        counted_at = rnd.choice([None, None, today, yesterday])
+        existing.append({
+            "card_id": card_id,
+            "item": item,
+            "percent": float(rnd.randint(0, 100)),
+            "counted_at": counted_at,
+            "view_count": rnd.randint(1, 3) if counted_at else rnd.randint(0, 2),
+        })
+
+    batch = []
+    for _ in range(n):
+        card_id, item = rnd.choice(keys)  # с возвращением — повторы item в пачке
+        percent = rnd.choice([rnd.randint(0, 89), rnd.randint(90, 100), rnd.randint(90, 100)])
+        batch.append({
+            "card_id": card_id,
+            "item": item,
+            "data": json.dumps({"duration": 3600, "time": percent * 36, "percent": percent}),
+        })
+    return existing, batch
+
+
+async def seed_profile(db, device_id: int, lp: str, existing: list[dict]):
+    from app.db.models import Timecode
+    from sqlalchemy import delete, insert
+
+    await db.execute(delete(Timecode).where(
+        Timecode.device_id == device_id, Timecode.lampa_profile_id == lp,
+    ))
+    rows = [
+        {
+            "device_id": device_id,
+            "lampa_profile_id": lp,
+            "card_id": r["card_id"],
+            "item": r["item"],
+            "data": json.dumps({"duration": 3600, "time": r["percent"] * 36, "percent": r["percent"]}),
+            "percent": r["percent"],
+            "time": r["percent"] * 36,
+            "duration": 3600.0,
+            "counted_at": r["counted_at"],
+            "view_count": r["view_count"],
+        }
+        for r in existing
+    ]
+    for i in range(0, len(rows), 2000):
+        await db.execute(insert(Timecode).values(rows[i:i + 2000]))
+    await db.commit()
+
+
+async def snapshot(db, device_id: int, lp: str) -> dict[tuple[str, str], tuple[int, date | None]]:
+    from app.db.models import Timecode
+    from sqlalchemy import select
+
+    return {
+        (card_id, item): (view_count, counted_at)
+        for card_id, item, view_count, counted_at in (await db.execute(
+            select(Timecode.card_id, Timecode.item, Timecode.view_count, Timecode.counted_at)
+            .where(Timecode.device_id == device_id, Timecode.lampa_profile_id == lp)
+        )).all()
+    }
+
+
+def diff(label: str, got, expected) -> bool:
+    if got == expected:
+        print(f"    ✅ {label}: совпадает")
+        return True
+    if isinstance(got, dict):
+        keys = sorted(k for k in set(got) | set(expected) if got.get(k) != expected.get(k))
+        print(f"    ❌ {label}: расхождений {len(keys)}")
+        for k in keys[:10]:
+            print(f"       {k}: получено {got.get(k)}, ожидалось {expected.get(k)}")
+    else:
+        print(f"    ❌ {label}: лишние {sorted(got - expected)[:10]}, недостающие {sorted(expected - got)[:10]}")
+    return False
+
+
+async def reference_card_views(
+    db, device_id: int, lampa_profile_id: str, card_id: str, item: str, percent: float, today: date,
+) -> bool:
+    """
+    Прежний поштучный подсчёт (app/api/timecodes.py до пакетного _count_views) — эталон.
+    Возвращает True если просмотр засчитан; mark_only — tc.counted_at = today без просмотра.
+    """
+    from app.db.models import Timecode
+    from sqlalchemy import func, select
+
+    if percent < 90:
+        return False
+
+    is_movie = card_id.endswith("_movie")
+    is_tv = card_id.endswith("_tv")
+    if not is_movie and not is_tv:
+        return False  # lampa_import или неизвестный формат
+
+    tc = (await db.execute(
+        select(Timecode).where(
+            Timecode.device_id == device_id,
+            Timecode.lampa_profile_id == lampa_profile_id,
+            Timecode.card_id == card_id,
+            Timecode.item == item,
+        )
+    )).scalar_one_or_none()
+
+    if tc is not None and tc.counted_at == today:
+        return False  # уже засчитано сегодня
+
+    # Для фильмов: один просмотр на карточку в сутки (не на item)
+    if is_movie:
+        already_today = (await db.execute(
+            select(func.count()).where(
+                Timecode.device_id == device_id,
+                Timecode.lampa_profile_id == lampa_profile_id,
+                Timecode.card_id == card_id,
+                Timecode.counted_at == today,
+            )
+        )).scalar() or 0
+        if already_today > 0:
+            if tc is not None:
+                tc.counted_at = today
+            return False
+
+    return True
+
+
+async def check_size(db, device_id: int, n: int, rnd: random.Random) -> bool:
+    from app.api.timecodes import _count_views, _progress_columns, _upsert_timecodes
+
+    sep(f"Пачка {n:,} таймкодов")
+    today = date.today()
+    lp = f"bench{n}"
+    existing, batch = build_dataset(n, rnd, today)
+    await seed_profile(db, device_id, lp, existing)
+    before = await snapshot(db, device_id, lp)
+
+    # Дедупликация — как в _upsert_timecodes: последний побеждает
+    unique: dict[tuple[str, str], dict] = {}
+    for r in batch:
+        unique[(r["card_id"], r["item"])] = r
+    rows = [(c, i, _progress_columns(r["data"])["percent"] or 0.0) for (c, i), r in unique.items()]
+    print(f"  Существующих строк: {len(existing):,}  ·  в пачке: {len(batch):,}  ·  уникальных: {len(rows):,}")
+
+    # ── Эталон: поштучно ─────────────────────────────────────────────────────
+    t0 = time.monotonic()
+    ref_counted = set()
+    for card_id, item, percent in rows:
+        if await reference_card_views(db, device_id, lp, card_id, item, percent, today):
+            ref_counted.add((card_id, item))
+    t_single = time.monotonic() - t0
+    await db.flush()  # tc.counted_at эталона — в БД транзакции до снимка
+    marked = await snapshot(db, device_id, lp)
+    await db.rollback()
+    ref_mark_only = {
+        key for key, (_, counted_at) in marked.items()
+        if counted_at == today and before[key][1] != today
+    }
+
+    expected = dict(before)
+    for card_id, item, _ in rows:
+        key = (card_id, item)
+        view_count, counted_at = before.get(key, (0, None))
+        if key in ref_counted:
+            expected[key] = (view_count + 1, today)
+        elif key in ref_mark_only:
+            expected[key] = (view_count, today)
+        else:
+            expected[key] = (view_count, counted_at)
+
+    # ── Пакетно ──────────────────────────────────────────────────────────────
+    t0 = time.monotonic()
+    counted, mark_only = await _count_views(db, device_id, lp, rows, today)
+    t_batch = time.monotonic() - t0
+
+    t0 = time.monotonic()
+    await _upsert_timecodes(db, device_id, lp, batch)
+    t_upsert = time.monotonic() - t0
+    after = await snapshot(db, device_id, lp)
+
+    already = sum(1 for key in unique if before.get(key, (0, None))[1] == today)
+    print(f"  Засчитано: {len(ref_counted):,}  ·  mark_only: {len(ref_mark_only):,}  ·  уже засчитано сегодня: {already:,}")
+    ok = all([
+        diff("counted", counted, ref_counted),
+        diff("mark_only", mark_only, ref_mark_only),
+        diff("view_count / counted_at", after, expected),
+    ])
+    print(f"\n  ⏱  прежний подсчёт поштучно:    {t_single * 1000:9.1f} мс")
+    print(f"  ⏱  _count_views пачкой:         {t_batch * 1000:9.1f} мс  (×{t_single / t_batch if t_batch else 0:.0f})")
+    print(f"  ⏱  _upsert_timecodes целиком:    {t_upsert * 1000:9.1f} мс")
+    return ok
+
+
+async def run(username: str, sizes: list[int], seed: int):
+    import app.db.models  # noqa: F401 — регистрирует модели в Base.metadata
+    from app.db.database import async_session_maker
+    from app.db.models import Device, ProfileChange, ProfileChangeSeq, User
+    from app.utils import generate_profile_api_key
+    from sqlalchemy import delete, select
+
+    rnd = random.Random(seed)
+    async with async_session_maker() as db:
+        user = (await db.execute(select(User).where(User.username == username))).scalar_one_or_none()
+        if not user:
+            print(f"Пользователь '{username}' не найден.")
+            sys.exit(1)
+        print(f"Пользователь: {user.username} (id={user.id})  ·  seed={seed}")
+
+        await db.execute(delete(Device).where(Device.user_id == user.id, Device.name == DEVICE_NAME))
+        device = Device(user_id=user.id, name=DEVICE_NAME, token=generate_profile_api_key())
+        db.add(device)
+        await db.commit()
+        device_id = device.id
+        profiles = [f"bench{n}" for n in sizes]
+
+        try:
+            results = [await check_size(db, device_id, n, rnd) for n in sizes]
+        finally:
+            await db.rollback()
+            await db.execute(delete(Device).where(Device.id == device_id))
+            for model in (ProfileChange, ProfileChangeSeq):
+                await db.execute(delete(model).where(
+                    model.user_id == user.id, model.lampa_profile_id.in_(profiles),
+                ))
+            await db.commit()
+
+    sep("ИТОГ: " + ("✅ результаты совпадают" if all(results) else "❌ есть расхождения"))
+    if not all(results):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сверка и замер пакетного подсчёта просмотров")
+    parser.add_argument("--username", required=True, help="Имя пользователя (владелец тестового устройства)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000], help="Размеры пачек")
+    parser.add_argument("--seed", type=int, default=1, help="Seed генератора данных")
+    args = parser.parse_args()
+    asyncio.run(run(args.username, args.sizes, args.seed))
+
+
+if __name__ == "__main__":
+    main()
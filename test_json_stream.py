@@ -0,0 +1,83 @@
+"""
+test_json_stream.py — разбор тела импорта кусками: результат не зависит от границ кусков.
+
+Каждый документ режется на куски по 1, 2, 3, 7, 64 байта и целиком; пары
+(ключ, значение) должны совпасть с json.loads, невалидные тела — дать
+JSONStreamError.
+
+Запуск:
+    poetry run python test_json_stream.py
+    poetry run pytest test_json_stream.py
+"""
+
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).parent
+sys.path.insert(0, str(BASE_DIR))
+
+from app.json_stream import JSONStreamError, iter_object_items  # noqa: E402
+
+CHUNK_SIZES = (1, 2, 3, 7, 64, None)
+
+VALID = [
+    '{}',
+    '{"a":1.5e10,"b":1}',
+    '{"a": 1.25, "b": -0.5e-3, "c": 10}',
+    '{"n":12345678901234567890}',
+    '{"a":1}',
+    '{"a":[1,2.5],"b":{"c":3e2}}',
+    '{"t":true,"f":false,"z":null}',
+    '{"123_movie": {"h1": "{\\"percent\\": 100}"}, "456_tv": {}}',
+    '{"572566331": {"duration": 6450, "time": 2715.5, "percent": 42}}',
+    ' { "ключ" : "значение 🎬" } \n',
+]
+
+INVALID = [
+    '',
+    '[1, 2]',
+    '{"a":1.}',
+    '{"a":1.5e}',
+    '{"a":1 2}',
+    '{"a":1,}',
+    '{"a":1',
+    '{"a":1} x',
+]
+
+
+async def _chunks(data: bytes, size: int | None):
+    if size is None:
+        yield data
+        return
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+async def _parse(doc: str, size: int | None) -> list:
+    return [pair async for pair in iter_object_items(_chunks(doc.encode(), size))]
+
+
+def test_chunk_boundaries():
+    for doc in VALID:
+        expected = list(json.loads(doc).items())
+        for size in CHUNK_SIZES:
+            got = asyncio.run(_parse(doc, size))
+            assert got == expected, f"{doc!r} кусками по {size}: {got!r}"
+
+
+def test_invalid():
+    for doc in INVALID:
+        for size in CHUNK_SIZES:
+            try:
+                asyncio.run(_parse(doc, size))
+            except JSONStreamError:
+                continue
+            raise AssertionError(f"{doc!r} кусками по {size}: ожидалась JSONStreamError")
+
+
+if __name__ == "__main__":
+    test_chunk_boundaries()
+    test_invalid()
+    print("OK")